@@ -1,7 +1,10 @@
 import os
+import sqlite3
 import subprocess
 import datetime
+import time
 
+import click
 from flask import Flask
 from flask_login import LoginManager
 from flask_migrate import Migrate
@@ -14,6 +17,23 @@ from app.models import db, User, Role
 from flask_security import Security, SQLAlchemyUserDatastore
 from app.routes.admin import create_admin_blueprint
 from app.utils.rbac_permissions import initialize_rbac, assign_role_to_user
+from app.utils.pacientes_busca import build_search_index
+from app.utils.pacientes_binario import compile_binary_index
+from app.utils.pacientes_import import CHAVES, BATCH_SIZE, import_pacientes
+from app.utils.contadores import init_status_counters, rebuild_status_counters
+from app.utils.rollup_diario import init_daily_rollup, rebuild_daily_rollup
+from app.utils.planos_consulta import criar_indices_expressao, indices_expressao_faltando, verificar_planos
+from app.utils.eventos import backfill_eventos, init_eventos
+from app.utils.pdf_render import autorizados_em, renderizar_lote
+from app.utils.jobs import TAREFAS, Worker, enfileirar, init_jobs
+from app.utils.anexos import coletar_orfaos, init_anexos
+from app.utils.anexos_preview import init_previews
+from app.utils.carregamento import init_lazyload_check
+from app.utils.instrumentacao import init_request_timing
+from app.utils.facetas import init_facetas
+from app.utils.rbac_bits import init_rbac_bits
+from app.utils.capacidades import init_capacidades
+from app.utils.identidade import carregar_usuario, init_identidade
 from app.routes.auth import auth_bp
 from app.routes.main import main_bp
 from app.routes.util import format_status_filter, util_bp, format_date_filter
@@ -37,6 +57,35 @@ def create_app():
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'app', 'uploads')
     app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024
+    app.config['PACIENTES_DB_PATH'] = os.getenv('PACIENTES_DB_PATH', os.path.join(instance_dir, 'pacientes.db'))
+    app.config['PACIENTES_BIN_PATH'] = os.getenv('PACIENTES_BIN_PATH', os.path.join(instance_dir, 'pacientes.idx'))
+    app.config['PACIENTES_BUSCA_MEMORIA'] = os.getenv('PACIENTES_BUSCA_MEMORIA', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['STATUS_COUNTERS'] = os.getenv('STATUS_COUNTERS', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['DAILY_ROLLUP'] = os.getenv('DAILY_ROLLUP', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['PANEL_CACHE_TTL'] = int(os.getenv('PANEL_CACHE_TTL', '60'))
+    app.config['IDENTITY_CACHE_TTL'] = int(os.getenv('IDENTITY_CACHE_TTL', '0'))
+    app.config['PDF_CACHE_DIR'] = os.getenv('PDF_CACHE_DIR', os.path.join(instance_dir, 'pdfs'))
+    app.config['PDF_WORKERS'] = int(os.getenv('PDF_WORKERS', '2'))
+    app.config['PDF_TIMEOUT'] = int(os.getenv('PDF_TIMEOUT', '60'))
+    app.config['JOB_MAX_TENTATIVAS'] = int(os.getenv('JOB_MAX_TENTATIVAS', '3'))
+    app.config['JOB_BACKOFF_S'] = int(os.getenv('JOB_BACKOFF_S', '30'))
+    app.config['JOB_TIMEOUT_S'] = int(os.getenv('JOB_TIMEOUT_S', '1800'))
+    app.config['ANEXOS_DIR'] = os.getenv('ANEXOS_DIR', os.path.join(app.config['UPLOAD_FOLDER'], 'anexos'))
+    app.config['ANEXOS_EXTENSOES'] = os.getenv('ANEXOS_EXTENSOES', 'pdf,jpg,jpeg,png')
+    app.config['ANEXOS_ACCEL_REDIRECT'] = os.getenv('ANEXOS_ACCEL_REDIRECT', '')
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['PREVIEW_FORMATO'] = os.getenv('PREVIEW_FORMATO', 'webp').lower()
+    app.config['PREVIEW_THUMB_PX'] = int(os.getenv('PREVIEW_THUMB_PX', '320'))
+    app.config['PREVIEW_MEDIA_PX'] = int(os.getenv('PREVIEW_MEDIA_PX', '1600'))
+    app.config['SQLALCHEMY_STRICT_LOADING'] = os.getenv('SQLALCHEMY_STRICT_LOADING', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['SQLALCHEMY_LAZYLOAD_CHECK'] = os.getenv('SQLALCHEMY_LAZYLOAD_CHECK', '').lower()
+    app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING', '0').lower() in ('1', 'true', 'on', 'yes')
+    app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', '0'))
+    app.config['AGENDA_INICIO'] = os.getenv('AGENDA_INICIO', '07:00')
+    app.config['AGENDA_FIM'] = os.getenv('AGENDA_FIM', '17:00')
+    app.config['AGENDA_INTERVALO_MIN'] = int(os.getenv('AGENDA_INTERVALO_MIN', '30'))
+    app.config['AGENDA_DIAS_SEMANA'] = os.getenv('AGENDA_DIAS_SEMANA', '0,1,2,3,4')
+    app.config['AGENDA_MAX_DIAS'] = int(os.getenv('AGENDA_MAX_DIAS', '31'))
 
     app.config['SECURITY_PASSWORD_HASH'] = os.getenv('SECURITY_PASSWORD_HASH', 'argon2')
     app.config['SECURITY_PASSWORD_SALT'] = os.getenv('SECURITY_PASSWORD_SALT', 'change-me-salt')
@@ -54,6 +103,18 @@ def create_app():
     app.config['SECURITY_UNAUTHORIZED_VIEW'] = 'main.panel'
     db.init_app(app)
     Migrate(app, db)
+    init_status_counters(app)
+    init_daily_rollup(app)
+    init_lazyload_check(app)
+    init_request_timing(app)
+    init_facetas(app)
+    init_rbac_bits(app)
+    init_capacidades(app)
+    init_eventos(app)
+    init_identidade(app)
+    init_jobs(app)
+    init_anexos(app)
+    init_previews(app)
 
     user_datastore = SQLAlchemyUserDatastore(db, User, Role)
     Security(app=app, datastore=user_datastore, register_blueprint=False)
@@ -62,6 +123,7 @@ def create_app():
     registry_routes(app)
     registry_filters(app)
     initdb(app)
+    registry_commands(app)
     return app
 
 def registry_routes(app):
@@ -81,15 +143,7 @@ def login_config(app):
 
     @login_manager.user_loader
     def load_user(user_id: str):
-        if not user_id:
-            return None
-        user = User.query.filter_by(fs_uniquifier=user_id).first()
-        if user:
-            return user
-        try:
-            return db.session.get(User, int(user_id))
-        except (ValueError, TypeError):
-            return None
+        return carregar_usuario(user_id)
 
 def registry_filters(app):
     app.jinja_env.filters['format_date'] = format_date_filter
@@ -135,4 +189,178 @@ def initdb(app):
         msg = f"Auto migration - {datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}"
         subprocess.run([".\\venv\\Scripts\\flask", "db", "migrate", "-m", msg], check=True)
         subprocess.run([".\\venv\\Scripts\\flask", "db", "upgrade"], check=True)
-        print("Migração e upgrade aplicados com sucesso.")
\ No newline at end of file
+        # O autogenerate não detecta índices de expressão no SQLite
+        subprocess.run([".\\venv\\Scripts\\flask", "create-expression-indexes"], check=True)
+        print("Migração e upgrade aplicados com sucesso.")
+
+def registry_commands(app):
+    @app.cli.command("index-pacientes")
+    def index_pacientes_command():
+        """Cria/recria os índices de busca (FTS5 + CPF/CNS) no pacientes.db."""
+        db_path = app.config['PACIENTES_DB_PATH']
+        if not os.path.exists(db_path):
+            print(f"Banco de pacientes não encontrado: {db_path}")
+            return
+        inicio = time.perf_counter()
+        conn = sqlite3.connect(db_path)
+        try:
+            total = build_search_index(conn)
+        finally:
+            conn.close()
+        print(f"Índice de pacientes criado: {total} registros em {time.perf_counter() - inicio:.1f}s.")
+
+
+    @app.cli.command("compile-pacientes")
+    def compile_pacientes_command():
+        """Compila o pacientes.db no índice binário compartilhado (mmap)."""
+        db_path = app.config['PACIENTES_DB_PATH']
+        if not os.path.exists(db_path):
+            print(f"Banco de pacientes não encontrado: {db_path}")
+            return
+        inicio = time.perf_counter()
+        try:
+            total = compile_binary_index(db_path, app.config['PACIENTES_BIN_PATH'])
+        except PermissionError as e:
+            raise click.ClickException(str(e))
+        print(f"Índice binário gerado em {app.config['PACIENTES_BIN_PATH']}: {total} registros em {time.perf_counter() - inicio:.1f}s.")
+
+
+    @app.cli.command("import-pacientes")
+    @click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--chave", type=click.Choice(CHAVES), default="cns", show_default=True,
+                  help="Campo usado para atualizar pacientes já existentes.")
+    @click.option("--lote", type=int, default=BATCH_SIZE, show_default=True, help="Registros por transação.")
+    def import_pacientes_command(arquivo, chave, lote):
+        """Importa um dump CSV/JSONL (.gz opcional) para o pacientes.db."""
+        db_path = app.config['PACIENTES_DB_PATH']
+
+        def progresso(stats):
+            print(f"  {stats['lidos']} lidos | {stats['gravados']} gravados | "
+                  f"{stats['ignorados']} ignorados | {stats['linhas_por_segundo']:.0f} linhas/s")
+
+        try:
+            stats = import_pacientes(db_path, arquivo, chave=chave, batch_size=lote, progress=progresso)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(f"Importação concluída: {stats['gravados']} gravados, {stats['ignorados']} ignorados, "
+              f"{stats['indexados']} indexados em {stats['segundos']:.1f}s "
+              f"({stats['linhas_por_segundo']:.0f} linhas/s).")
+        if os.path.exists(app.config['PACIENTES_BIN_PATH']):
+            try:
+                total = compile_binary_index(db_path, app.config['PACIENTES_BIN_PATH'])
+            except PermissionError as e:
+                raise click.ClickException(str(e))
+            print(f"Índice binário atualizado: {total} registros.")
+
+
+    @app.cli.command("rebuild-status-counters")
+    def rebuild_status_counters_command():
+        """Recalcula a tabela status_counters (use ao habilitar STATUS_COUNTERS)."""
+        with app.app_context():
+            counts = rebuild_status_counters()
+        print(f"Contadores de status recalculados: {sum(counts.values())} formulários em {len(counts)} status.")
+
+
+    @app.cli.command("rebuild-daily-rollup")
+    def rebuild_daily_rollup_command():
+        """Recalcula a tabela formulario_daily_rollup (use ao habilitar DAILY_ROLLUP)."""
+        with app.app_context():
+            linhas = rebuild_daily_rollup()
+        print(f"Consolidado diário recalculado: {linhas} linhas.")
+
+
+    @app.cli.command("check-query-plans")
+    def check_query_plans_command():
+        """Falha se alguma consulta das rotas varrer formulario inteira ou ordenar em B-tree temporária."""
+        with app.app_context():
+            resultado = verificar_planos()
+            faltando = [indice.name for indice in indices_expressao_faltando()]
+        falhas = 0
+        for nome, plano, ok in resultado:
+            print(f"[{'OK' if ok else 'SCAN'}] {nome}")
+            for linha in plano:
+                print(f"       {linha}")
+            falhas += not ok
+        if falhas:
+            dica = (f"faltam os índices de expressão {', '.join(faltando)}; rode `flask create-expression-indexes`"
+                    if faltando else "confira se as migrações de índices foram aplicadas com `flask db upgrade`")
+            raise click.ClickException(
+                f"{falhas} consulta(s) com varredura completa de formulario ou ORDER BY sem índice ({dica}).")
+        print(f"Planos de consulta verificados: {len(resultado)} consultas usando índices.")
+
+
+    @app.cli.command("create-expression-indexes")
+    def create_expression_indexes_command():
+        """Cria os índices de expressão de formulario (o autogenerate do alembic não os gera no SQLite).
+
+        Rodar depois de `flask db upgrade`; o `flask migrate-upgrade` já chama este comando.
+        """
+        with app.app_context():
+            criados = criar_indices_expressao()
+        print(f"Índices de expressão criados: {', '.join(criados)}." if criados
+              else "Índices de expressão já existem.")
+
+
+    @app.cli.command("backfill-eventos")
+    @click.option("--lote", type=int, default=500, show_default=True, help="Formulários por transação.")
+    def backfill_eventos_command(lote):
+        """Migra o histórico de Formulario.observacao para a tabela formulario_evento."""
+        with app.app_context():
+            stats = backfill_eventos(lote=lote)
+        print(f"Eventos migrados: {stats['eventos']} eventos de {stats['formularios']} formulários.")
+
+
+    @app.cli.command("render-pdfs")
+    @click.option("--data", "dia", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+                  help="Dia das autorizações (padrão: hoje).")
+    def render_pdfs_command(dia):
+        """Gera os PDFs das autorizações de um dia (usa o cache por conteúdo)."""
+        dia = dia.date() if dia else datetime.date.today()
+        with app.app_context():
+            formularios = autorizados_em(dia)
+            stats = renderizar_lote(formularios)
+            db.session.commit()
+        print(f"PDFs de {dia:%d/%m/%Y}: {stats['total']} autorizações, {stats['cache']} já em cache, "
+              f"{stats['gerados']} gerados, {stats['erros']} erros.")
+        if stats['erros']:
+            raise click.ClickException("Alguns PDFs não puderam ser gerados; veja o log.")
+
+
+    @app.cli.command("worker")
+    @click.option("--threads", type=int, default=1, show_default=True, help="Tarefas em paralelo neste processo.")
+    @click.option("--poll", type=float, default=2.0, show_default=True, help="Intervalo (s) entre buscas na fila vazia.")
+    @click.option("--once", is_flag=True, help="Executa as tarefas prontas e sai.")
+    def worker_command(threads, poll, once):
+        """Executa as tarefas da fila em segundo plano (tabela jobs)."""
+        worker = Worker(app, threads=threads, poll=poll)
+        if once:
+            print(f"Tarefas executadas: {worker.run_once()}.")
+            return
+        print(f"Worker {worker.id} aguardando tarefas ({threads} thread(s)). Ctrl+C para parar.")
+        worker.run()
+
+
+    @app.cli.command("enqueue-job")
+    @click.argument("tipo", type=click.Choice(sorted(TAREFAS)))
+    @click.option("--payload", default="{}", show_default=True, help="Argumentos da tarefa em JSON.")
+    def enqueue_job_command(tipo, payload):
+        """Coloca uma tarefa na fila do worker."""
+        import json
+        with app.app_context():
+            try:
+                job = enfileirar(tipo, json.loads(payload))
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            db.session.commit()
+            print(f"Tarefa {job.id} ({tipo}) enfileirada.")
+
+
+    @app.cli.command("gc-anexos")
+    @click.option("--idade", type=int, default=3600, show_default=True,
+                  help="Só apaga arquivos sem uso mais velhos que isso (segundos).")
+    def gc_anexos_command(idade):
+        """Apaga do disco conteúdos de anexos que não pertencem a nenhum formulário."""
+        with app.app_context():
+            stats = coletar_orfaos(idade_minima=idade)
+        print(f"Anexos: {stats['arquivos']} arquivos verificados, {stats['removidos']} removidos "
+              f"({stats['bytes'] / 1024 / 1024:.1f} MB).")
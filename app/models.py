@@ -1,4 +1,5 @@
 import enum
+import json
 from flask import url_for
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, date
@@ -56,19 +57,25 @@ class User(db.Model, FSUserMixin):
         self.is_active = bool(value)
     
     def has_permission(self, permission_name):
-        """Check permission via Flask-Security role permissions only."""
-        try:
-            if super().has_permission(permission_name):
-                return True
-        except Exception:
-            pass
+        """Check permission via role permissions (compiled bitmask, see app.utils.rbac_bits)."""
+        return self.has_any_permission(permission_name)
+
+    def has_any_permission(self, *permission_names):
+        from app.utils import rbac_bits
+
+        if rbac_bits.disponivel(self):
+            return rbac_bits.tem_alguma(self, *permission_names)
         for role in self.roles:
-            if role.has_permission(permission_name):
+            if any(role.has_permission(p) for p in permission_names):
                 return True
         return False
     
     def get_permissions(self):
         """Retorna todas as permissões do usuário (diretas + através de papéis)"""
+        from app.utils import rbac_bits
+
+        if rbac_bits.disponivel(self):
+            return rbac_bits.permissoes(self)
         permissions = set()
         
         for role in self.roles:
@@ -91,8 +98,40 @@ class PermissionCatalog(db.Model):
     def __repr__(self):
         return f'<Permission {self.name}>'
 
+# Ordem de trabalho das listas de Regulação e UBS. Ficam como SQL literal porque
+# o SQLite só usa um índice de expressão se a consulta repetir a mesma expressão.
+PRIORIDADE_REGULACAO_SQL = "CASE WHEN status IN ('EM_ANALISE', 'PENDENTE') THEN 0 WHEN status = 'AGENDADO' THEN 1 ELSE 2 END"
+PRIORIDADE_UBS_SQL = (
+    "CASE status WHEN 'PENDENTE' THEN 0 WHEN 'EM_ANALISE' THEN 1 "
+    "WHEN 'AGENDADO' THEN 2 WHEN 'CONCLUIDO' THEN 3 ELSE 4 END"
+)
+
 class Formulario(db.Model):
     __tablename__ = 'formulario'
+    __table_args__ = (
+        db.Index('ix_formulario_status_registro', 'status', 'data_registro', 'id'),
+        db.Index('ix_formulario_data_registro', 'data_registro', 'id'),
+        db.Index('ix_formulario_status_atendimento', 'status', 'data_atendimento', 'hora_agendamento', 'id'),
+        db.Index('ix_formulario_funcionario_registro', 'funcionario_id', 'data_registro', 'id'),
+        db.Index('ix_formulario_medico_horario', 'medico_atendimento', 'data_atendimento', 'hora_agendamento'),
+        db.Index('ix_formulario_local_horario', 'local_destino', 'data_atendimento', 'hora_agendamento'),
+        # Um agendamento ativo por médico/local e intervalo da grade: as rotas só aceitam horas
+        # no início de um intervalo (hora_na_grade), então o índice fecha a corrida
+        db.Index('ux_formulario_slot_medico', 'medico_atendimento', 'data_atendimento', 'hora_agendamento',
+                 unique=True, sqlite_where=db.text("status = 'AGENDADO'"),
+                 postgresql_where=db.text("status = 'AGENDADO'")),
+        db.Index('ux_formulario_slot_local', 'local_destino', 'data_atendimento', 'hora_agendamento',
+                 unique=True, sqlite_where=db.text("status = 'AGENDADO'"),
+                 postgresql_where=db.text("status = 'AGENDADO'")),
+        # Índices de expressão: o autogenerate do alembic não os enxerga no SQLite; são criados
+        # por `flask create-expression-indexes` (executado pelo `flask migrate-upgrade`)
+        db.Index('ix_formulario_prioridade_regulacao',
+                 db.text(f'({PRIORIDADE_REGULACAO_SQL})'), db.text('data_registro DESC'), db.text('id DESC')),
+        db.Index('ix_formulario_prioridade_ubs',
+                 db.text(f'({PRIORIDADE_UBS_SQL})'), db.text('data_registro DESC'), db.text('id DESC')),
+        db.Index('ix_formulario_funcionario_prioridade_ubs', 'funcionario_id',
+                 db.text(f'({PRIORIDADE_UBS_SQL})'), db.text('data_registro DESC'), db.text('id DESC')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     data_registro = db.Column(db.DateTime, nullable=False)
     funcionario_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -120,6 +159,115 @@ class Formulario(db.Model):
 
     funcionario = db.relationship('User', foreign_keys=[funcionario_id], backref="formularios_criados")
     autorizador = db.relationship('User', foreign_keys=[autorizador_id], backref="formularios_autorizados")
+    eventos = db.relationship('FormularioEvento', back_populates='formulario', cascade='all, delete-orphan',
+                              order_by='(FormularioEvento.criado_em, FormularioEvento.id)')
+    anexos = db.relationship('Anexo', back_populates='formulario', cascade='all, delete-orphan',
+                             order_by='(Anexo.criado_em, Anexo.id)')
+
+
+class Anexo(db.Model):
+    """Arquivo anexado a um formulário; o conteúdo fica em disco, endereçado pelo SHA-256."""
+    __tablename__ = 'anexos'
+    __table_args__ = (
+        db.Index('ix_anexos_formulario', 'formulario_id', 'criado_em', 'id'),
+        db.Index('ix_anexos_sha256', 'sha256'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    formulario_id = db.Column(db.Integer, db.ForeignKey('formulario.id'), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    nome = db.Column(db.String(255), nullable=False)
+    mimetype = db.Column(db.String(100), nullable=False)
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    enviado_por_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Extensão das prévias geradas ('webp'/'jpg'); '' = sem prévia possível, nulo = pendente
+    preview = db.Column(db.String(10), nullable=True)
+
+    formulario = db.relationship('Formulario', back_populates='anexos')
+    enviado_por = db.relationship('User', foreign_keys=[enviado_por_id])
+
+
+class FormularioEvento(db.Model):
+    """Linha do tempo do fluxo (Regulação, Ambulatório, UBS) de um formulário."""
+    __tablename__ = 'formulario_evento'
+    __table_args__ = (
+        db.Index('ix_formulario_evento_formulario', 'formulario_id', 'criado_em', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    formulario_id = db.Column(db.Integer, db.ForeignKey('formulario.id'), nullable=False)
+    tipo = db.Column(db.String(40), nullable=False)
+    mensagem = db.Column(db.Text, nullable=True)
+    ator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    # Nome de quem registrou no momento do evento (eventos antigos só têm o nome)
+    ator_nome = db.Column(db.String(100), nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    formulario = db.relationship('Formulario', back_populates='eventos')
+    ator = db.relationship('User', foreign_keys=[ator_id])
+
+
+class StatusCounter(db.Model):
+    """Total de formulários por status, mantido junto com cada transição (STATUS_COUNTERS)."""
+    __tablename__ = 'status_counters'
+    status = db.Column(db.String(30), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+
+class FormularioDailyRollup(db.Model):
+    """Formulários por dia de registro x especialidade x status x unidade (DAILY_ROLLUP)."""
+    __tablename__ = 'formulario_daily_rollup'
+    __table_args__ = (
+        db.Index('ix_formulario_daily_rollup_status_dia', 'status', 'dia'),
+    )
+    dia = db.Column(db.Date, primary_key=True)
+    especialidade = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(30), primary_key=True)
+    unidade_saude = db.Column(db.String(100), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    """Tarefa em segundo plano executada por ``flask worker`` (ver app/utils/jobs.py)."""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_executar', 'status', 'executar_em', 'id'),
+        db.Index('ix_jobs_status_tipo', 'status', 'tipo'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='PENDENTE')
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    max_tentativas = db.Column(db.Integer, nullable=False, default=3)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    executar_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime, nullable=True)
+    concluido_em = db.Column(db.DateTime, nullable=True)
+    worker = db.Column(db.String(100), nullable=True)
+    resultado = db.Column(db.Text, nullable=True)
+    erro = db.Column(db.Text, nullable=True)
+    criado_por_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'status': self.status,
+            'tentativas': self.tentativas,
+            'max_tentativas': self.max_tentativas,
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None,
+            'iniciado_em': self.iniciado_em.isoformat() if self.iniciado_em else None,
+            'concluido_em': self.concluido_em.isoformat() if self.concluido_em else None,
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'erro': self.erro,
+        }
+
+
+class CacheVersion(db.Model):
+    """Contador de versão por nome; cada worker compara com a versão do seu cache em memória."""
+    __tablename__ = 'cache_versions'
+    nome = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
 
 
 class UnidadeSaude(db.Model):
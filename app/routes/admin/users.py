@@ -2,6 +2,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import current_user, login_required
 from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
 from werkzeug.security import generate_password_hash
 from app.models import db, User, Role
 from app.utils.rbac_permissions import require_permission
@@ -82,7 +83,7 @@ def render_users_list():
     status_filter = request.args.get('status', '')
     sort_option = request.args.get('sort', 'date_desc')
     
-    query = User.query
+    query = User.query.options(selectinload(User.roles))
     
     if search_query:
         query = query.filter(
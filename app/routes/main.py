@@ -2,6 +2,10 @@ from flask import Blueprint, render_template, redirect, session, url_for, flash
 from flask_login import login_required, current_user
 from sqlalchemy import func, select
 from app.models import db, Formulario, User
+from app.utils.capacidades import pode
+from app.utils.carregamento import formulario_options
+from app.utils.painel_cache import get_panel_cache
+from app.utils.rollup_diario import rollup_enabled, total_por_especialidade, total_por_status
 from datetime import date, timedelta
 
 main_bp = Blueprint('main', __name__, template_folder='../templates')
@@ -11,6 +15,44 @@ def index():
     return redirect(url_for("main.panel"))
 
 #<-- PAINEL PRINCIPAL -->
+def _dashboard_relatorios(hoje):
+    """Agregados de quem tem ADMIN ou VER_RELATORIOS (iguais para todos esses usuários)."""
+    dados = {}
+    usar_rollup = rollup_enabled()
+    if usar_rollup:
+        dados['formularios_em_analise'] = total_por_status('EM_ANALISE')
+    else:
+        stmt_em_analise = db.select(func.count(Formulario.id)).where(Formulario.status == 'EM_ANALISE')
+        dados['formularios_em_analise'] = db.session.execute(stmt_em_analise).scalar_one_or_none() or 0
+
+    # Por data de atendimento (não de registro): usa ix_formulario_status_atendimento
+    stmt_agendados_hoje = db.select(func.count(Formulario.id)).where(
+        Formulario.status == 'AGENDADO',
+        Formulario.data_atendimento == hoje
+    )
+    dados['agendados_hoje'] = db.session.execute(stmt_agendados_hoje).scalar_one_or_none() or 0
+    dados['data_hoje'] = hoje.isoformat()
+
+    data_inicio_grafico = hoje - timedelta(days=30)
+    if usar_rollup:
+        resultados_grafico = total_por_especialidade(data_inicio_grafico, limite=6)
+    else:
+        stmt_grafico = db.select(Formulario.especialidade, func.count(Formulario.id).label('total'))\
+            .where(Formulario.data_registro >= data_inicio_grafico)\
+            .group_by(Formulario.especialidade)\
+            .order_by(func.count(Formulario.id).desc())\
+            .limit(6)
+        resultados_grafico = db.session.execute(stmt_grafico).all()
+    dados['labels_grafico'] = [r.especialidade for r in resultados_grafico]
+    dados['data_grafico'] = [r.total for r in resultados_grafico]
+    return dados
+
+
+def _dashboard_admin():
+    stmt_total_users = db.select(func.count(User.id))
+    return {'total_usuarios': db.session.execute(stmt_total_users).scalar_one_or_none() or 0}
+
+
 @main_bp.route("/panel")
 @login_required
 def panel():
@@ -18,35 +60,19 @@ def panel():
     
     dados_dashboard['labels_grafico'] = []
     dados_dashboard['data_grafico'] = []
+    cache = get_panel_cache()
     
-    if 'ADMIN' in current_user.profile or 'VER_RELATORIOS' in current_user.profile:
-        stmt_em_analise = db.select(func.count(Formulario.id)).where(Formulario.status == 'EM_ANALISE')
-        dados_dashboard['formularios_em_analise'] = db.session.execute(stmt_em_analise).scalar_one_or_none() or 0
-        
+    if pode('ADMIN', 'VER_RELATORIOS'):
         hoje = date.today()
-        stmt_agendados_hoje = db.select(func.count(Formulario.id)).where(
-            Formulario.status == 'AGENDADO',
-            Formulario.data_atendimento == hoje
-        )
-        dados_dashboard['agendados_hoje'] = db.session.execute(stmt_agendados_hoje).scalar_one_or_none() or 0
-        dados_dashboard['data_hoje'] = hoje.isoformat()
-        
-        data_inicio_grafico = date.today() - timedelta(days=30)
-        stmt_grafico = db.select(Formulario.especialidade, func.count(Formulario.id).label('total'))\
-            .where(Formulario.data_registro >= data_inicio_grafico)\
-            .group_by(Formulario.especialidade)\
-            .order_by(func.count(Formulario.id).desc())\
-            .limit(6)
-        resultados_grafico = db.session.execute(stmt_grafico).all()
-        dados_dashboard['labels_grafico'] = [r.especialidade for r in resultados_grafico]
-        dados_dashboard['data_grafico'] = [r.total for r in resultados_grafico]
+        dados_dashboard.update(cache.get_or_compute(('relatorios', hoje), lambda: _dashboard_relatorios(hoje)))
 
-    if 'ADMIN' in current_user.profile:
-        stmt_total_users = db.select(func.count(User.id))
-        dados_dashboard['total_usuarios'] = db.session.execute(stmt_total_users).scalar_one_or_none() or 0
+    if pode('ADMIN'):
+        dados_dashboard.update(cache.get_or_compute(('admin',), _dashboard_admin))
             
-    if 'CRIAR_RELATORIOS' in current_user.profile:
+    # Por usuário: fica fora do cache
+    if pode('CRIAR_RELATORIOS'):
         stmt_meus_envios = db.select(Formulario)\
+            .options(*formulario_options())\
             .where(Formulario.funcionario_id == current_user.id)\
             .order_by(Formulario.data_registro.desc())\
             .limit(5)
@@ -1,50 +1,47 @@
+import os
 from datetime import datetime, timedelta, date
-from flask import Blueprint, flash, redirect, render_template, request, session, url_for, abort, jsonify, current_app
+from flask import Blueprint, Response, flash, redirect, render_template, request, send_file, session, stream_with_context, url_for, abort, jsonify, current_app
 from flask_login import current_user, login_required
-from sqlalchemy import Date, cast, select, func, or_, case
-from ..models import db, Formulario, User
-import os
-import sqlite3
-try:
-    from zoneinfo import ZoneInfo
-except Exception:
-    ZoneInfo = None
-
-
-def _now_brasilia() -> datetime:
-    """Return current datetime in Brasília timezone (America/Sao_Paulo).
-    Falls back to UTC-3 if IANA tz database is unavailable (e.g., Windows without tzdata).
-    """
-    if ZoneInfo is not None:
-        try:
-            return datetime.now(ZoneInfo("America/Sao_Paulo"))
-        except Exception:
-            pass
-    # Fallback: approximate Brasília time as UTC-3 (no DST handling)
-    return datetime.utcnow() - timedelta(hours=3)
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import Date, cast, select, or_, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from ..models import db, Anexo, Formulario, FormularioEvento, Job, User, PRIORIDADE_REGULACAO_SQL, PRIORIDADE_UBS_SQL
+from ..utils.pacientes_busca import search_pacientes
+from ..utils.pacientes_pool import get_pacientes_pool
+from ..utils.pacientes_memoria import get_pacientes_mem_search
+from ..utils.pacientes_cache import get_pacientes_cache
+from ..utils.pacientes_binario import get_pacientes_bin_search
+from ..utils.paginacao import SortKey, keyset_paginate
+from ..utils.contadores import contar_por, status_counts
+from ..utils import anexos, anexos_preview, eventos, exportacao, jobs, pdf_render
+from ..utils.eventos import registrar_evento
+from ..utils.carregamento import DETALHE, LISTA, PDF, formulario_options
+from ..utils.facetas import facetas
+from ..utils.agenda_slots import conflito_horario, hora_na_grade, normalizar_hora, slots_livres
+from ..utils.capacidades import pode, requer_capacidade
 
 sisreg_bp = Blueprint('sisreg', __name__, template_folder='../templates')
+
+_MSG_FORA_DA_GRADE = ('Hora do agendamento fora da grade: os horários começam às {AGENDA_INICIO}, '
+                      'a cada {AGENDA_INTERVALO_MIN} minutos.')
  
 @sisreg_bp.route("/meus-trabalhos")
 @login_required
 def meus_trabalhos():
-    profile = current_user.profile or ""
-    if ("ALTERAR_STATUS" in profile) or ("ADMIN" in profile) or ("REGULACAO" in profile):
+    if pode("ALTERAR_STATUS", "ADMIN", "REGULACAO"):
         return redirect(url_for('sisreg.setor_regulacao_lista'))
-    if ("VER_RELATORIOS" in profile) or ("AMBULATORIO" in profile):
+    if pode("VER_RELATORIOS", "AMBULATORIO"):
         return redirect(url_for('sisreg.setor_ambulatorio_lista'))
-    if "CRIAR_RELATORIOS" in profile:
+    if pode("CRIAR_RELATORIOS"):
         return redirect(url_for('sisreg.formularios'))
     return redirect(url_for('main.panel'))
 
 @sisreg_bp.route("/novo_formulario", methods=["GET", "POST"])
+@anexos.recebe_anexos
 @login_required
+@requer_capacidade("CRIAR_RELATORIOS", "ADMIN", mensagem="Acesso negado! Você não tem permissão para criar novos formulários.")
 def novo_formulario():
-    
-    if "CRIAR_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado! Você não tem permissão para criar novos formulários.", "danger")
-        return redirect(url_for("main.panel"))
-
     if request.method == "POST":
         try:
             cpf_val = request.form.get("cpf") or request.form.get("cartao_sus")
@@ -62,12 +59,19 @@ def novo_formulario():
                 observacao=request.form.get("observacao")
             )
             db.session.add(form)
+            db.session.flush()
+            for arquivo in request.files.getlist("anexos"):
+                if arquivo.filename:
+                    anexos.anexar(form, arquivo, ator=current_user)
             db.session.commit()
             flash("Formulário enviado com sucesso!", "success")
             return redirect(url_for("main.panel"))
         
         except KeyError as e:
             flash(f"Erro no formulário: campo obrigatório '{e.name}' ausente.", "danger")
+        except anexos.AnexoInvalido as e:
+            db.session.rollback()
+            flash(str(e), "warning")
         except Exception as e:
             db.session.rollback()
             flash(f"Ocorreu um erro ao salvar o formulário: {str(e)}", "danger")
@@ -77,77 +81,128 @@ def novo_formulario():
 
 @sisreg_bp.get("/api/pacientes/busca")
 @login_required
+@requer_capacidade("CRIAR_RELATORIOS", "ADMIN", resposta="json")
 def buscar_pacientes():
-    if "CRIAR_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        return jsonify({"error": "forbidden"}), 403
-
     q = (request.args.get("q", "") or "").strip()
     if len(q) < 2:
         return jsonify([])
 
-    db_path = os.path.join(current_app.instance_path, "pacientes.db")
-    if not os.path.exists(db_path):
-        return jsonify({"error": "database_not_found", "detail": db_path}), 500
+    mem = get_pacientes_mem_search()
+    if mem is not None:
+        resultados = mem.search(q)
+        if resultados is not None:
+            return jsonify(resultados)
 
-    q_lower = q.lower()
-    like_nome = f"%{q_lower}%"
-    digits = "".join(ch for ch in q if ch.isdigit())
-    like_digits = f"%{digits}%" if digits else like_nome
+    resultados = get_pacientes_bin_search().search(q)
+    if resultados is not None:
+        return jsonify(resultados)
 
+    pool = get_pacientes_pool()
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        sql = (
-            """
-            SELECT id, nome, cpf, cns, data_nascimento
-            FROM pacientes_paciente
-            WHERE (
-                lower(nome) LIKE ?
-                OR replace(replace(replace(ifnull(cpf,''), '.', ''), '-', ''), ' ', '') LIKE ?
-                OR replace(replace(replace(ifnull(cns,''), '.', ''), '-', ''), ' ', '') LIKE ?
-                OR ifnull(cpf,'') LIKE ?
-                OR ifnull(cns,'') LIKE ?
-            )
-            ORDER BY nome ASC
-            LIMIT 10
-            """
-        )
-        params = (like_nome, like_digits, like_digits, like_digits, like_digits)
-        rows = cur.execute(sql, params).fetchall()
-
-        results = []
-        for r in rows:
-            results.append({
-                "id": r["id"],
-                "nome": r["nome"] or "",
-                "cpf": r["cpf"] or "",
-                "cns": r["cns"] or "",
-                "data_nascimento": r["data_nascimento"] or "",
-            })
-        return jsonify(results)
+        with pool.connection() as conn:
+            if pool.indexed:
+                return jsonify(get_pacientes_cache().search(conn, q, generation=pool.generation))
+            return jsonify(search_pacientes(conn, q, indexed=False))
+    except FileNotFoundError:
+        return jsonify({"error": "database_not_found", "detail": pool.db_path}), 500
     except Exception as e:
         return jsonify({"error": "query_failed", "detail": str(e)}), 500
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
 
-@sisreg_bp.route("/formularios")
+
+@sisreg_bp.get("/api/pacientes/pool")
 @login_required
-def formularios():
-    if "VER_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado! Você não tem permissão para visualizar os formulários.", "danger")
-        return redirect(url_for("main.panel"))
+@requer_capacidade("ADMIN", resposta="json")
+def pacientes_pool_stats():
+    stats = get_pacientes_pool().stats()
+    stats['cache'] = get_pacientes_cache().stats()
+    stats['binario'] = get_pacientes_bin_search().stats()
+    mem = get_pacientes_mem_search()
+    if mem is not None:
+        stats['memoria'] = mem.stats()
+    return jsonify(stats)
+
+
+@sisreg_bp.get("/api/csrf")
+@login_required
+def csrf_token_api():
+    """Token CSRF para clientes JSON (enviar no cabeçalho ``X-CSRFToken`` com o cookie de sessão)."""
+    return jsonify({"csrf_token": generate_csrf()})
 
-    status_filtro = request.args.get('status', '').strip()
-    data_inicio_str = request.args.get('data_inicio', '').strip()
-    data_fim_str = request.args.get('data_fim', '').strip()
-    tipo_data = request.args.get('tipo_data', 'registro').strip()
 
-    query = select(Formulario).order_by(Formulario.data_registro.desc())
+@sisreg_bp.post("/api/jobs")
+@login_required
+@requer_capacidade("ADMIN", resposta="json")
+def enfileirar_job():
+    """Enfileira ``{"tipo": ..., "payload": {...}}``; exige o cabeçalho ``X-CSRFToken`` (ver ``/api/csrf``)."""
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return jsonify({"error": "json_invalido"}), 400
+    tipo = dados.get("tipo")
+    if tipo not in jobs.TAREFAS:
+        return jsonify({"error": "tipo_invalido", "tipos": sorted(jobs.TAREFAS)}), 400
+    payload = dados.get("payload") or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "payload_invalido", "detail": "payload deve ser um objeto JSON"}), 400
+    job = jobs.enfileirar(tipo, payload, ator=current_user)
+    db.session.commit()
+    return jsonify(job.to_dict()), 202, {"Location": url_for("sisreg.status_job", job_id=job.id)}
+
+
+@sisreg_bp.get("/api/jobs/<int:job_id>")
+@login_required
+def status_job(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": "not_found"}), 404
+    if not pode("ADMIN") and job.criado_por_id != current_user.id:
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(job.to_dict())
+
+
+@sisreg_bp.get("/api/jobs")
+@login_required
+@requer_capacidade("ADMIN", resposta="json")
+def listar_jobs():
+    limite = max(1, min(request.args.get("limite", 50, type=int), 200))
+    query = select(Job).order_by(Job.id.desc()).limit(limite)
+    status = (request.args.get("status", "") or "").strip().upper()
+    if status:
+        query = query.where(Job.status == status)
+    return jsonify([job.to_dict() for job in db.session.execute(query).scalars()])
+
+
+@sisreg_bp.get("/api/slots")
+@login_required
+@requer_capacidade("ALTERAR_STATUS", "ADMIN", resposta="json")
+def agenda_slots():
+    medico = (request.args.get("medico", "") or "").strip() or None
+    local = (request.args.get("local", "") or "").strip() or None
+    if not medico and not local:
+        return jsonify({"error": "medico_ou_local_obrigatorio"}), 400
+    try:
+        de = datetime.strptime(request.args.get("de", ""), "%Y-%m-%d").date()
+        ate_str = request.args.get("ate", "")
+        ate = datetime.strptime(ate_str, "%Y-%m-%d").date() if ate_str else de
+    except ValueError:
+        return jsonify({"error": "data_invalida"}), 400
+    max_dias = current_app.config.get("AGENDA_MAX_DIAS", 31)
+    if ate < de or (ate - de).days >= max_dias:
+        return jsonify({"error": "periodo_invalido", "max_dias": max_dias}), 400
+
+    return jsonify({
+        "medico": medico,
+        "local": local,
+        "intervalo_min": current_app.config.get("AGENDA_INTERVALO_MIN", 30),
+        "dias": slots_livres(de, ate, medico, local),
+    })
+
+def _formularios_filtrados(status_filtro, data_inicio_str, data_fim_str, tipo_data, avisar=True):
+    """Consulta e ordenação da lista de formulários (tela e exportação).
+
+    ``avisar=False`` (exportação) ignora datas inválidas sem ``flash``: o
+    download não mostra a mensagem e ela sobraria para a próxima página.
+    """
+    query = select(Formulario)
 
     if status_filtro:
         query = query.where(Formulario.status == status_filtro.upper())
@@ -156,7 +211,6 @@ def formularios():
         if tipo_data == 'agendamento':
             coluna_data = Formulario.data_atendimento
             query = query.where(Formulario.data_atendimento.isnot(None))
-            query = query.order_by(Formulario.data_atendimento.desc())
         else:
             coluna_data = cast(Formulario.data_registro, Date)
 
@@ -165,33 +219,75 @@ def formularios():
                 data_inicio_obj = datetime.strptime(data_inicio_str, '%Y-%m-%d').date()
                 query = query.where(coluna_data >= data_inicio_obj)
             except ValueError:
-                flash(f"Formato de 'Data Início' inválido: '{data_inicio_str}'.", "warning")
+                if avisar:
+                    flash(f"Formato de 'Data Início' inválido: '{data_inicio_str}'.", "warning")
         
         if data_fim_str:
             try:
                 data_fim_obj = datetime.strptime(data_fim_str, '%Y-%m-%d').date()
                 query = query.where(coluna_data <= data_fim_obj)
             except ValueError:
-                flash(f"Formato de 'Data Fim' inválido: '{data_fim_str}'.", "warning")
+                if avisar:
+                    flash(f"Formato de 'Data Fim' inválido: '{data_fim_str}'.", "warning")
 
-    todos_formularios = db.session.execute(query).scalars().all()
+    coluna_ordem = Formulario.data_registro
+    if (data_inicio_str or data_fim_str) and tipo_data == 'agendamento':
+        coluna_ordem = Formulario.data_atendimento
+    return query, [SortKey(coluna_ordem, desc=True), SortKey(Formulario.id, desc=True)]
+
+
+@sisreg_bp.route("/formularios")
+@login_required
+@requer_capacidade("VER_RELATORIOS", "ADMIN", mensagem="Acesso negado! Você não tem permissão para visualizar os formulários.")
+def formularios():
+    status_filtro = request.args.get('status', '').strip()
+    data_inicio_str = request.args.get('data_inicio', '').strip()
+    data_fim_str = request.args.get('data_fim', '').strip()
+    tipo_data = request.args.get('tipo_data', 'registro').strip()
+
+    query, keys = _formularios_filtrados(status_filtro, data_inicio_str, data_fim_str, tipo_data)
+    pagina = keyset_paginate(db.session, query.options(*formulario_options(*LISTA)), keys, 'sisreg.formularios')
 
     return render_template(
         "workflow/requests.html", 
-        formularios=todos_formularios, 
+        formularios=pagina.items,
+        pagina=pagina,
         status_atual=status_filtro,
         data_inicio_atual=data_inicio_str,
         data_fim_atual=data_fim_str,
         tipo_data_atual=tipo_data
     )
 
+@sisreg_bp.route("/formularios/exportar")
+@login_required
+@requer_capacidade("VER_RELATORIOS", "ADMIN", mensagem="Acesso negado! Você não tem permissão para exportar os formulários.")
+def exportar_formularios():
+    formato = request.args.get('formato', 'xlsx').strip().lower()
+    if formato not in ('xlsx', 'csv'):
+        abort(400)
+    query, keys = _formularios_filtrados(
+        request.args.get('status', '').strip(),
+        request.args.get('data_inicio', '').strip(),
+        request.args.get('data_fim', '').strip(),
+        request.args.get('tipo_data', 'registro').strip(),
+        avisar=False,
+    )
+    stmt = exportacao.export_stmt(query.order_by(*(k.expr.desc() if k.desc else k.expr.asc() for k in keys)))
+    nome = f"formularios_{datetime.utcnow():%Y%m%d_%H%M}.{formato}"
+    if formato == 'csv':
+        corpo, mimetype = exportacao.gerar_csv(stmt), 'text/csv'
+    else:
+        corpo, mimetype = exportacao.gerar_xlsx(stmt), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return Response(
+        stream_with_context(corpo),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{nome}"'},
+    )
+
 @sisreg_bp.route("/agenda")
 @login_required
+@requer_capacidade("VER_RELATORIOS", "ADMIN", mensagem="Acesso negado! Você não tem permissão para visualizar a agenda.")
 def agenda():
-    if "VER_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado! Você não tem permissão para visualizar a agenda.", "danger")
-        return redirect(url_for("main.panel"))
-
     hoje = datetime.utcnow().date()
     padrao_inicio = request.args.get('data_inicio', '').strip()
     padrao_fim = request.args.get('data_fim', '').strip()
@@ -219,6 +315,7 @@ def agenda():
 
     query = (
         select(Formulario)
+        .options(*formulario_options(*LISTA))
         .where(Formulario.status == 'AGENDADO')
         .where(Formulario.data_atendimento.isnot(None))
         .where(Formulario.data_atendimento >= data_inicio)
@@ -245,15 +342,7 @@ def agenda():
         chave = f.data_atendimento
         agendados_por_dia.setdefault(chave, []).append(f)
 
-    distinct_medicos = [r[0] for r in db.session.execute(
-        select(Formulario.medico_atendimento).where(Formulario.medico_atendimento.isnot(None)).distinct()
-    ).all() if r[0]]
-    distinct_locais = [r[0] for r in db.session.execute(
-        select(Formulario.local_destino).where(Formulario.local_destino.isnot(None)).distinct()
-    ).all() if r[0]]
-    distinct_especialidades = [r[0] for r in db.session.execute(
-        select(Formulario.especialidade).where(Formulario.especialidade.isnot(None)).distinct()
-    ).all() if r[0]]
+    opcoes = facetas()
 
     return render_template(
         "agenda.html",
@@ -263,9 +352,9 @@ def agenda():
         medico_atual=medico,
         local_atual=local,
         especialidade_atual=especialidade,
-        opcoes_medicos=sorted(distinct_medicos),
-        opcoes_locais=sorted(distinct_locais),
-        opcoes_especialidades=sorted(distinct_especialidades),
+        opcoes_medicos=opcoes['medicos'],
+        opcoes_locais=opcoes['locais'],
+        opcoes_especialidades=opcoes['especialidades'],
         quick_ranges={
             'today': {
                 'start': hoje.isoformat(),
@@ -285,29 +374,143 @@ def agenda():
 @sisreg_bp.route("/formulario/<int:form_id>/detalhes")
 @login_required
 def detalhes_formulario(form_id):
-    formulario = db.session.get(Formulario, form_id)
+    formulario = db.session.get(Formulario, form_id, options=formulario_options(*DETALHE))
     if not formulario:
         flash("Formulário não encontrado.", "danger")
         return redirect(url_for('sisreg.formularios'))
     
-    can_view_all = "ADMIN" in current_user.profile or "VER_RELATORIOS" in current_user.profile
-    is_owner = "CRIAR_RELATORIOS" in current_user.profile and formulario.funcionario_id == current_user.id
-    
-    if not (can_view_all or is_owner):
+    if not _pode_ver_formulario(formulario):
         flash("Acesso negado! Você não tem permissão para visualizar os detalhes deste formulário.", "danger")
         return redirect(url_for("sisreg.formularios"))
     
     return render_template("detalhes_formulario.html", formulario=formulario)
 
 
-@sisreg_bp.route("/formulario/alterar_status/<int:form_id>", methods=["POST"])
+@sisreg_bp.route("/formulario/<int:form_id>/pdf")
 @login_required
-def alterar_status_formulario(form_id):
+def pdf_formulario(form_id):
+    formulario = db.session.get(Formulario, form_id, options=formulario_options(*PDF))
+    if not formulario:
+        abort(404)
+
+    if not _pode_ver_formulario(formulario):
+        abort(403)
+
+    try:
+        caminho, chave, pronto = pdf_render.pdf_formulario(formulario)
+    except Exception as e:
+        current_app.logger.exception("Falha ao gerar PDF do formulário %s", form_id)
+        flash(f"Erro ao gerar o PDF: {str(e)}", "danger")
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+    if not pronto:
+        # A renderização segue no pool; a página tenta de novo a cada 2s até PDF_TIMEOUT
+        espera = request.args.get('espera', 0, type=int)
+        if espera * 2 >= current_app.config.get('PDF_TIMEOUT', 60):
+            flash('O PDF está demorando para ser gerado. Tente novamente em alguns instantes.', 'warning')
+            return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+        return render_template('pdf/gerando.html', form_id=form_id, espera=espera, intervalo=2), 202
+    if formulario in db.session.dirty:
+        db.session.commit()
+    response = send_file(
+        caminho,
+        mimetype='application/pdf',
+        download_name=f"solicitacao_{form_id}.pdf",
+        etag=chave,
+        conditional=True,
+    )
+    response.cache_control.private = True
+    return response
+
+
+def _pode_ver_formulario(formulario):
+    return pode("ADMIN", "VER_RELATORIOS") or (
+        pode("CRIAR_RELATORIOS") and formulario.funcionario_id == current_user.id
+    )
+
+
+def _pode_anexar(formulario):
+    return pode("ADMIN") or (pode("CRIAR_RELATORIOS") and formulario.funcionario_id == current_user.id)
 
-    if "ALTERAR_STATUS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado! Você não tem permissão para alterar o status dos formulários.", "danger")
-        return redirect(url_for("sisreg.detalhes_formulario", form_id=form_id))
 
+@sisreg_bp.route("/formulario/<int:form_id>/anexos", methods=["POST"])
+@anexos.recebe_anexos
+@login_required
+def enviar_anexos(form_id):
+    formulario = db.session.get(Formulario, form_id)
+    if not formulario:
+        flash("Formulário não encontrado.", "danger")
+        return redirect(url_for('sisreg.formularios'))
+    if not _pode_anexar(formulario):
+        flash("Acesso negado! Você não pode anexar arquivos a este formulário.", "danger")
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+
+    arquivos = [a for a in request.files.getlist("anexos") if a.filename]
+    if not arquivos:
+        flash("Selecione ao menos um arquivo.", "warning")
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+    try:
+        for arquivo in arquivos:
+            anexos.anexar(formulario, arquivo, ator=current_user)
+        db.session.commit()
+        flash(f"{len(arquivos)} arquivo(s) anexado(s).", "success")
+    except anexos.AnexoInvalido as e:
+        db.session.rollback()
+        flash(str(e), "warning")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Erro ao anexar arquivos: {str(e)}", "danger")
+    return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+
+
+@sisreg_bp.route("/anexo/<int:anexo_id>")
+@login_required
+def baixar_anexo(anexo_id):
+    anexo = db.session.get(Anexo, anexo_id, options=[joinedload(Anexo.formulario)])
+    if not anexo:
+        abort(404)
+    if not _pode_ver_formulario(anexo.formulario):
+        abort(403)
+    return anexos.resposta_download(anexo)
+
+
+@sisreg_bp.route("/anexo/<int:anexo_id>/preview/<tamanho>")
+@login_required
+def preview_anexo(anexo_id, tamanho):
+    if tamanho not in anexos_preview.TAMANHOS:
+        abort(404)
+    anexo = db.session.get(Anexo, anexo_id, options=[joinedload(Anexo.formulario)])
+    if not anexo or not anexo.preview:
+        abort(404)
+    if not _pode_ver_formulario(anexo.formulario):
+        abort(403)
+    caminho = anexos_preview.caminho_preview(anexo.sha256, tamanho, anexo.preview)
+    if not os.path.exists(caminho):
+        abort(404)
+    return anexos.resposta_preview(anexo, caminho)
+
+
+@sisreg_bp.route("/anexo/<int:anexo_id>/remover", methods=["POST"])
+@login_required
+def remover_anexo(anexo_id):
+    anexo = db.session.get(Anexo, anexo_id, options=[joinedload(Anexo.formulario)])
+    if not anexo:
+        abort(404)
+    form_id = anexo.formulario_id
+    if not _pode_anexar(anexo.formulario):
+        flash("Acesso negado! Você não pode remover anexos deste formulário.", "danger")
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+    # O conteúdo em disco pode ser de outros anexos; órfãos saem com `flask gc-anexos`
+    db.session.delete(anexo)
+    db.session.commit()
+    flash("Anexo removido.", "success")
+    return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+
+
+@sisreg_bp.route("/formulario/alterar_status/<int:form_id>", methods=["POST"])
+@login_required
+@requer_capacidade("ALTERAR_STATUS", "ADMIN", mensagem="Acesso negado! Você não tem permissão para alterar o status dos formulários.",
+                   destino=lambda form_id: url_for("sisreg.detalhes_formulario", form_id=form_id))
+def alterar_status_formulario(form_id):
     formulario_para_alterar = db.session.get(Formulario, form_id)
     if not formulario_para_alterar:
         flash("Formulário não encontrado.", "danger")
@@ -335,16 +538,13 @@ def alterar_status_formulario(form_id):
 
 @sisreg_bp.route('/formulario/<int:form_id>/atualizar', methods=['POST'])
 @login_required
+@requer_capacidade("ADMIN", "ALTERAR_STATUS")
 def atualizar_formulario(form_id):
     form_to_update = db.session.get(Formulario, form_id)
     if not form_to_update:
         flash("Formulário não encontrado.", "danger")
         return redirect(url_for('sisreg.formularios'))
 
-    if "ADMIN" not in current_user.profile and "ALTERAR_STATUS" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('main.panel'))
-
     novo_status = request.form.get("novo_status")
 
     if novo_status == 'AGENDADO':
@@ -363,21 +563,15 @@ def atualizar_formulario(form_id):
             flash('Data do agendamento inválida.', 'warning')
             return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
 
-        conflito_q = (
-            select(func.count(Formulario.id))
-            .where(Formulario.id != form_id)
-            .where(Formulario.status == 'AGENDADO')
-            .where(Formulario.data_atendimento == data_atendimento_obj)
-            .where(Formulario.hora_agendamento == hora_agendamento)
-            .where(
-                or_(
-                    Formulario.medico_atendimento == medico_atendimento,
-                    Formulario.local_destino == local_destino
-                )
-            )
-        )
-        conflitos = db.session.execute(conflito_q).scalar_one() or 0
-        if conflitos > 0:
+        hora_agendamento = normalizar_hora(hora_agendamento)
+        if hora_agendamento is None:
+            flash('Hora do agendamento inválida.', 'warning')
+            return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+        if not hora_na_grade(hora_agendamento):
+            flash(_MSG_FORA_DA_GRADE.format_map(current_app.config), 'warning')
+            return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+
+        if conflito_horario(data_atendimento_obj, hora_agendamento, medico_atendimento, local_destino, ignorar_id=form_id):
             flash('Horário indisponível: já existe agendamento nesse horário para o mesmo médico ou local. Escolha outro horário.', 'warning')
             return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
 
@@ -399,6 +593,9 @@ def atualizar_formulario(form_id):
     try:
         db.session.commit()
         flash("Solicitação atualizada com sucesso!", "success")
+    except IntegrityError:
+        db.session.rollback()
+        flash('Horário indisponível: o horário acabou de ser ocupado por outro agendamento. Escolha outro horário.', 'warning')
     except Exception as e:
         db.session.rollback()
         flash(f"Erro ao atualizar a solicitação: {str(e)}", "danger")
@@ -407,10 +604,8 @@ def atualizar_formulario(form_id):
 
 @sisreg_bp.route('/setor/regulacao/<int:form_id>/autorizar', methods=['POST'])
 @login_required
+@requer_capacidade("ALTERAR_STATUS", "ADMIN", destino="sisreg.setor_regulacao_lista")
 def setor_regulacao_autorizar(form_id):
-    if "ALTERAR_STATUS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('sisreg.setor_regulacao_lista'))
     f = db.session.get(Formulario, form_id)
     if not f:
         flash('Solicitação não encontrada.', 'danger')
@@ -432,16 +627,15 @@ def setor_regulacao_autorizar(form_id):
         flash('Data do agendamento inválida.', 'warning')
         return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
 
-    conflito_q = (
-        select(func.count(Formulario.id))
-        .where(Formulario.id != form_id)
-        .where(Formulario.status == 'AGENDADO')
-        .where(Formulario.data_atendimento == data_atendimento_obj)
-        .where(Formulario.hora_agendamento == hora_agendamento)
-        .where(or_(Formulario.medico_atendimento == medico_atendimento, Formulario.local_destino == local_destino))
-    )
-    conflitos = db.session.execute(conflito_q).scalar_one() or 0
-    if conflitos > 0:
+    hora_agendamento = normalizar_hora(hora_agendamento)
+    if hora_agendamento is None:
+        flash('Hora do agendamento inválida.', 'warning')
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+    if not hora_na_grade(hora_agendamento):
+        flash(_MSG_FORA_DA_GRADE.format_map(current_app.config), 'warning')
+        return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+
+    if conflito_horario(data_atendimento_obj, hora_agendamento, medico_atendimento, local_destino, ignorar_id=form_id):
         flash('Horário indisponível: já existe agendamento nesse horário para o mesmo médico ou local.', 'warning')
         return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
 
@@ -451,21 +645,12 @@ def setor_regulacao_autorizar(form_id):
     f.local_destino = local_destino
     f.medico_atendimento = medico_atendimento
     f.autorizador_id = current_user.id
-    # Registrar evento com timestamp e autor
-    _stamp = _now_brasilia().strftime('%d/%m/%Y %H:%M')
-    _actor = getattr(current_user, 'name', None) or 'Usuário'
     # Se está voltando do ambulatório por falta (compareceu == False), tratamos como REAGENDAR
     is_reschedule = (f.compareceu is False)
     if is_reschedule:
         # limpar presença para o novo agendamento
         f.compareceu = None
-    _header = 'REAGENDAR' if is_reschedule else 'AUTORIZAR'
-    _msg = f"[REGULAÇÃO - {_header}]{f' {obs}' if obs else ''} - {_stamp} | por {_actor}"
-    f.observacao = (f.observacao or '')
-    if f.observacao:
-        f.observacao += f"\n{_msg}"
-    else:
-        f.observacao = f"\n{_msg}"
+    registrar_evento(f, eventos.REGULACAO_REAGENDAR if is_reschedule else eventos.REGULACAO_AUTORIZAR, obs)
 
     try:
         db.session.commit()
@@ -473,6 +658,9 @@ def setor_regulacao_autorizar(form_id):
             flash('Solicitação reagendada e encaminhada ao ambulatório.', 'success')
         else:
             flash('Solicitação autorizada e encaminhada ao ambulatório.', 'success')
+    except IntegrityError:
+        db.session.rollback()
+        flash('Horário indisponível: o horário acabou de ser ocupado por outro agendamento.', 'warning')
     except Exception as e:
         db.session.rollback()
         flash(f'Erro ao autorizar solicitação: {str(e)}', 'danger')
@@ -481,14 +669,11 @@ def setor_regulacao_autorizar(form_id):
 
 @sisreg_bp.route('/setor/regulacao')
 @login_required
+@requer_capacidade("VER_RELATORIOS", "ADMIN", "ALTERAR_STATUS")
 def setor_regulacao_lista():
-    if "VER_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile and "ALTERAR_STATUS" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('main.panel'))
-
     status = request.args.get('status', '').upper().strip()
     q = request.args.get('q', '').strip()
-    query = select(Formulario)
+    query = select(Formulario).options(*formulario_options())
     if status == 'PENDENTES':
         query = query.where(Formulario.status.in_(['EM_ANALISE', 'PENDENTE']))
     elif status:
@@ -501,37 +686,40 @@ def setor_regulacao_lista():
                 Formulario.cpf.ilike(like)
             )
         )
-    status_priority = case(
-        (Formulario.status.in_(['EM_ANALISE', 'PENDENTE']), 0),
-        (Formulario.status == 'AGENDADO', 1),
-        else_=2
-    )
-    query = query.order_by(status_priority.asc(), Formulario.data_registro.desc())
-
-    itens = db.session.execute(query).scalars().all()
-    total = db.session.execute(select(func.count(Formulario.id))).scalar_one() or 0
-    pend_q = select(func.count(Formulario.id)).where(Formulario.status.in_(['EM_ANALISE', 'PENDENTE']))
-    pendentes = db.session.execute(pend_q).scalar_one() or 0
-    ag_q = select(func.count(Formulario.id)).where(Formulario.status == 'AGENDADO')
-    agendados = db.session.execute(ag_q).scalar_one() or 0
-    neg_q = select(func.count(Formulario.id)).where(Formulario.status == 'CANCELADO')
-    negados = db.session.execute(neg_q).scalar_one() or 0
-
+    status_priority = literal_column(f"({PRIORIDADE_REGULACAO_SQL})")
+    pagina = keyset_paginate(db.session, query, [
+        SortKey(status_priority),
+        SortKey(Formulario.data_registro, desc=True),
+        SortKey(Formulario.id, desc=True),
+    ], 'sisreg.setor_regulacao_lista')
+    itens = pagina.items
+
+    por_status = status_counts()
     stats_counts = {
-        'total': total,
-        'pendentes': pendentes,
-        'agendados': agendados,
-        'negados': negados
+        'total': sum(por_status.values()),
+        'pendentes': por_status.get('EM_ANALISE', 0) + por_status.get('PENDENTE', 0),
+        'agendados': por_status.get('AGENDADO', 0),
+        'negados': por_status.get('CANCELADO', 0)
     }
 
-    return render_template('workflow/setor_regulacao_lista.html', itens=itens, status=status, stats_counts=stats_counts)
+    return render_template('workflow/setor_regulacao_lista.html', itens=itens, pagina=pagina, status=status, stats_counts=stats_counts)
+
+@sisreg_bp.route('/setor/regulacao/<int:form_id>/painel')
+@login_required
+@requer_capacidade("VER_RELATORIOS", "ADMIN", "ALTERAR_STATUS", resposta="abort")
+def setor_regulacao_painel(form_id):
+    """Fragmento HTML do painel de ações/eventos, carregado ao expandir a linha."""
+    f = db.session.execute(
+        select(Formulario).options(*formulario_options(*DETALHE)).where(Formulario.id == form_id)
+    ).scalar_one_or_none()
+    if not f:
+        abort(404)
+    return render_template('workflow/_regulacao_painel.html', f=f)
 
 @sisreg_bp.route('/setor/regulacao/<int:form_id>/negar', methods=['POST'])
 @login_required
+@requer_capacidade("ALTERAR_STATUS", "ADMIN", destino="sisreg.setor_regulacao_lista")
 def setor_regulacao_negar(form_id):
-    if "ALTERAR_STATUS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('sisreg.setor_regulacao_lista'))
     f = db.session.get(Formulario, form_id)
     if not f:
         flash('Solicitação não encontrada.', 'danger')
@@ -543,16 +731,9 @@ def setor_regulacao_negar(form_id):
         return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
     f.status = 'CANCELADO'
     f.justificativa_negativa = justificativa
-    # Registrar evento com timestamp e autor (inclui justificativa e obs extra quando houver)
-    _stamp = _now_brasilia().strftime('%d/%m/%Y %H:%M')
-    _actor = getattr(current_user, 'nome', None) or 'Usuário'
+    # Registrar evento (inclui justificativa e obs extra quando houver)
     _extra = f" | Obs: {observacao_extra}" if observacao_extra else ''
-    _msg = f"[REGULAÇÃO - NEGAR] {justificativa}{_extra} - {_stamp} | por {_actor}"
-    f.observacao = (f.observacao or '')
-    if f.observacao:
-        f.observacao += f"\n{_msg}"
-    else:
-        f.observacao = _msg
+    registrar_evento(f, eventos.REGULACAO_NEGAR, f"{justificativa}{_extra}")
     try:
         db.session.commit()
         flash('Solicitação negada e registrada com justificativa.', 'success')
@@ -563,10 +744,8 @@ def setor_regulacao_negar(form_id):
 
 @sisreg_bp.route('/setor/regulacao/<int:form_id>/solicitar-revisao', methods=['POST'])
 @login_required
+@requer_capacidade("ALTERAR_STATUS", "ADMIN", destino="sisreg.setor_regulacao_lista")
 def setor_regulacao_solicitar_revisao(form_id):
-    if "ALTERAR_STATUS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('sisreg.setor_regulacao_lista'))
     f = db.session.get(Formulario, form_id)
     if not f:
         flash('Solicitação não encontrada.', 'danger')
@@ -577,14 +756,7 @@ def setor_regulacao_solicitar_revisao(form_id):
         return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
     # Enviar de volta para UBS para correção: voltar ao estado de pendência e limpar qualquer agendamento
     f.status = 'PENDENTE'
-    f.observacao = (f.observacao or '')
-    _stamp = _now_brasilia().strftime('%d/%m/%Y %H:%M')
-    _actor = getattr(current_user, 'name', None) or 'Usuário'
-    _entry = f"[REGULAÇÃO - SOLICITAR REVISÃO] {motivo} - {_stamp} | por {_actor}"
-    if f.observacao:
-        f.observacao += f"\n{_entry}"
-    else:
-        f.observacao = _entry
+    registrar_evento(f, eventos.REGULACAO_SOLICITAR_REVISAO, motivo)
     f.data_atendimento = None
     f.hora_agendamento = None
     f.local_destino = None
@@ -608,27 +780,23 @@ def setor_ambulatorio_lista():
         like = f"%{q}%"
         base = base.where(or_(Formulario.nome_paciente.ilike(like), Formulario.cpf.ilike(like)))
 
-    itens = db.session.execute(
-        base.order_by(Formulario.data_atendimento.asc(), Formulario.hora_agendamento.asc())
-    ).scalars().all()
+    pagina = keyset_paginate(db.session, base.options(*formulario_options()), [
+        SortKey(Formulario.data_atendimento),
+        SortKey(Formulario.hora_agendamento),
+        SortKey(Formulario.id),
+    ], 'sisreg.setor_ambulatorio_lista')
+    itens = pagina.items
 
     # Estatísticas (apenas sobre AGENDADO + filtro q)
-    total = db.session.execute(select(func.count()).select_from(base.subquery())).scalar_one() or 0
-    presentes = db.session.execute(
-        select(func.count()).select_from(base.where(Formulario.compareceu.is_(True)).subquery())
-    ).scalar_one() or 0
-    faltas = db.session.execute(
-        select(func.count()).select_from(base.where(Formulario.compareceu.is_(False)).subquery())
-    ).scalar_one() or 0
-    sem_registro = total - presentes - faltas
+    por_presenca = contar_por(base, Formulario.compareceu)
     stats_counts = {
-        'total': total,
-        'presentes': presentes,
-        'faltas': faltas,
-        'sem_registro': sem_registro,
+        'total': sum(por_presenca.values()),
+        'presentes': por_presenca.get(True, 0),
+        'faltas': por_presenca.get(False, 0),
+        'sem_registro': por_presenca.get(None, 0),
     }
 
-    return render_template('workflow/setor_ambulatorio_lista.html', itens=itens, stats_counts=stats_counts, q=q)
+    return render_template('workflow/setor_ambulatorio_lista.html', itens=itens, pagina=pagina, stats_counts=stats_counts, q=q)
 
 @sisreg_bp.route('/setor/ambulatorio/<int:form_id>/atualizar', methods=['POST'])
 @login_required
@@ -665,18 +833,9 @@ def setor_ambulatorio_atualizar(form_id):
     if resultado:
         f.resultado_procedimento = resultado
 
-    # Registrar evento nos comentários (observação)
+    # Registrar evento na linha do tempo
     if compareceu_choice is not None:
-        _stamp = _now_brasilia().strftime('%d/%m/%Y %H:%M')
-        _actor = getattr(current_user, 'name', None) or 'Usuário'
-        header = 'PRESENÇA' if f.compareceu else 'FALTA'
-        body = resultado if resultado else ''
-        entry = f"[AMBULATÓRIO - {header}] {body} - {_stamp} | por {_actor}"
-        f.observacao = (f.observacao or '')
-        if f.observacao:
-            f.observacao += f"\n{entry}"
-        else:
-            f.observacao = entry
+        registrar_evento(f, eventos.AMBULATORIO_PRESENCA if f.compareceu else eventos.AMBULATORIO_FALTA, resultado)
     try:
         db.session.commit()
         if compareceu_choice == '0':
@@ -690,12 +849,9 @@ def setor_ambulatorio_atualizar(form_id):
 
 @sisreg_bp.route("/formulario/deletar/<int:form_id>", methods=["POST"])
 @login_required
+@requer_capacidade("ADMIN", mensagem="Acesso negado! Você não tem permissão para deletar formulários.",
+                   destino=lambda form_id: url_for("sisreg.detalhes_formulario", form_id=form_id))
 def deletar_formulario(form_id):
-
-    if "ADMIN" not in current_user.profile:
-        flash("Acesso negado! Você não tem permissão para deletar formulários.", "danger")
-        return redirect(url_for("sisreg.detalhes_formulario", form_id=form_id)) 
-
     formulario_para_deletar = db.session.get(Formulario, form_id)
 
     if not formulario_para_deletar:
@@ -715,11 +871,8 @@ def deletar_formulario(form_id):
 
 @sisreg_bp.route('/setor/ubs')
 @login_required
+@requer_capacidade("CRIAR_RELATORIOS", "ADMIN")
 def sector_ubs_lista():
-    if "CRIAR_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('main.panel'))
-
     # Filtros
     filter_status = (request.args.get('filter_status', '') or '').strip().lower()
     q = (request.args.get('q', '') or '').strip()
@@ -751,53 +904,28 @@ def sector_ubs_lista():
     else:
         query = base_query
 
-    status_priority = case(
-        (Formulario.status == 'PENDENTE', 0),
-        (Formulario.status == 'EM_ANALISE', 1),
-        (Formulario.status == 'AGENDADO', 2),
-        (Formulario.status == 'CONCLUIDO', 3),
-        else_=4
-    )
-    query = query.order_by(status_priority.asc(), Formulario.data_registro.desc())
-
-    itens = db.session.execute(query).scalars().all()
+    status_priority = literal_column(f"({PRIORIDADE_UBS_SQL})")
+    pagina = keyset_paginate(db.session, query.options(*formulario_options()), [
+        SortKey(status_priority),
+        SortKey(Formulario.data_registro, desc=True),
+        SortKey(Formulario.id, desc=True),
+    ], 'sisreg.sector_ubs_lista')
+    itens = pagina.items
 
     # Contadores (respeitando filtros base: q e meus)
-    total = db.session.execute(
-        select(func.count()).select_from(base_query.subquery())
-    ).scalar_one() or 0
-    pendentes = db.session.execute(
-        select(func.count()).select_from(
-            base_query.where(Formulario.status == 'PENDENTE').subquery()
-        )
-    ).scalar_one() or 0
-    em_andamento = db.session.execute(
-        select(func.count()).select_from(
-            base_query.where(Formulario.status == 'EM_ANALISE').subquery()
-        )
-    ).scalar_one() or 0
-    concluidos = db.session.execute(
-        select(func.count()).select_from(
-            base_query.where(Formulario.status == 'CONCLUIDO').subquery()
-        )
-    ).scalar_one() or 0
-    cancelados = db.session.execute(
-        select(func.count()).select_from(
-            base_query.where(Formulario.status == 'CANCELADO').subquery()
-        )
-    ).scalar_one() or 0
-
+    por_status = status_counts(base_query if (q or meus) else None)
     stats_counts = {
-        'total': total,
-        'pendentes': pendentes,
-        'em_andamento': em_andamento,
-        'concluidos': concluidos,
-        'cancelados': cancelados,
+        'total': sum(por_status.values()),
+        'pendentes': por_status.get('PENDENTE', 0),
+        'em_andamento': por_status.get('EM_ANALISE', 0),
+        'concluidos': por_status.get('CONCLUIDO', 0),
+        'cancelados': por_status.get('CANCELADO', 0),
     }
 
     return render_template(
         'workflow/sector_ubs_lista.html',
         itens=itens,
+        pagina=pagina,
         stats_counts=stats_counts,
         filter_status=filter_status,
         q=q,
@@ -805,35 +933,35 @@ def sector_ubs_lista():
     )
 
 @sisreg_bp.route('/setor/ubs/<int:form_id>/editar', methods=['GET', 'POST'])
+@anexos.recebe_anexos
 @login_required
+@requer_capacidade("CRIAR_RELATORIOS", "ADMIN")
 def sector_ubs_editar(form_id):
     # UBS edita todos os dados originais e reenvia para Regulação
-    if "CRIAR_RELATORIOS" not in current_user.profile and "ADMIN" not in current_user.profile:
-        flash("Acesso negado!", "danger")
-        return redirect(url_for('main.panel'))
-
-    f = db.session.get(Formulario, form_id)
+    f = db.session.get(Formulario, form_id, options=formulario_options(selectinload(Formulario.anexos)))
     if not f:
         flash('Solicitação não encontrada.', 'danger')
         return redirect(url_for('sisreg.sector_ubs_lista'))
 
     # Somente o criador pode editar (a não ser admin)
-    if ("ADMIN" not in current_user.profile) and (f.funcionario_id != current_user.id):
+    if not pode("ADMIN") and f.funcionario_id != current_user.id:
         flash('Você não tem permissão para editar esta solicitação.', 'danger')
         return redirect(url_for('sisreg.sector_ubs_lista'))
 
     # Encontrar último motivo de revisão
-    motivo_revisao = None
-    if f.observacao:
-        try:
-            for line in reversed((f.observacao or '').split('\n')):
-                if '[REGULAÇÃO - SOLICITAR REVISÃO]' in line:
-                    motivo_revisao = line.replace('[REGULAÇÃO - SOLICITAR REVISÃO] ', '')
-                    break
-        except Exception:
-            pass
+    motivo_revisao = db.session.execute(
+        select(FormularioEvento.mensagem)
+        .where(FormularioEvento.formulario_id == f.id, FormularioEvento.tipo == eventos.REGULACAO_SOLICITAR_REVISAO)
+        .order_by(FormularioEvento.criado_em.desc(), FormularioEvento.id.desc())
+        .limit(1)
+    ).scalar_one_or_none()
 
     if request.method == 'POST':
+        # Valida antes de alterar o formulário ou gravar anexos
+        resposta = (request.form.get('observacao_resposta') or '').strip()
+        if not resposta:
+            flash('Informe a resposta/correção.', 'warning')
+            return redirect(url_for('sisreg.sector_ubs_editar', form_id=form_id))
         try:
             f.nome_paciente = (request.form.get('nome_paciente') or f.nome_paciente).strip()
             nasc_str = (request.form.get('nascimento') or '').strip()
@@ -843,27 +971,20 @@ def sector_ubs_editar(form_id):
             f.unidade_saude = (request.form.get('unidade_saude') or f.unidade_saude).strip()
             f.medico_solicitante = (request.form.get('medico_solicitante') or f.medico_solicitante).strip()
             f.especialidade = (request.form.get('especialidade') or f.especialidade).strip()
-            f.anexo = (request.form.get('anexo') or '').strip() or None
-
-            resposta = (request.form.get('observacao_resposta') or '').strip()
-            if not resposta:
-                flash('Informe a resposta/correção.', 'warning')
-                return redirect(url_for('sisreg.sector_ubs_editar', form_id=form_id))
+            for arquivo in request.files.getlist('anexos'):
+                if arquivo.filename:
+                    anexos.anexar(f, arquivo, ator=current_user)
 
             # Devolver à regulação
             f.status = 'EM_ANALISE'
-            f.observacao = (f.observacao or '')
-            _stamp = _now_brasilia().strftime('%d/%m/%Y %H:%M')
-            _actor = getattr(current_user, 'name', None) or 'Usuário'
-            _entry = f"[UBS - RESPOSTA REVISÃO] {resposta} - {_stamp} | por {_actor}"
-            if f.observacao:
-                f.observacao += f"\n{_entry}"
-            else:
-                f.observacao = _entry
+            registrar_evento(f, eventos.UBS_RESPOSTA_REVISAO, resposta)
 
             db.session.commit()
             flash('Solicitação atualizada e enviada para Regulação.', 'success')
             return redirect(url_for('sisreg.detalhes_formulario', form_id=form_id))
+        except anexos.AnexoInvalido as e:
+            db.session.rollback()
+            flash(str(e), 'warning')
         except ValueError:
             db.session.rollback()
             flash('Data de nascimento inválida.', 'warning')
@@ -0,0 +1,157 @@
+"""Horários livres para agendamento (médico / local).
+
+A grade do dia vem da configuração (``AGENDA_INICIO``, ``AGENDA_FIM``,
+``AGENDA_INTERVALO_MIN``, ``AGENDA_DIAS_SEMANA``). Os agendamentos existentes
+no período são lidos com uma única consulta por faixa de data (índice
+``status, data_atendimento, hora_agendamento``) e marcados em uma grade de
+ocupação em memória; um horário está livre se nem o médico nem o local têm
+agendamento naquele intervalo. A verificação de conflito ao agendar usa a
+mesma grade, e só se agenda no início de um intervalo (``hora_na_grade``).
+"""
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import or_, select
+
+from app.models import db, Formulario
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:
+    ZoneInfo = None
+
+
+def _agora() -> datetime:
+    if ZoneInfo is not None:
+        try:
+            return datetime.now(ZoneInfo("America/Sao_Paulo")).replace(tzinfo=None)
+        except Exception:
+            pass
+    return datetime.utcnow() - timedelta(hours=3)
+
+
+def _minutos(hora) -> int:
+    h, m = str(hora).strip()[:5].split(':')
+    return int(h) * 60 + int(m)
+
+
+def _hhmm(minutos) -> str:
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def normalizar_hora(hora):
+    """``'7:5'``/``'07:05:00'`` -> ``'07:05'``; ``None`` se inválida."""
+    try:
+        minutos = _minutos(hora)
+    except (ValueError, AttributeError):
+        return None
+    return _hhmm(minutos) if 0 <= minutos < 24 * 60 else None
+
+
+@dataclass
+class GradeAgenda:
+    inicio: int = 7 * 60
+    fim: int = 17 * 60
+    intervalo: int = 30
+    dias_semana: frozenset = frozenset(range(5))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            inicio=_minutos(config.get('AGENDA_INICIO', '07:00')),
+            fim=_minutos(config.get('AGENDA_FIM', '17:00')),
+            intervalo=int(config.get('AGENDA_INTERVALO_MIN', 30)),
+            dias_semana=frozenset(int(d) for d in str(config.get('AGENDA_DIAS_SEMANA', '0,1,2,3,4')).split(',') if d.strip()),
+        )
+
+    def horarios(self) -> list[str]:
+        return [_hhmm(m) for m in range(self.inicio, self.fim, self.intervalo)]
+
+    def slot(self, hora) -> str:
+        """Início do intervalo da grade que contém ``hora`` (ou a própria hora, fora da grade)."""
+        minutos = _minutos(hora)
+        if self.inicio <= minutos < self.fim:
+            minutos -= (minutos - self.inicio) % self.intervalo
+        return _hhmm(minutos)
+
+
+@dataclass
+class Ocupacao:
+    grade: GradeAgenda
+    medico: set = field(default_factory=set)
+    local: set = field(default_factory=set)
+
+    def ocupado(self, dia, hora) -> bool:
+        chave = (dia, self.grade.slot(hora))
+        return chave in self.medico or chave in self.local
+
+    def livres(self, dia, depois_de=None) -> list[str]:
+        return [
+            h for h in self.grade.horarios()
+            if (depois_de is None or h > depois_de) and not self.ocupado(dia, h)
+        ]
+
+
+def carregar_ocupacao(de, ate, medico=None, local=None, ignorar_id=None, grade=None) -> Ocupacao:
+    """Marca na grade os agendamentos do ``medico`` e do ``local`` entre ``de`` e ``ate``."""
+    grade = grade or GradeAgenda.from_config(current_app.config)
+    ocupacao = Ocupacao(grade)
+    filtros = []
+    if medico:
+        filtros.append(Formulario.medico_atendimento == medico)
+    if local:
+        filtros.append(Formulario.local_destino == local)
+    if not filtros:
+        return ocupacao
+
+    query = (
+        select(Formulario.data_atendimento, Formulario.hora_agendamento,
+               Formulario.medico_atendimento, Formulario.local_destino)
+        .where(Formulario.status == 'AGENDADO')
+        .where(Formulario.data_atendimento >= de, Formulario.data_atendimento <= ate)
+        .where(or_(*filtros))
+    )
+    if ignorar_id is not None:
+        query = query.where(Formulario.id != ignorar_id)
+    for dia, hora, med, loc in db.session.execute(query).all():
+        if normalizar_hora(hora) is None:
+            continue
+        chave = (dia, grade.slot(hora))
+        if medico and med == medico:
+            ocupacao.medico.add(chave)
+        if local and loc == local:
+            ocupacao.local.add(chave)
+    return ocupacao
+
+
+def slots_livres(de, ate, medico=None, local=None) -> list[dict]:
+    """``[{'data': 'aaaa-mm-dd', 'livres': ['07:00', ...]}]`` para os dias úteis do período."""
+    grade = GradeAgenda.from_config(current_app.config)
+    agora = _agora()
+    de = max(de, agora.date())
+    ocupacao = carregar_ocupacao(de, ate, medico, local, grade=grade)
+    dias = []
+    dia = de
+    while dia <= ate:
+        if dia.weekday() in grade.dias_semana:
+            depois_de = agora.strftime('%H:%M') if dia == agora.date() else None
+            dias.append({'data': dia.isoformat(), 'livres': ocupacao.livres(dia, depois_de)})
+        dia += timedelta(days=1)
+    return dias
+
+
+def hora_na_grade(hora, grade=None) -> bool:
+    """Se ``hora`` (já normalizada) é o início de um intervalo da grade.
+
+    Os índices únicos de agendamento são sobre a hora gravada; aceitando só
+    inícios de intervalo, dois agendamentos no mesmo intervalo gravam a mesma
+    hora e o segundo concorrente falha no banco. Horas fora da janela
+    ``AGENDA_INICIO``-``AGENDA_FIM`` são aceitas como vieram.
+    """
+    return (grade or GradeAgenda.from_config(current_app.config)).slot(hora) == hora
+
+
+def conflito_horario(dia: date, hora, medico, local, ignorar_id=None) -> bool:
+    """Se já existe agendamento do médico ou do local no intervalo de ``hora``."""
+    return carregar_ocupacao(dia, dia, medico, local, ignorar_id).ocupado(dia, hora)
@@ -0,0 +1,231 @@
+"""Anexos dos formulários, guardados por conteúdo (SHA-256).
+
+Upload: nas views marcadas com ``@recebe_anexos``, ``AnexoRequest`` faz o
+Werkzeug gravar cada arquivo do multipart direto num temporário dentro do
+diretório de anexos, calculando o SHA-256 a cada bloco recebido; o arquivo
+nunca fica inteiro em memória. Os demais uploads da aplicação seguem o
+tratamento padrão do Werkzeug. Ao anexar, o
+temporário vira ``<ANEXOS_DIR>/ab/cd/<sha256>`` (um ``os.replace`` no mesmo
+disco) ou é descartado se o mesmo conteúdo já existe. Cada ``Anexo`` guarda
+nome, tipo e tamanho; arquivos iguais ocupam o disco uma vez só.
+
+Download: ``send_file`` condicional (ETag = hash, ``Range``/206) ou, com
+``USE_X_SENDFILE``/``ANEXOS_ACCEL_REDIRECT``, só o cabeçalho para o
+Apache/nginx enviar o arquivo. ``coletar_orfaos`` apaga conteúdos que não
+pertencem mais a nenhum anexo (``flask gc-anexos``).
+"""
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+from urllib.parse import quote
+
+from flask import Request, current_app, send_file
+from sqlalchemy import select
+
+from app.models import db, Anexo
+
+_CHUNK = 1024 * 1024
+_SUFIXO_TMP = '.part'
+# Tipos abertos no navegador; o resto é sempre baixado (SVG/HTML podem ter script)
+_INLINE = {'application/pdf', 'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+
+
+class AnexoInvalido(ValueError):
+    pass
+
+
+class ArquivoComHash:
+    """Temporário em disco que calcula o SHA-256 do que é escrito nele."""
+
+    def __init__(self, diretorio):
+        os.makedirs(diretorio, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=diretorio, suffix=_SUFIXO_TMP)
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.tamanho = 0
+        self._finalizado = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.tamanho += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def finalizar(self, destino):
+        """Fecha o temporário e move para ``destino`` (ou descarta, se já existe)."""
+        self._file.close()
+        self._finalizado = True
+        if os.path.exists(destino):
+            os.unlink(self.name)
+            # Renova o mtime: gc-anexos não apaga conteúdo que acabou de ser reaproveitado
+            os.utime(destino)
+            return False
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        try:
+            os.replace(self.name, destino)
+        except OSError:
+            # Upload simultâneo do mesmo conteúdo já criou o arquivo
+            if not os.path.exists(destino):
+                raise
+            os.unlink(self.name)
+            return False
+        return True
+
+    def close(self):
+        if self._finalizado:
+            return
+        self._finalizado = True
+        self._file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, nome):
+        return getattr(self._file, nome)
+
+
+def recebe_anexos(view):
+    """Marca a view cujos uploads vão direto para o diretório de anexos (logo abaixo de ``@route``)."""
+    view.recebe_anexos = True
+    return view
+
+
+class AnexoRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        view = current_app.view_functions.get(self.endpoint)
+        if getattr(view, 'recebe_anexos', False):
+            return ArquivoComHash(diretorio_tmp())
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+def diretorio() -> str:
+    return current_app.config['ANEXOS_DIR']
+
+
+def diretorio_tmp() -> str:
+    return os.path.join(diretorio(), 'tmp')
+
+
+def caminho_relativo(sha256) -> str:
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def caminho_blob(sha256) -> str:
+    return os.path.join(diretorio(), sha256[:2], sha256[2:4], sha256)
+
+
+def extensoes_permitidas() -> set:
+    return {e.strip().lower() for e in current_app.config.get('ANEXOS_EXTENSOES', 'pdf').split(',') if e.strip()}
+
+
+def mimetype_por_nome(nome) -> str:
+    """Tipo pela extensão; o ``Content-Type`` enviado pelo navegador não é confiável."""
+    return mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+
+
+def anexar(formulario, arquivo, ator=None) -> Anexo:
+    """Grava o ``FileStorage`` e acrescenta o ``Anexo`` à sessão (commit fica com quem chama)."""
+    nome = os.path.basename((arquivo.filename or '').replace('\\', '/')).strip()
+    extensao = nome.rsplit('.', 1)[-1].lower() if '.' in nome else ''
+    if not nome or extensao not in extensoes_permitidas():
+        raise AnexoInvalido(
+            f"Arquivo '{nome or '?'}' não permitido. Tipos aceitos: {', '.join(sorted(extensoes_permitidas()))}."
+        )
+
+    stream = arquivo.stream
+    if not isinstance(stream, ArquivoComHash):
+        # Requisição sem AnexoRequest: copia em blocos calculando o hash
+        copia = ArquivoComHash(diretorio_tmp())
+        shutil.copyfileobj(stream, copia, _CHUNK)
+        stream = copia
+    if stream.tamanho == 0:
+        stream.close()
+        raise AnexoInvalido(f"Arquivo '{nome}' está vazio.")
+    stream.flush()
+    sha256 = stream.hexdigest()
+    tamanho = stream.tamanho
+    stream.finalizar(caminho_blob(sha256))
+
+    anexo = Anexo(
+        formulario_id=formulario.id,
+        sha256=sha256,
+        nome=nome[:255],
+        mimetype=mimetype_por_nome(nome),
+        tamanho=tamanho,
+        enviado_por_id=getattr(ator, 'id', None),
+    )
+    db.session.add(anexo)
+    return anexo
+
+
+def _cabecalhos_seguros(response):
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def resposta_download(anexo):
+    # Recalcula pelo nome: anexos antigos gravaram o tipo informado pelo cliente
+    mimetype = mimetype_por_nome(anexo.nome)
+    inline = mimetype in _INLINE
+    prefixo = current_app.config.get('ANEXOS_ACCEL_REDIRECT')
+    if prefixo:
+        # nginx: location interna apontando para ANEXOS_DIR
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{prefixo.rstrip('/')}/{caminho_relativo(anexo.sha256)}"
+        disposicao = 'inline' if inline else 'attachment'
+        response.headers['Content-Disposition'] = f"{disposicao}; filename*=UTF-8''{quote(anexo.nome)}"
+        response.set_etag(anexo.sha256)
+    else:
+        # USE_X_SENDFILE é aplicado pelo próprio send_file
+        response = send_file(
+            caminho_blob(anexo.sha256),
+            mimetype=mimetype,
+            as_attachment=not inline,
+            download_name=anexo.nome,
+            conditional=True,
+            etag=anexo.sha256,
+            max_age=current_app.config.get('ANEXOS_MAX_AGE', 3600),
+        )
+    return _cabecalhos_seguros(response)
+
+
+def resposta_preview(anexo, caminho):
+    response = send_file(caminho, conditional=True, etag=f"{anexo.sha256}-{os.path.basename(caminho)}",
+                         max_age=current_app.config.get('ANEXOS_MAX_AGE', 3600))
+    return _cabecalhos_seguros(response)
+
+
+def coletar_orfaos(idade_minima=3600) -> dict:
+    """Apaga conteúdos sem ``Anexo`` e temporários abandonados mais velhos que ``idade_minima`` segundos."""
+    usados = set(db.session.execute(select(Anexo.sha256).distinct()).scalars())
+    limite = time.time() - idade_minima
+    stats = {'arquivos': 0, 'removidos': 0, 'bytes': 0}
+    for raiz, _, arquivos in os.walk(diretorio()):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            stats['arquivos'] += 1
+            orfao = nome.endswith(_SUFIXO_TMP) or (len(nome) == 64 and nome not in usados)
+            try:
+                if orfao and os.path.getmtime(caminho) < limite:
+                    stats['bytes'] += os.path.getsize(caminho)
+                    os.unlink(caminho)
+                    stats['removidos'] += 1
+            except FileNotFoundError:
+                pass
+    return stats
+
+
+def init_anexos(app):
+    app.request_class = AnexoRequest
+
+    @app.context_processor
+    def _anexos_accept():
+        return {'anexos_accept': ','.join(f'.{e}' for e in sorted(extensoes_permitidas()))}
@@ -0,0 +1,145 @@
+"""Prévias (miniatura e imagem reduzida) dos anexos.
+
+Todo ``Anexo`` novo enfileira, na mesma transação, a tarefa ``anexos.preview``
+(fila de ``flask worker``), a menos que o mesmo conteúdo já tenha prévia ou
+uma tarefa pendente.
+A tarefa gera, a partir do original:
+
+- ``thumb``: até ``PREVIEW_THUMB_PX`` pixels (lista de anexos);
+- ``media``: até ``PREVIEW_MEDIA_PX`` pixels (visualização no navegador).
+
+Imagens são abertas com Pillow (respeitando a orientação EXIF); de PDFs usa-se
+a primeira página, rasterizada pelo ``pdftoppm`` (poppler, fora do pip: tem
+de estar no ``PATH``; sem ele PDFs ficam sem prévia e ``init_previews`` avisa
+no log). As prévias ficam em ``<ANEXOS_DIR>/previews`` com o nome derivado
+do SHA-256 do original, então anexos iguais compartilham as mesmas prévias.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from flask import current_app
+from sqlalchemy import event, select, update
+
+from app.models import db, Anexo, Job
+from app.utils.anexos import caminho_blob, diretorio
+from app.utils.jobs import EXECUTANDO, PENDENTE, enfileirar, tarefa
+
+logger = logging.getLogger(__name__)
+
+TAMANHOS = ('thumb', 'media')
+_IMAGENS = ('image/jpeg', 'image/png', 'image/webp', 'image/gif', 'image/bmp', 'image/tiff')
+
+
+def formato_preview() -> str:
+    formato = current_app.config.get('PREVIEW_FORMATO', 'webp')
+    if formato == 'webp':
+        from PIL import features
+
+        if not features.check('webp'):
+            formato = 'jpg'
+    return formato
+
+
+def caminho_preview(sha256, tamanho, extensao) -> str:
+    return os.path.join(diretorio(), 'previews', sha256[:2], f"{sha256}_{tamanho}.{extensao}")
+
+
+def _abrir_primeira_pagina(origem, mimetype, tmpdir):
+    from PIL import Image
+
+    if mimetype in _IMAGENS:
+        return Image.open(origem)
+    if mimetype == 'application/pdf':
+        pdftoppm = shutil.which('pdftoppm')
+        if not pdftoppm:
+            return None
+        saida = os.path.join(tmpdir, 'pagina')
+        subprocess.run(
+            [pdftoppm, '-f', '1', '-l', '1', '-r', '110', '-png', '-singlefile', origem, saida],
+            check=True, timeout=120, capture_output=True,
+        )
+        return Image.open(f"{saida}.png")
+    return None
+
+
+def gerar_previews(sha256, mimetype) -> str:
+    """Gera as prévias de ``sha256``; devolve a extensão usada ou ``''`` se não houver prévia possível."""
+    from PIL import Image, ImageOps
+
+    extensao = formato_preview()
+    limites = {
+        'thumb': current_app.config.get('PREVIEW_THUMB_PX', 320),
+        'media': current_app.config.get('PREVIEW_MEDIA_PX', 1600),
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        imagem = _abrir_primeira_pagina(caminho_blob(sha256), mimetype, tmpdir)
+        if imagem is None:
+            return ''
+        with imagem:
+            # JPEG grande: decodifica já reduzido
+            imagem.draft('RGB', (limites['media'], limites['media']))
+            imagem = ImageOps.exif_transpose(imagem)
+            if imagem.mode in ('RGBA', 'LA', 'P'):
+                imagem = imagem.convert('RGBA')
+                fundo = Image.new('RGB', imagem.size, 'white')
+                fundo.paste(imagem, mask=imagem.split()[-1])
+                imagem = fundo
+            elif imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+            for tamanho in ('media', 'thumb'):
+                imagem.thumbnail((limites[tamanho], limites[tamanho]), Image.LANCZOS)
+                destino = caminho_preview(sha256, tamanho, extensao)
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                tmp = f"{destino}.{os.getpid()}.part"
+                if extensao == 'webp':
+                    imagem.save(tmp, 'WEBP', quality=80, method=4)
+                else:
+                    imagem.save(tmp, 'JPEG', quality=80, optimize=True, progressive=True)
+                os.replace(tmp, destino)
+    return extensao
+
+
+@tarefa('anexos.preview', concorrencia=4)
+def _tarefa_preview(sha256, mimetype):
+    extensao = gerar_previews(sha256, mimetype)
+    db.session.execute(update(Anexo).where(Anexo.sha256 == sha256).values(preview=extensao))
+    db.session.commit()
+    return {'sha256': sha256, 'preview': extensao or None}
+
+
+def _pendentes() -> set:
+    """SHA-256 com tarefa ``anexos.preview`` ainda na fila ou em execução."""
+    payloads = db.session.execute(
+        select(Job.payload).where(Job.status.in_((PENDENTE, EXECUTANDO)), Job.tipo == 'anexos.preview')
+    ).scalars()
+    return {json.loads(payload or '{}').get('sha256') for payload in payloads}
+
+
+def _before_flush(session, flush_context, instances):
+    novos = [obj for obj in session.new if isinstance(obj, Anexo) and obj.preview is None]
+    if not novos:
+        return
+    with session.no_autoflush:
+        prontos = dict(session.execute(
+            select(Anexo.sha256, Anexo.preview)
+            .where(Anexo.sha256.in_({a.sha256 for a in novos}), Anexo.preview.isnot(None))
+        ).all())
+        enfileirados = _pendentes()
+        for anexo in novos:
+            if anexo.sha256 in prontos:
+                anexo.preview = prontos[anexo.sha256]
+            elif anexo.sha256 not in enfileirados:
+                enfileirar('anexos.preview', {'sha256': anexo.sha256, 'mimetype': anexo.mimetype})
+                enfileirados.add(anexo.sha256)
+
+
+def init_previews(app):
+    app.config.setdefault('PREVIEW_FORMATO', 'webp')
+    if not shutil.which('pdftoppm'):
+        logger.warning("pdftoppm (poppler) não encontrado no PATH: anexos PDF ficarão sem prévia.")
+    if not event.contains(db.session, 'before_flush', _before_flush):
+        event.listen(db.session, 'before_flush', _before_flush)
@@ -0,0 +1,83 @@
+"""Capacidades do usuário da requisição (telas do SISREG).
+
+As telas decidem acesso pelo texto legado ``User.profile`` (``ADMIN``,
+``ALTERAR_STATUS``, ``VER_RELATORIOS``...). Em vez de procurar substrings no
+perfil em cada view, helper e template, ``capacidades()`` resolve uma vez por
+requisição um ``frozenset`` com os marcadores do perfil e as capacidades
+concedidas por permissões das roles (``PERMISSOES``, checadas nas máscaras de
+``rbac_bits``) e guarda em ``g``.
+
+- ``pode(*nomes)``: verdadeiro se o usuário tem alguma das capacidades;
+  também disponível nos templates.
+- ``@requer_capacidade(*nomes, ...)``: nega o acesso à view com flash +
+  redirect, 403 em JSON ou ``abort(403)``.
+"""
+from functools import wraps
+
+from flask import abort, flash, g, jsonify, redirect, url_for
+from flask_login import current_user
+
+ADMIN = 'ADMIN'
+ALTERAR_STATUS = 'ALTERAR_STATUS'
+REGULACAO = 'REGULACAO'
+VER_RELATORIOS = 'VER_RELATORIOS'
+AMBULATORIO = 'AMBULATORIO'
+CRIAR_RELATORIOS = 'CRIAR_RELATORIOS'
+
+# Marcadores procurados em ``profile`` (por substring, como sempre foi)
+PERFIL = (ADMIN, ALTERAR_STATUS, REGULACAO, VER_RELATORIOS, AMBULATORIO, CRIAR_RELATORIOS)
+
+# Permissões RBAC (nomes do catálogo) que concedem capacidades do SISREG
+PERMISSOES = {'admin-total': ADMIN}
+
+
+def resolver(user) -> frozenset:
+    if not getattr(user, 'is_authenticated', False):
+        return frozenset()
+    profile = user.profile or ''
+    resolvidas = {nome for nome in PERFIL if nome in profile}
+    # Só consulta as roles se alguma capacidade mapeada ainda não veio do perfil
+    pendentes = {permissao: nome for permissao, nome in PERMISSOES.items() if nome not in resolvidas}
+    resolvidas.update(nome for permissao, nome in pendentes.items() if user.has_permission(permissao))
+    return frozenset(resolvidas)
+
+
+def capacidades() -> frozenset:
+    """Capacidades de ``current_user``, resolvidas uma vez por requisição."""
+    chave = current_user.get_id() if current_user.is_authenticated else None
+    cache = g.get('_capacidades')
+    if cache is None or cache[0] != chave:
+        cache = g._capacidades = (chave, resolver(current_user))
+    return cache[1]
+
+
+def pode(*nomes) -> bool:
+    return not capacidades().isdisjoint(nomes)
+
+
+def requer_capacidade(*nomes, mensagem="Acesso negado!", destino='main.panel', resposta='redirect'):
+    """Exige alguma das capacidades ``nomes``.
+
+    ``resposta``: ``'redirect'`` (flash ``mensagem`` e redireciona para
+    ``destino``, um endpoint ou função que recebe os argumentos da view),
+    ``'json'`` (``{"error": "forbidden"}``, 403) ou ``'abort'`` (403).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if pode(*nomes):
+                return f(*args, **kwargs)
+            if resposta == 'json':
+                return jsonify({"error": "forbidden"}), 403
+            if resposta == 'abort':
+                abort(403)
+            flash(mensagem, "danger")
+            return redirect(destino(**kwargs) if callable(destino) else url_for(destino))
+        return decorated_function
+    return decorator
+
+
+def init_capacidades(app):
+    @app.context_processor
+    def _capacidades():
+        return {'pode': pode}
@@ -0,0 +1,83 @@
+"""Carregamento dos relacionamentos de ``Formulario`` nas telas do SISREG.
+
+Cada consulta de lista/detalhe declara o que o template usa (``LISTA``,
+``DETALHE``, ``PDF``) via ``formulario_options``; assim a página faz um número fixo de
+SELECTs em vez de um por linha.
+
+Duas opções de configuração ajudam a achar N+1 novos:
+
+- ``SQLALCHEMY_STRICT_LOADING``: acrescenta ``raiseload('*')`` às consultas
+  de ``formulario_options``; qualquer relacionamento não declarado levanta
+  erro ao ser acessado.
+- ``SQLALCHEMY_LAZYLOAD_CHECK`` (``'log'`` ou ``'raise'``): registra ou
+  levanta ``LazyLoadError`` quando um lazy load dispara enquanto um template
+  está sendo renderizado.
+"""
+import logging
+
+from flask import before_render_template, current_app, g, has_app_context, template_rendered
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+
+from app.models import db, Formulario
+
+logger = logging.getLogger(__name__)
+
+# Listas que mostram quem registrou a solicitação
+LISTA = (selectinload(Formulario.funcionario),)
+# Página de detalhes e painel da Regulação
+DETALHE = (
+    joinedload(Formulario.funcionario),
+    joinedload(Formulario.autorizador),
+    selectinload(Formulario.eventos),
+    selectinload(Formulario.anexos),
+)
+# PDF da solicitação (templates/pdf/formulario.html)
+PDF = (
+    joinedload(Formulario.funcionario),
+    joinedload(Formulario.autorizador),
+)
+
+
+class LazyLoadError(RuntimeError):
+    pass
+
+
+def formulario_options(*options) -> tuple:
+    """Opções de carregamento para ``select(Formulario).options(...)``."""
+    if current_app.config.get('SQLALCHEMY_STRICT_LOADING'):
+        return options + (raiseload('*'),)
+    return options
+
+
+def _on_render_start(sender, template, context, **extra):
+    g._lazyload_template = template.name
+
+
+def _on_render_end(sender, template, context, **extra):
+    g.pop('_lazyload_template', None)
+
+
+def _on_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_relationship_load or not has_app_context():
+        return
+    mode = current_app.config.get('SQLALCHEMY_LAZYLOAD_CHECK')
+    template = g.get('_lazyload_template') if mode else None
+    if template is None:
+        return
+    origem = orm_execute_state.lazy_loaded_from
+    prop = getattr(orm_execute_state.loader_strategy_path, 'prop', None)
+    alvo = f"{origem.class_.__name__ if origem else '?'}.{getattr(prop, 'key', '?')}"
+    msg = f"Lazy load de {alvo} durante a renderização de {template}"
+    if mode == 'raise':
+        raise LazyLoadError(msg)
+    logger.warning(msg)
+
+
+def init_lazyload_check(app):
+    app.config.setdefault('SQLALCHEMY_STRICT_LOADING', False)
+    app.config.setdefault('SQLALCHEMY_LAZYLOAD_CHECK', '')
+    before_render_template.connect(_on_render_start, app)
+    template_rendered.connect(_on_render_end, app)
+    if not event.contains(db.session, 'do_orm_execute', _on_orm_execute):
+        event.listen(db.session, 'do_orm_execute', _on_orm_execute)
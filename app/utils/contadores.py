@@ -0,0 +1,95 @@
+"""Contadores dos cards de estatística das listas do SISREG.
+
+``contar_por`` resolve todos os cards de uma lista com um único ``GROUP BY``
+sobre a mesma consulta filtrada. Com ``STATUS_COUNTERS`` ligado, a tabela
+``status_counters`` guarda o total por status e é atualizada no mesmo flush
+(mesma transação) de toda criação, exclusão ou troca de status de um
+``Formulario``; aí os totais sem filtro viram uma leitura de poucas linhas.
+Ao ligar a opção pela primeira vez rode ``flask rebuild-status-counters``.
+"""
+from collections import Counter
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+
+from app.models import db, Formulario, StatusCounter
+
+
+def contar_por(query, coluna) -> dict:
+    """``{valor: total}`` de ``coluna`` nas linhas de ``query`` (um ``select(Formulario)``)."""
+    rows = db.session.execute(
+        query.order_by(None).with_only_columns(coluna, func.count()).group_by(coluna)
+    ).all()
+    return {valor: total for valor, total in rows}
+
+
+def counters_enabled() -> bool:
+    return has_app_context() and bool(current_app.config.get('STATUS_COUNTERS'))
+
+
+def status_counts(query=None) -> dict:
+    """Total por status; sem ``query`` usa ``status_counters`` quando habilitado."""
+    if query is None:
+        if counters_enabled():
+            rows = db.session.execute(select(StatusCounter.status, StatusCounter.total)).all()
+            return {status: total for status, total in rows if total}
+        query = select(Formulario)
+    return contar_por(query, Formulario.status)
+
+
+def _status_deltas(session) -> Counter:
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Formulario):
+            deltas[obj.status] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Formulario):
+            history = inspect(obj).attrs.status.history
+            deltas[(history.deleted or history.unchanged or [obj.status])[0]] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, Formulario) and obj not in session.deleted:
+            history = inspect(obj).attrs.status.history
+            if history.added and history.deleted and history.added[0] != history.deleted[0]:
+                deltas[history.deleted[0]] -= 1
+                deltas[history.added[0]] += 1
+    return deltas
+
+
+def _after_flush(session, flush_context):
+    if not counters_enabled():
+        return
+    conn = session.connection()
+    for status, delta in _status_deltas(session).items():
+        if not delta or status is None:
+            continue
+        result = conn.execute(
+            update(StatusCounter.__table__)
+            .where(StatusCounter.__table__.c.status == status)
+            .values(total=StatusCounter.__table__.c.total + delta)
+        )
+        if result.rowcount == 0:
+            conn.execute(insert(StatusCounter.__table__).values(status=status, total=delta))
+
+
+def _keep_old_status(target, value, oldvalue, initiator):
+    return value
+
+
+def init_status_counters(app):
+    app.config.setdefault('STATUS_COUNTERS', False)
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        # Carrega o status anterior antes da troca para o histórico do flush
+        event.listen(Formulario.status, 'set', _keep_old_status, active_history=True, retval=True)
+
+
+def rebuild_status_counters() -> dict:
+    """Recalcula ``status_counters`` a partir da tabela ``formulario``."""
+    counts = contar_por(select(Formulario), Formulario.status)
+    db.session.execute(delete(StatusCounter))
+    if counts:
+        db.session.execute(insert(StatusCounter), [
+            {'status': status, 'total': total} for status, total in counts.items()
+        ])
+    db.session.commit()
+    return counts
@@ -0,0 +1,185 @@
+"""Eventos do fluxo de um formulário (tabela ``formulario_evento``).
+
+Cada ação da Regulação, do Ambulatório ou da UBS grava uma linha nova em vez
+de concatenar texto em ``Formulario.observacao``. ``backfill_eventos`` migra o
+histórico antigo: interpreta as linhas ``[SETOR - AÇÃO] mensagem - dd/mm/aaaa
+HH:MM | por Nome`` de ``observacao``, grava os eventos e deixa em
+``observacao`` apenas o texto original da solicitação. Formulários que já
+ganharam eventos novos antes do backfill também são migrados: a linha do
+tempo ordena por ``criado_em``, então o histórico antigo entra antes deles.
+
+Enquanto o backfill não roda, ``linha_do_tempo`` (usada nos templates) já
+separa a observação original e mostra o histórico antigo junto dos eventos.
+"""
+import re
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from flask_login import current_user
+from sqlalchemy import select
+
+from app.models import db, Formulario, FormularioEvento, User
+
+REGULACAO_AUTORIZAR = 'REGULACAO_AUTORIZAR'
+REGULACAO_REAGENDAR = 'REGULACAO_REAGENDAR'
+REGULACAO_NEGAR = 'REGULACAO_NEGAR'
+REGULACAO_SOLICITAR_REVISAO = 'REGULACAO_SOLICITAR_REVISAO'
+UBS_RESPOSTA_REVISAO = 'UBS_RESPOSTA_REVISAO'
+AMBULATORIO_PRESENCA = 'AMBULATORIO_PRESENCA'
+AMBULATORIO_FALTA = 'AMBULATORIO_FALTA'
+OUTRO = 'OUTRO'
+
+# Cabeçalhos do texto antigo -> tipo (mesma ordem de precedência dos templates)
+_CABECALHOS = (
+    (('SOLICITAR REVISÃO',), REGULACAO_SOLICITAR_REVISAO),
+    (('RESPOSTA REVISÃO',), UBS_RESPOSTA_REVISAO),
+    (('NEGAR', 'NEGADO', 'CANCELAR', 'CANCELADO'), REGULACAO_NEGAR),
+    (('REAGENDAR',), REGULACAO_REAGENDAR),
+    (('AUTORIZAR', 'AUTORIZADO'), REGULACAO_AUTORIZAR),
+    (('PRESENÇA', 'PRESENCA'), AMBULATORIO_PRESENCA),
+    (('FALTA', 'NAO COMPARECEU', 'NÃO COMPARECEU'), AMBULATORIO_FALTA),
+)
+_STAMP_RE = re.compile(r'^(\d{2}/\d{2}/\d{4} \d{2}:\d{2})(?:\s*\|\s*por\s+(.*))?$')
+# Horário de Brasília (UTC-3) -> UTC, como o restante das datas gravadas
+_OFFSET_BRASILIA = timedelta(hours=3)
+
+
+def registrar_evento(formulario, tipo, mensagem=None, ator=None):
+    """Acrescenta um evento ao formulário (só um INSERT; a coleção não é carregada)."""
+    if ator is None and current_user and current_user.is_authenticated:
+        ator = current_user
+    evento = FormularioEvento(
+        formulario_id=formulario.id,
+        tipo=tipo,
+        mensagem=(mensagem or '').strip() or None,
+        ator_id=getattr(ator, 'id', None),
+        ator_nome=getattr(ator, 'name', None) or 'Usuário',
+    )
+    db.session.add(evento)
+    return evento
+
+
+def _tipo_do_cabecalho(cabecalho):
+    upper = cabecalho.upper()
+    for chaves, tipo in _CABECALHOS:
+        if any(chave in upper for chave in chaves):
+            return tipo
+    return OUTRO
+
+
+def parse_observacao(texto):
+    """Separa o texto antigo em (observação original, lista de eventos).
+
+    Cada evento é um dicionário com ``tipo``, ``mensagem``, ``ator_nome`` e
+    ``criado_em`` (UTC, ou ``None`` se o carimbo não puder ser lido).
+    """
+    inicial, eventos = [], []
+    for linha in (texto or '').split('\n'):
+        if not linha.strip().startswith('['):
+            if linha.strip():
+                inicial.append(linha.rstrip())
+            continue
+        for trecho in linha.strip().replace(' [', '\n[').split('\n'):
+            trecho = trecho.strip()
+            if not trecho.startswith('['):
+                continue
+            cabecalho, _, mensagem = trecho[1:].partition(']')
+            mensagem = mensagem.strip()
+            carimbo = None
+            idx = mensagem.rfind(' - ')
+            if idx != -1:
+                mensagem, carimbo = mensagem[:idx], mensagem[idx + 3:]
+            elif mensagem.startswith('- '):
+                mensagem, carimbo = '', mensagem[2:]
+            criado_em, ator_nome = None, None
+            match = _STAMP_RE.match((carimbo or '').strip())
+            if match:
+                criado_em = datetime.strptime(match.group(1), '%d/%m/%Y %H:%M') + _OFFSET_BRASILIA
+                ator_nome = (match.group(2) or '').strip() or None
+            elif carimbo:
+                mensagem = f"{mensagem} - {carimbo}" if mensagem else carimbo
+            tipo = _tipo_do_cabecalho(cabecalho)
+            if tipo == OUTRO and cabecalho.strip():
+                mensagem = f"{cabecalho.strip()}: {mensagem}" if mensagem else cabecalho.strip()
+            eventos.append({
+                'tipo': tipo,
+                'mensagem': mensagem.strip() or None,
+                'ator_nome': ator_nome,
+                'criado_em': criado_em,
+            })
+    return '\n'.join(inicial), eventos
+
+
+def linha_do_tempo(formulario):
+    """``(observação original, eventos)`` para exibir, com o histórico ainda não migrado.
+
+    Os eventos antigos de ``observacao`` (sem carimbo legível: data de
+    registro) entram na lista junto com ``formulario.eventos``, por ``criado_em``.
+    """
+    inicial, antigos = parse_observacao(formulario.observacao)
+    if not antigos:
+        return formulario.observacao, list(formulario.eventos)
+    eventos = [
+        SimpleNamespace(**dict(evento, criado_em=evento['criado_em'] or formulario.data_registro))
+        for evento in antigos
+    ]
+    eventos.extend(formulario.eventos)
+    eventos.sort(key=lambda evento: evento.criado_em or datetime.min)
+    return inicial or None, eventos
+
+
+def init_eventos(app):
+    @app.context_processor
+    def _linha_do_tempo():
+        return {'linha_do_tempo': linha_do_tempo}
+
+
+def backfill_eventos(lote=500) -> dict:
+    """Migra o histórico de ``observacao`` para ``formulario_evento``.
+
+    Vale para todo formulário com cabeçalhos antigos em ``observacao``, tenha
+    ou não eventos; eventos iguais (tipo, data e mensagem) já gravados não
+    são duplicados.
+    """
+    usuarios = {}
+    for user_id, nome in db.session.execute(select(User.id, User.name)).all():
+        # Nomes repetidos ficam sem vínculo (ator_id nulo)
+        usuarios[nome] = None if nome in usuarios else user_id
+
+    ids = db.session.execute(
+        select(Formulario.id)
+        .where(Formulario.observacao.like('%[%'))
+        .order_by(Formulario.id)
+    ).scalars().all()
+
+    stats = {'formularios': 0, 'eventos': 0}
+    for inicio in range(0, len(ids), lote):
+        formularios = db.session.execute(
+            select(Formulario).where(Formulario.id.in_(ids[inicio:inicio + lote]))
+        ).scalars().all()
+        existentes = set(db.session.execute(
+            select(FormularioEvento.formulario_id, FormularioEvento.tipo,
+                   FormularioEvento.criado_em, FormularioEvento.mensagem)
+            .where(FormularioEvento.formulario_id.in_([f.id for f in formularios]))
+        ).all())
+        for f in formularios:
+            inicial, eventos = parse_observacao(f.observacao)
+            if not eventos:
+                continue
+            for evento in eventos:
+                criado_em = evento['criado_em'] or f.data_registro
+                if (f.id, evento['tipo'], criado_em, evento['mensagem']) in existentes:
+                    continue
+                db.session.add(FormularioEvento(
+                    formulario_id=f.id,
+                    tipo=evento['tipo'],
+                    mensagem=evento['mensagem'],
+                    ator_id=usuarios.get(evento['ator_nome']),
+                    ator_nome=evento['ator_nome'],
+                    criado_em=criado_em,
+                ))
+                stats['eventos'] += 1
+            f.observacao = inicial or None
+            stats['formularios'] += 1
+        db.session.commit()
+    return stats
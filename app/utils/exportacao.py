@@ -0,0 +1,109 @@
+"""Exportação das listas de formulários (CSV e Excel) em fluxo contínuo.
+
+As linhas saem de um cursor do lado do servidor (``stream_results`` +
+``yield_per``) só com as colunas exportadas, sem montar objetos ORM, então a
+memória fica constante mesmo com centenas de milhares de linhas.
+
+- CSV: cada bloco de linhas vira um pedaço da resposta; o download começa na
+  primeira leitura do banco.
+- XLSX: workbook ``write_only`` do openpyxl, gravado em arquivo temporário
+  (o .xlsx é um zip cujo índice só existe no fim) e enviado em pedaços.
+"""
+import csv
+import io
+import tempfile
+from datetime import datetime, timedelta
+
+from app.models import db, Formulario, User
+
+LOTE = 1000
+_CHUNK = 64 * 1024
+# Datas gravadas em UTC; a planilha sai no horário de Brasília, como nas telas
+_OFFSET_BRASILIA = timedelta(hours=-3)
+# Texto digitado pelo usuário que o Excel/LibreOffice interpretaria como fórmula
+_INICIO_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+COLUNAS = (
+    ('ID', Formulario.id),
+    ('Data de registro', Formulario.data_registro),
+    ('Status', Formulario.status),
+    ('Paciente', Formulario.nome_paciente),
+    ('Nascimento', Formulario.nascimento),
+    ('CPF', Formulario.cpf),
+    ('Unidade de saúde', Formulario.unidade_saude),
+    ('Médico solicitante', Formulario.medico_solicitante),
+    ('Especialidade', Formulario.especialidade),
+    ('Data de atendimento', Formulario.data_atendimento),
+    ('Hora', Formulario.hora_agendamento),
+    ('Local', Formulario.local_destino),
+    ('Médico do atendimento', Formulario.medico_atendimento),
+    ('Registrado por', User.name),
+)
+
+
+def export_stmt(query):
+    """Troca as entidades de ``query`` (um ``select(Formulario)`` filtrado/ordenado) pelas colunas exportadas."""
+    return (
+        query.with_only_columns(*(coluna for _, coluna in COLUNAS))
+        .outerjoin(User, User.id == Formulario.funcionario_id)
+        .execution_options(stream_results=True, yield_per=LOTE)
+    )
+
+
+def _linhas(stmt):
+    for row in db.session.execute(stmt):
+        registro = row[1]
+        if isinstance(registro, datetime):
+            registro = registro + _OFFSET_BRASILIA
+        yield (row[0], registro) + tuple(_celula(valor) for valor in row[2:])
+
+
+def _celula(valor):
+    """Neutraliza texto que começa como fórmula (``=``, ``+``, ``-``, ``@``) prefixando ``'``."""
+    if isinstance(valor, str) and valor.startswith(_INICIO_FORMULA):
+        return f"'{valor}"
+    return valor
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.strftime('%d/%m/%Y %H:%M')
+    if hasattr(valor, 'strftime'):
+        return valor.strftime('%d/%m/%Y')
+    return valor
+
+
+def gerar_csv(stmt):
+    """Gera a planilha CSV (``;`` e BOM, para abrir direto no Excel) em pedaços."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')
+    writer.writerow([titulo for titulo, _ in COLUNAS])
+    for n, linha in enumerate(_linhas(stmt), 1):
+        writer.writerow([_texto(valor) for valor in linha])
+        if n % LOTE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def gerar_xlsx(stmt):
+    """Gera o .xlsx (workbook write-only) e devolve os bytes em pedaços."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Formulários')
+    ws.append([titulo for titulo, _ in COLUNAS])
+    for linha in _linhas(stmt):
+        ws.append(list(linha))
+    with tempfile.TemporaryFile() as arquivo:
+        wb.save(arquivo)
+        arquivo.seek(0)
+        while True:
+            pedaco = arquivo.read(_CHUNK)
+            if not pedaco:
+                break
+            yield pedaco
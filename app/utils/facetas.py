@@ -0,0 +1,140 @@
+"""Listas de opções (facetas) dos filtros da agenda.
+
+Médicos, locais e especialidades saem de ``SELECT DISTINCT`` sobre toda a
+tabela ``formulario``. Cada worker guarda as listas em memória junto com a
+versão ``facetas`` de ``cache_versions``. Um flush só incrementa a versão
+(e os workers refazem as listas na próxima requisição) se grava um valor que
+não está nas listas atuais ou se remove/troca o último ``Formulario`` com um
+valor; um envio comum de UBS, com especialidade já conhecida, não invalida
+nada. Página normal: uma leitura por chave primária em vez de três varreduras.
+"""
+import threading
+from itertools import chain
+
+from flask import current_app
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm.base import NO_VALUE
+
+from app.models import db, Formulario
+from app.utils.versoes import incrementar_versao, ler_versao
+
+VERSAO = 'facetas'
+COLUNAS = {
+    'medicos': Formulario.medico_atendimento,
+    'locais': Formulario.local_destino,
+    'especialidades': Formulario.especialidade,
+}
+
+
+class FacetCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versao = None
+        self._valores = None
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, versao) -> dict:
+        with self._lock:
+            if self._valores is not None and versao == self._versao:
+                self._stats['hits'] += 1
+                return self._valores
+        valores = _carregar()
+        with self._lock:
+            self._stats['misses'] += 1
+            self._versao, self._valores = versao, valores
+        return valores
+
+    def atual(self, versao):
+        """Listas em cache se foram montadas na ``versao``; ``None`` caso contrário."""
+        with self._lock:
+            return self._valores if versao == self._versao else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, versao=self._versao)
+
+
+def _carregar() -> dict:
+    valores = {}
+    for nome, coluna in COLUNAS.items():
+        rows = db.session.execute(select(coluna).where(coluna.isnot(None)).distinct()).scalars()
+        valores[nome] = sorted(v for v in rows if v)
+    return valores
+
+
+def get_facet_cache() -> FacetCache:
+    cache = current_app.extensions.get('facetas')
+    if cache is None:
+        cache = FacetCache()
+        current_app.extensions['facetas'] = cache
+    return cache
+
+
+def facetas() -> dict:
+    """``{'medicos': [...], 'locais': [...], 'especialidades': [...]}`` ordenadas."""
+    return get_facet_cache().get(ler_versao(VERSAO))
+
+
+def _alteracoes(session):
+    """``(gravados, removidos, ids)`` por faceta neste flush; ``NO_VALUE`` marca valor antigo não carregado."""
+    gravados = {nome: set() for nome in COLUNAS}
+    removidos = {nome: set() for nome in COLUNAS}
+    ids = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, Formulario):
+            continue
+        ids.add(obj.id)
+        attrs = inspect(obj).attrs
+        for nome, coluna in COLUNAS.items():
+            attr = attrs[coluna.key]
+            if obj in session.deleted:
+                antigos, novos = (attr.loaded_value,), ()
+            else:
+                historico = attr.history
+                if not historico.has_changes():
+                    continue
+                novos = historico.added
+                antigos = () if obj in session.new else historico.deleted or (NO_VALUE,)
+            gravados[nome].update(v for v in novos if v)
+            removidos[nome].update(v for v in antigos if v is NO_VALUE or v)
+    return gravados, removidos, ids
+
+
+def _existe(conn, coluna, valor, excluir=()) -> bool:
+    # O flush já foi executado: a consulta enxerga as linhas como ficaram
+    query = select(coluna).where(coluna == valor)
+    if excluir:
+        query = query.where(Formulario.id.notin_(excluir))
+    return conn.execute(query.limit(1)).first() is not None
+
+
+def _mudou(session) -> bool:
+    gravados, removidos, ids = _alteracoes(session)
+    if not any(gravados.values()) and not any(removidos.values()):
+        return False
+    conn = session.connection()
+    if any(gravados.values()):
+        # As listas deste worker só valem se estão na versão do banco; senão o valor é
+        # conhecido se outro Formulario (fora deste flush) já o tem
+        atuais = get_facet_cache().atual(ler_versao(VERSAO, conn))
+        for nome, valores in gravados.items():
+            for valor in valores:
+                if atuais is not None and valor in atuais[nome]:
+                    continue
+                if atuais is not None or not _existe(conn, COLUNAS[nome], valor, ids):
+                    return True
+    for nome, valores in removidos.items():
+        for valor in valores:
+            if valor is NO_VALUE or not _existe(conn, COLUNAS[nome], valor):
+                return True
+    return False
+
+
+def _after_flush(session, flush_context):
+    if _mudou(session):
+        incrementar_versao(session.connection(), VERSAO)
+
+
+def init_facetas(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
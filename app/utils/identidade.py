@@ -0,0 +1,108 @@
+"""Carregamento do usuário da sessão (``user_loader``).
+
+Uma consulta só: o usuário pelo ``fs_uniquifier`` (ou pelo id, sessões
+antigas) com as roles no mesmo ``JOIN``. Com ``IDENTITY_CACHE_TTL`` > 0 cada
+worker guarda por alguns segundos um retrato das colunas do usuário e monta
+o objeto na sessão sem ir ao banco (``merge(load=False)``). As roles ficam
+fora do retrato: as checagens de permissão usam as máscaras de
+``rbac_bits`` e ``user.roles`` só é carregado se alguma tela o usar.
+
+O retrato vale só para a versão ``identidade`` de ``cache_versions`` em que
+foi feito. Ela é incrementada quando um usuário é criado, removido ou tem
+dados de identidade alterados (perfil, ativo, senha, login...), então todos os
+workers descartam os retratos na requisição seguinte. Mudanças de roles e
+permissões ficam na versão ``rbac`` (``rbac_bits``) e não mexem nos retratos.
+"""
+from itertools import chain
+
+from flask import current_app
+from sqlalchemy import event, inspect, or_, select
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.models import db, User
+from app.utils.painel_cache import TTLCache
+from app.utils.versoes import incrementar_versao, ler_versao
+
+VERSAO = 'identidade'
+
+# Colunas de User que, alteradas, invalidam os retratos em cache
+_IDENTIDADE = ('name', 'username', 'email', 'password', 'profile', 'is_active', 'fs_uniquifier')
+
+
+def _consultar(user_id):
+    condicao = User.fs_uniquifier == user_id
+    if user_id.isdigit():
+        condicao = or_(condicao, User.id == int(user_id))
+    usuarios = db.session.execute(
+        select(User).options(joinedload(User.roles)).where(condicao)
+    ).unique().scalars().all()
+    # fs_uniquifier tem precedência sobre o id
+    for user in usuarios:
+        if user.fs_uniquifier == user_id:
+            return user
+    return usuarios[0] if usuarios else None
+
+
+def _retrato(user):
+    if user is None:
+        return None
+    return {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+
+
+def _montar(retrato):
+    user = User()
+    for chave, valor in retrato.items():
+        set_committed_value(user, chave, valor)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def get_identity_cache() -> TTLCache:
+    cache = current_app.extensions.get('identidade')
+    if cache is None:
+        cache = TTLCache(current_app.config.get('IDENTITY_CACHE_TTL', 0))
+        current_app.extensions['identidade'] = cache
+    return cache
+
+
+def carregar_usuario(user_id):
+    if not user_id:
+        return None
+    user_id = str(user_id)
+    cache = get_identity_cache()
+    if cache.ttl <= 0:
+        return _consultar(user_id)
+    consultados = []
+
+    def consultar():
+        user = _consultar(user_id)
+        consultados.append(user)
+        return _retrato(user)
+
+    retrato = cache.get_or_compute((user_id, ler_versao(VERSAO)), consultar)
+    if consultados:
+        return consultados[0]
+    return _montar(retrato) if retrato is not None else None
+
+
+def _mudou(session) -> bool:
+    if any(isinstance(obj, User) for obj in chain(session.new, session.deleted)):
+        return True
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            attrs = inspect(obj).attrs
+            if any(attrs[nome].history.has_changes() for nome in _IDENTIDADE):
+                return True
+    return False
+
+
+def _after_flush(session, flush_context):
+    if _mudou(session):
+        incrementar_versao(session.connection(), VERSAO)
+
+
+def init_identidade(app):
+    app.config.setdefault('IDENTITY_CACHE_TTL', 0)
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
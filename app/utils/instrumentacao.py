@@ -0,0 +1,128 @@
+"""Medição por requisição: tempo de banco, de template e total.
+
+Eventos do engine do SQLAlchemy somam o tempo e a quantidade de consultas de
+cada requisição; os sinais de template do Flask somam o tempo de
+renderização. A resposta sai com ``Server-Timing`` (visível nas DevTools do
+navegador) e, se ``SLOW_REQUEST_MS`` estiver definido, requisições acima do
+limite são registradas no log com a lista de SQL executado.
+
+Configuração:
+
+- ``SERVER_TIMING``: liga os cabeçalhos ``Server-Timing`` (desligado por padrão: expõe
+  quantidade e tempo de consultas a qualquer cliente).
+- ``SLOW_REQUEST_MS``: limite (ms) do log de requisições lentas; ``0`` desliga.
+- ``SLOW_REQUEST_MAX_SQL``: quantas consultas guardar para o log.
+"""
+import logging
+import time
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+from app.models import db
+
+logger = logging.getLogger(__name__)
+
+_SQL_PREVIEW = 500
+
+
+class RequestTiming:
+    __slots__ = ('inicio', 'db', 'queries', 'template', '_template_inicio', 'statements', 'max_sql')
+
+    def __init__(self, max_sql=0):
+        self.inicio = time.perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.template = 0.0
+        self._template_inicio = None
+        self.statements = [] if max_sql else None
+        self.max_sql = max_sql
+
+    def add_query(self, statement, duracao):
+        self.db += duracao
+        self.queries += 1
+        if self.statements is not None and len(self.statements) < self.max_sql:
+            self.statements.append((duracao, statement))
+
+    def header(self, total) -> str:
+        return (
+            f'db;dur={self.db * 1000:.1f};desc="{self.queries} queries", '
+            f'tpl;dur={self.template * 1000:.1f}, '
+            f'total;dur={total * 1000:.1f}'
+        )
+
+
+def _current():
+    return g.get('_request_timing') if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    inicio = conn.info['_query_start'].pop()
+    timing = _current()
+    if timing is not None:
+        timing.add_query(statement, time.perf_counter() - inicio)
+
+
+def _handle_error(context):
+    # Consulta que falhou não chega ao after_cursor_execute
+    if context.connection is not None and context.connection.info.get('_query_start'):
+        context.connection.info['_query_start'].pop()
+
+
+def _on_render_start(sender, template, context, **extra):
+    timing = _current()
+    if timing is not None:
+        timing._template_inicio = time.perf_counter()
+
+
+def _on_render_end(sender, template, context, **extra):
+    timing = _current()
+    if timing is not None and timing._template_inicio is not None:
+        timing.template += time.perf_counter() - timing._template_inicio
+        timing._template_inicio = None
+
+
+def init_request_timing(app):
+    app.config.setdefault('SERVER_TIMING', False)
+    app.config.setdefault('SLOW_REQUEST_MS', 0)
+    app.config.setdefault('SLOW_REQUEST_MAX_SQL', 50)
+
+    with app.app_context():
+        engine = db.engine
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+    before_render_template.connect(_on_render_start, app)
+    template_rendered.connect(_on_render_end, app)
+
+    @app.before_request
+    def _start_request_timing():
+        slow_ms = app.config['SLOW_REQUEST_MS']
+        g._request_timing = RequestTiming(app.config['SLOW_REQUEST_MAX_SQL'] if slow_ms else 0)
+
+    @app.after_request
+    def _finish_request_timing(response):
+        timing = g.pop('_request_timing', None)
+        if timing is None:
+            return response
+        total = time.perf_counter() - timing.inicio
+        if app.config['SERVER_TIMING']:
+            response.headers.add('Server-Timing', timing.header(total))
+        slow_ms = app.config['SLOW_REQUEST_MS']
+        if slow_ms and total * 1000 >= slow_ms:
+            linhas = [
+                f"Requisição lenta: {request.method} {request.full_path.rstrip('?')} -> {response.status_code} "
+                f"total={total * 1000:.0f}ms db={timing.db * 1000:.0f}ms ({timing.queries} consultas) "
+                f"template={timing.template * 1000:.0f}ms"
+            ]
+            for duracao, statement in timing.statements or ():
+                linhas.append(f"  {duracao * 1000:7.1f}ms  {' '.join(statement.split())[:_SQL_PREVIEW]}")
+            if timing.queries > len(timing.statements or ()):
+                linhas.append(f"  ... {timing.queries - len(timing.statements or ())} consultas omitidas")
+            logger.warning('\n'.join(linhas))
+        return response
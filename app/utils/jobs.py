@@ -0,0 +1,247 @@
+"""Fila de tarefas em segundo plano guardada no próprio banco (tabela ``jobs``).
+
+``enfileirar`` grava a tarefa; ``flask worker`` roda ``Worker``, que reserva
+tarefas com um ``UPDATE`` condicional (só um processo ganha cada linha) e as
+executa fora do caminho das requisições. Falhas voltam para a fila com espera
+exponencial até ``max_tentativas``; tarefas presas em ``EXECUTANDO`` por mais
+de ``JOB_TIMEOUT_S`` (worker que morreu) são devolvidas à fila.
+
+Cada tipo de tarefa é registrado com ``@tarefa``; ``concorrencia`` limita
+quantas do mesmo tipo rodam ao mesmo tempo somando todos os workers.
+
+Configuração: ``JOB_MAX_TENTATIVAS``, ``JOB_BACKOFF_S``, ``JOB_TIMEOUT_S``.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from app.models import db, Job
+
+logger = logging.getLogger(__name__)
+
+PENDENTE = 'PENDENTE'
+EXECUTANDO = 'EXECUTANDO'
+CONCLUIDO = 'CONCLUIDO'
+FALHOU = 'FALHOU'
+
+_tabela = Job.__table__
+
+
+@dataclass
+class Tarefa:
+    nome: str
+    func: object
+    max_tentativas: int = None
+    concorrencia: int = None
+
+
+TAREFAS = {}
+
+
+def tarefa(nome, max_tentativas=None, concorrencia=None):
+    """Registra ``func(**payload)`` como tipo de tarefa ``nome``."""
+    def decorator(func):
+        TAREFAS[nome] = Tarefa(nome, func, max_tentativas, concorrencia)
+        return func
+    return decorator
+
+
+def enfileirar(tipo, payload=None, ator=None, executar_em=None) -> Job:
+    """Adiciona a tarefa à sessão; o commit fica com quem chama."""
+    if tipo not in TAREFAS:
+        raise ValueError(f"Tipo de tarefa desconhecido: {tipo}")
+    if payload is not None and not isinstance(payload, dict):
+        # func(**payload) falharia em todas as tentativas
+        raise ValueError("O payload da tarefa deve ser um objeto JSON.")
+    job = Job(
+        tipo=tipo,
+        payload=json.dumps(payload or {}),
+        status=PENDENTE,
+        max_tentativas=TAREFAS[tipo].max_tentativas or current_app.config.get('JOB_MAX_TENTATIVAS', 3),
+        executar_em=executar_em or datetime.utcnow(),
+        criado_por_id=getattr(ator, 'id', None),
+    )
+    db.session.add(job)
+    return job
+
+
+def _limite_ok(tipo, limite):
+    """Condição SQL: menos de ``limite`` tarefas ``tipo`` em execução."""
+    em_execucao = _tabela.alias('em_execucao')
+    total = (
+        select(func.count())
+        .select_from(em_execucao)
+        .where(em_execucao.c.status == EXECUTANDO, em_execucao.c.tipo == tipo)
+        .scalar_subquery()
+    )
+    return total < limite
+
+
+def reservar(worker_id):
+    """Reserva a próxima tarefa pronta para este worker; ``None`` se não houver."""
+    agora = datetime.utcnow()
+    candidatas = db.session.execute(
+        select(_tabela.c.id, _tabela.c.tipo)
+        .where(_tabela.c.status == PENDENTE, _tabela.c.executar_em <= agora)
+        .order_by(_tabela.c.executar_em, _tabela.c.id)
+        .limit(20)
+    ).all()
+    for job_id, tipo in candidatas:
+        condicao = [_tabela.c.id == job_id, _tabela.c.status == PENDENTE]
+        registro = TAREFAS.get(tipo)
+        if registro is not None and registro.concorrencia:
+            # Contagem e reserva no mesmo UPDATE: a trava de escrita do banco serializa os workers
+            condicao.append(_limite_ok(tipo, registro.concorrencia))
+        result = db.session.execute(
+            update(_tabela).where(*condicao).values(
+                status=EXECUTANDO, worker=worker_id, iniciado_em=agora,
+                tentativas=_tabela.c.tentativas + 1,
+            )
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(Job, job_id, populate_existing=True)
+    return None
+
+
+def executar(job):
+    """Roda ``job`` (já reservado) e grava o resultado ou o agendamento da nova tentativa."""
+    job_id, tipo = job.id, job.tipo
+    registro = TAREFAS.get(tipo)
+    try:
+        if registro is None:
+            raise LookupError(f"Tipo de tarefa desconhecido: {tipo}")
+        resultado = registro.func(**json.loads(job.payload or '{}'))
+    except Exception:
+        db.session.rollback()
+        erro = traceback.format_exc(limit=20)
+        job = db.session.get(Job, job_id, populate_existing=True)
+        logger.error("Tarefa %s (%s) falhou na tentativa %s:\n%s", job_id, tipo, job.tentativas, erro)
+        job.erro = erro
+        if job.tentativas < job.max_tentativas:
+            espera = current_app.config.get('JOB_BACKOFF_S', 30) * 2 ** (job.tentativas - 1)
+            job.status = PENDENTE
+            job.executar_em = datetime.utcnow() + timedelta(seconds=espera)
+        else:
+            job.status = FALHOU
+            job.concluido_em = datetime.utcnow()
+        db.session.commit()
+        return job
+    job = db.session.get(Job, job_id, populate_existing=True)
+    job.status = CONCLUIDO
+    job.resultado = json.dumps(resultado, default=str) if resultado is not None else None
+    job.erro = None
+    job.concluido_em = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def recuperar_travadas() -> int:
+    """Devolve à fila tarefas em execução há mais de ``JOB_TIMEOUT_S``."""
+    limite = datetime.utcnow() - timedelta(seconds=current_app.config.get('JOB_TIMEOUT_S', 1800))
+    result = db.session.execute(
+        update(_tabela)
+        .where(_tabela.c.status == EXECUTANDO, _tabela.c.iniciado_em < limite)
+        .values(status=PENDENTE, worker=None, executar_em=datetime.utcnow(),
+                erro='Tarefa interrompida (timeout do worker)')
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def init_jobs(app):
+    app.config.setdefault('JOB_MAX_TENTATIVAS', 3)
+
+
+class Worker:
+    def __init__(self, app, threads=1, poll=2.0):
+        self.app = app
+        self.threads = threads
+        self.poll = poll
+        self.parar = threading.Event()
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def _loop(self, n):
+        worker_id = f"{self.id}:{n}"
+        while not self.parar.is_set():
+            with self.app.app_context():
+                try:
+                    job = reservar(worker_id)
+                    if job is not None:
+                        logger.info("Tarefa %s (%s) iniciada por %s", job.id, job.tipo, worker_id)
+                        job = executar(job)
+                        logger.info("Tarefa %s (%s): %s", job.id, job.tipo, job.status)
+                        continue
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Erro no worker %s", worker_id)
+                finally:
+                    db.session.remove()
+            self.parar.wait(self.poll)
+
+    def run(self):
+        with self.app.app_context():
+            recuperadas = recuperar_travadas()
+        if recuperadas:
+            logger.warning("%s tarefas travadas devolvidas à fila", recuperadas)
+        threads = [threading.Thread(target=self._loop, args=(n,), daemon=True) for n in range(self.threads)]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(timeout=1.0)
+        except KeyboardInterrupt:
+            self.parar.set()
+            for t in threads:
+                t.join()
+
+    def run_once(self) -> int:
+        """Executa as tarefas prontas e sai (útil em cron)."""
+        total = 0
+        with self.app.app_context():
+            recuperar_travadas()
+            while (job := reservar(f"{self.id}:0")) is not None:
+                executar(job)
+                total += 1
+        return total
+
+
+# Tarefas da aplicação
+
+@tarefa('pdf.lote', concorrencia=1)
+def _pdf_lote(dia):
+    from app.utils.pdf_render import autorizados_em, renderizar_lote
+
+    stats = renderizar_lote(autorizados_em(datetime.strptime(dia, '%Y-%m-%d').date()))
+    db.session.commit()
+    return stats
+
+
+@tarefa('contadores.rebuild', concorrencia=1)
+def _contadores_rebuild():
+    from app.utils.contadores import rebuild_status_counters
+
+    return rebuild_status_counters()
+
+
+@tarefa('rollup.rebuild', concorrencia=1)
+def _rollup_rebuild():
+    from app.utils.rollup_diario import rebuild_daily_rollup
+
+    return {'linhas': rebuild_daily_rollup()}
+
+
+@tarefa('eventos.backfill', concorrencia=1, max_tentativas=1)
+def _eventos_backfill(lote=500):
+    from app.utils.eventos import backfill_eventos
+
+    return backfill_eventos(lote=lote)
@@ -0,0 +1,335 @@
+"""Índice binário de pacientes compartilhado entre workers via ``mmap``.
+
+``flask compile-pacientes`` compila o pacientes.db em um arquivo de dados
+versionado (``pacientes.<n>.idx`` ao lado de ``PACIENTES_BIN_PATH``) e troca o
+ponteiro ``PACIENTES_BIN_PATH``, que guarda só o nome desse arquivo. Todos os
+workers mapeiam o mesmo arquivo de dados somente leitura, então o sistema
+operacional mantém uma única cópia em page cache e a busca lê direto do
+mapeamento, sem carga inicial por worker.
+
+Um arquivo mapeado nunca é sobrescrito: no Windows ele não pode ser
+substituído nem apagado enquanto algum worker o mantém aberto. Cada
+compilação apaga as versões antigas que já não estão em uso; as que ainda
+estão mapeadas ficam para a próxima. ``PACIENTES_BIN_PATH`` no formato antigo
+(o próprio índice) continua sendo lido.
+
+Layout (little-endian, seções alinhadas em 8 bytes)::
+
+    cabeçalho   MAGIC, versão, contagens e offsets das seções
+    registros   N x RECORD (id, offset/tamanhos no heap), ordenados por nome
+    heap        nome, cpf, cns e nascimento em UTF-8, concatenados
+    tokens      T x TOKEN (palavra sem acento, offset e total de postings), ordenado
+    postings    u32 com a posição dos registros de cada token, crescente
+    cpf / cns   D x DOC (dígitos, posição do registro), ordenados
+
+Busca por nome: pega o termo com menos postings, percorre em ordem crescente
+(ordem alfabética) a união das listas dos tokens com aquele prefixo e confere
+os demais termos no nome do registro, parando no ``limit``.
+"""
+import heapq
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from io import BytesIO
+from urllib.parse import quote
+
+from flask import current_app
+
+from app.utils.pacientes_busca import RESULT_LIMIT, name_tokens, only_digits
+
+MAGIC = b'SISPACI\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIII6Q')
+RECORD = struct.Struct('<qIHBBBx')
+TOKEN_WIDTH = 24
+TOKEN = struct.Struct(f'<{TOKEN_WIDTH}sII')
+DOC_WIDTH = 16
+DOC = struct.Struct(f'<{DOC_WIDTH}sI')
+
+logger = logging.getLogger(__name__)
+
+
+def _align(buf):
+    buf.write(b'\x00' * (-buf.tell() % 8))
+
+
+class _FixedKeys:
+    """Sequência (para ``bisect``) das chaves de uma tabela de largura fixa."""
+
+    def __init__(self, mm, offset, count, entry, width):
+        self.mm, self.offset, self.count, self.entry, self.width = mm, offset, count, entry, width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.entry.size
+        return self.mm[start:start + self.width].rstrip(b'\x00')
+
+    def value(self, i):
+        return self.entry.unpack_from(self.mm, self.offset + i * self.entry.size)[1:]
+
+    def prefix_range(self, prefix, upper):
+        lo = bisect_left(self, prefix)
+        return lo, bisect_left(self, prefix + upper, lo)
+
+
+def compile_binary_index(db_path, out_path) -> int:
+    """Gera o arquivo binário a partir do pacientes.db. Retorna o total de registros."""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT id, nome, cpf, cns, data_nascimento FROM pacientes_paciente ORDER BY nome"
+        ).fetchall()
+    finally:
+        conn.close()
+
+    records, heap = bytearray(), bytearray()
+    token_postings = {}
+    cpfs, cnss = [], []
+    for pos, (pid, nome, cpf, cns, nascimento) in enumerate(rows):
+        fields = [(v or '').encode('utf-8') for v in (nome, cpf, cns, nascimento)]
+        fields[0] = fields[0][:0xFFFF]
+        fields[1:] = [f[:0xFF] for f in fields[1:]]
+        records += RECORD.pack(pid, len(heap), len(fields[0]), len(fields[1]), len(fields[2]), len(fields[3]))
+        for f in fields:
+            heap += f
+        for key in {t.encode('utf-8')[:TOKEN_WIDTH] for t in name_tokens(nome)}:
+            token_postings.setdefault(key, []).append(pos)
+        for digits, target in ((only_digits(cpf), cpfs), (only_digits(cns), cnss)):
+            if digits:
+                target.append((digits.encode('ascii')[:DOC_WIDTH], pos))
+
+    buf = BytesIO()
+    buf.write(b'\x00' * HEADER.size)
+    _align(buf)
+    records_off = buf.tell()
+    buf.write(records)
+    heap_off = buf.tell()
+    buf.write(heap)
+    _align(buf)
+
+    tokens = sorted(token_postings)
+    postings_blob = array('I')
+    token_table = bytearray()
+    for key in tokens:
+        plist = token_postings[key]
+        token_table += TOKEN.pack(key, len(postings_blob), len(plist))
+        postings_blob.extend(plist)
+    if sys.byteorder != 'little':
+        postings_blob.byteswap()
+    tokens_off = buf.tell()
+    buf.write(token_table)
+    _align(buf)
+    postings_off = buf.tell()
+    buf.write(postings_blob.tobytes())
+    _align(buf)
+
+    doc_offs = []
+    for docs in (sorted(cpfs), sorted(cnss)):
+        doc_offs.append(buf.tell())
+        buf.write(b''.join(DOC.pack(k, p) for k, p in docs))
+        _align(buf)
+
+    buf.seek(0)
+    buf.write(HEADER.pack(
+        MAGIC, VERSION, len(rows), len(tokens), len(cpfs), len(cnss),
+        records_off, heap_off, tokens_off, postings_off, doc_offs[0], doc_offs[1],
+    ))
+    data_path = _versao_path(out_path, time.time_ns())
+    with open(data_path, 'wb') as fh:
+        fh.write(buf.getbuffer())
+        fh.flush()
+        os.fsync(fh.fileno())
+    _apontar(out_path, data_path)
+    _remover_antigos(out_path, data_path)
+    return len(rows)
+
+
+def _versao_path(out_path, versao):
+    root, ext = os.path.splitext(out_path)
+    return f"{root}.{versao}{ext}"
+
+
+def _apontar(out_path, data_path):
+    """Troca o ponteiro ``out_path`` para ``data_path``."""
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(os.path.basename(data_path))
+        fh.flush()
+        os.fsync(fh.fileno())
+    # No Windows a troca falha enquanto um worker lê o ponteiro (instantes) ou, se
+    # ``out_path`` ainda é um índice no formato antigo, enquanto estiver mapeado
+    for _ in range(10):
+        try:
+            os.replace(tmp_path, out_path)
+            return
+        except PermissionError as e:
+            erro = e
+            time.sleep(0.2)
+    os.remove(tmp_path)
+    raise PermissionError(
+        f"Não foi possível substituir {out_path} ({erro}). Se for um índice do formato antigo "
+        f"mapeado pelos workers, pare a aplicação e rode o comando de novo; o novo índice está em {data_path}."
+    )
+
+
+def _remover_antigos(out_path, atual):
+    root, ext = os.path.splitext(os.path.basename(out_path))
+    padrao = re.compile(rf"{re.escape(root)}\.\d+{re.escape(ext)}")
+    pasta = os.path.dirname(os.path.abspath(out_path))
+    for nome in os.listdir(pasta):
+        caminho = os.path.join(pasta, nome)
+        if padrao.fullmatch(nome) and nome != os.path.basename(atual):
+            try:
+                os.remove(caminho)
+            except PermissionError:
+                # Ainda mapeado por algum worker (Windows); sai na próxima compilação
+                pass
+
+
+def _resolver(path):
+    """Arquivo de dados indicado pelo ponteiro ``path`` (ou o próprio ``path`` no formato antigo)."""
+    with open(path, 'rb') as fh:
+        conteudo = fh.read(256)
+    if conteudo.startswith(MAGIC):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(path)), conteudo.decode('utf-8').strip())
+
+
+class PacientesBinIndex:
+
+    def __init__(self, path):
+        path = _resolver(path)
+        with open(path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.size, n_tokens, n_cpf, n_cns,
+         self._records_off, self._heap_off, tokens_off, self._postings_off,
+         cpf_off, cns_off) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Arquivo de índice inválido: {path}")
+        if sys.byteorder != 'little':
+            raise ValueError("Índice binário de pacientes requer plataforma little-endian")
+        self._postings = memoryview(self._mm)[self._postings_off:].cast('I')
+        self._tokens = _FixedKeys(self._mm, tokens_off, n_tokens, TOKEN, TOKEN_WIDTH)
+        self._cpf = _FixedKeys(self._mm, cpf_off, n_cpf, DOC, DOC_WIDTH)
+        self._cns = _FixedKeys(self._mm, cns_off, n_cns, DOC, DOC_WIDTH)
+
+    def _record(self, pos):
+        pid, off, *lens = RECORD.unpack_from(self._mm, self._records_off + pos * RECORD.size)
+        start = self._heap_off + off
+        fields = []
+        for n in lens:
+            fields.append(self._mm[start:start + n].decode('utf-8'))
+            start += n
+        return pid, fields
+
+    def _to_dict(self, pos):
+        pid, (nome, cpf, cns, nascimento) = self._record(pos)
+        return {"id": pid, "nome": nome, "cpf": cpf, "cns": cns, "data_nascimento": nascimento}
+
+    def _token_lists(self, token):
+        key = token.encode('utf-8')[:TOKEN_WIDTH]
+        lo, hi = self._tokens.prefix_range(key, b'\xff')
+        lists = []
+        for i in range(lo, hi):
+            start, count = self._tokens.value(i)
+            lists.append(self._postings[start:start + count])
+        return lists
+
+    def _search_nome(self, tokens, limit):
+        candidates = min((self._token_lists(t) for t in tokens), key=lambda ls: sum(len(x) for x in ls))
+        if not candidates:
+            return []
+        needles = [' ' + t for t in tokens]
+        # Com um único termo curto o token já garante o casamento
+        verify = len(tokens) > 1 or len(tokens[0].encode('utf-8')) > TOKEN_WIDTH
+        found, last = [], None
+        for pos in heapq.merge(*candidates):
+            if pos == last:
+                continue
+            last = pos
+            if verify:
+                words = ' ' + ' '.join(name_tokens(self._record(pos)[1][0]))
+                if not all(n in words for n in needles):
+                    continue
+            found.append(pos)
+            if len(found) >= limit:
+                break
+        return found
+
+    def _search_digits(self, digits, limit):
+        key = digits.encode('ascii')[:DOC_WIDTH]
+        matches = set()
+        for table in (self._cpf, self._cns):
+            lo, hi = table.prefix_range(key, b':')
+            matches.update(table.value(i)[0] for i in range(lo, hi))
+        return heapq.nsmallest(limit, matches)
+
+    def search(self, q, limit=RESULT_LIMIT):
+        tokens = name_tokens(q)
+        if tokens:
+            found = self._search_nome(tokens, limit)
+        else:
+            digits = only_digits(q)
+            found = self._search_digits(digits, limit) if digits else []
+        return [self._to_dict(pos) for pos in found]
+
+
+class PacientesBinSearch:
+    """Abre (e reabre quando recompilado) o índice binário do worker."""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._index = None
+        self._mtime_ns = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._mtime_ns is None or now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                try:
+                    mtime_ns = os.stat(self.path).st_mtime_ns
+                except OSError:
+                    self._index, self._mtime_ns = None, None
+                    return None
+                if mtime_ns != self._mtime_ns:
+                    # O mmap antigo é liberado quando a última busca em andamento terminar
+                    self._mtime_ns = mtime_ns
+                    try:
+                        self._index = PacientesBinIndex(self.path)
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Erro ao abrir índice binário de pacientes: {e}")
+                        self._index = None
+            return self._index
+
+    def search(self, q, limit=RESULT_LIMIT):
+        """Resultados do índice binário ou ``None`` se o arquivo não existir."""
+        index = self._current()
+        if index is None:
+            return None
+        return index.search(q, limit)
+
+    def stats(self) -> dict:
+        index = self._index
+        return {'path': self.path, 'ready': index is not None, 'records': index.size if index else 0}
+
+
+def get_pacientes_bin_search() -> PacientesBinSearch:
+    search = current_app.extensions.get('pacientes_bin_search')
+    if search is None:
+        search = PacientesBinSearch(current_app.config['PACIENTES_BIN_PATH'])
+        current_app.extensions['pacientes_bin_search'] = search
+    return search
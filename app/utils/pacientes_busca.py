@@ -0,0 +1,163 @@
+"""Busca de pacientes no cadastro municipal externo (pacientes.db).
+
+O banco ``pacientes.db`` é gerado fora da aplicação e contém a tabela
+``pacientes_paciente`` (id, nome, cpf, cns, data_nascimento). Para o
+autocomplete não varrer a tabela inteira a cada tecla, o comando
+``flask index-pacientes`` cria dentro do próprio arquivo:
+
+- ``pacientes_paciente_fts``: tabela FTS5 (sem conteúdo) com o nome do
+  paciente, tokenizada sem acentos e com índices de prefixo;
+- ``pacientes_paciente_docs``: CPF/CNS somente com dígitos, indexados,
+  para busca por prefixo numérico.
+
+Enquanto os índices não existirem a busca usa a consulta legada com LIKE.
+"""
+import re
+import unicodedata
+
+FTS_TABLE = 'pacientes_paciente_fts'
+DOCS_TABLE = 'pacientes_paciente_docs'
+RESULT_LIMIT = 10
+
+_TOKEN_RE = re.compile(r'[^\W\d_]+', re.UNICODE)
+_NON_DIGIT_RE = re.compile(r'\D+')
+
+_LEGACY_SQL = """
+    SELECT id, nome, cpf, cns, data_nascimento
+    FROM pacientes_paciente
+    WHERE (
+        lower(nome) LIKE ?
+        OR replace(replace(replace(ifnull(cpf,''), '.', ''), '-', ''), ' ', '') LIKE ?
+        OR replace(replace(replace(ifnull(cns,''), '.', ''), '-', ''), ' ', '') LIKE ?
+        OR ifnull(cpf,'') LIKE ?
+        OR ifnull(cns,'') LIKE ?
+    )
+    ORDER BY nome ASC
+    LIMIT ?
+"""
+
+_NOME_SQL = f"""
+    SELECT p.id, p.nome, p.cpf, p.cns, p.data_nascimento
+    FROM {FTS_TABLE} AS f
+    JOIN pacientes_paciente AS p ON p.id = f.rowid
+    WHERE {FTS_TABLE} MATCH ?
+    ORDER BY p.nome ASC
+    LIMIT ?
+"""
+
+_DOCS_SQL = f"""
+    SELECT p.id, p.nome, p.cpf, p.cns, p.data_nascimento
+    FROM pacientes_paciente AS p
+    WHERE p.id IN (
+        SELECT paciente_id FROM {DOCS_TABLE} WHERE cpf_digits >= ? AND cpf_digits < ?
+        UNION
+        SELECT paciente_id FROM {DOCS_TABLE} WHERE cns_digits >= ? AND cns_digits < ?
+    )
+    ORDER BY p.nome ASC
+    LIMIT ?
+"""
+
+
+def only_digits(value) -> str:
+    """Remove pontuação/espaços de CPF e CNS."""
+    return _NON_DIGIT_RE.sub("", value or "")
+
+
+def fold_text(value) -> str:
+    """Minúsculas e sem acentos ("José" -> "jose")."""
+    value = value or ''
+    if value.isascii():
+        return value.lower()
+    decomposed = unicodedata.normalize('NFKD', value)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
+
+def name_tokens(value) -> list[str]:
+    return _TOKEN_RE.findall(fold_text(value))
+
+
+def _row_to_dict(row) -> dict:
+    return {
+        "id": row[0],
+        "nome": row[1] or "",
+        "cpf": row[2] or "",
+        "cns": row[3] or "",
+        "data_nascimento": row[4] or "",
+    }
+
+
+def has_search_index(conn) -> bool:
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE name IN (?, ?)", (FTS_TABLE, DOCS_TABLE)
+    ).fetchall()
+    return len(rows) == 2
+
+
+def build_search_index(conn) -> int:
+    """(Re)cria os índices de busca no pacientes.db. Retorna o total indexado."""
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+        conn.execute(f"DROP TABLE IF EXISTS {DOCS_TABLE}")
+        conn.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "nome, content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        conn.execute(
+            f"CREATE TABLE {DOCS_TABLE} ("
+            "paciente_id INTEGER PRIMARY KEY, cpf_digits TEXT, cns_digits TEXT)"
+        )
+
+        conn.create_function('only_digits', 1, only_digits, deterministic=True)
+        conn.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, nome) "
+            "SELECT id, ifnull(nome, '') FROM pacientes_paciente"
+        )
+        conn.execute(
+            f"INSERT INTO {DOCS_TABLE}(paciente_id, cpf_digits, cns_digits) "
+            "SELECT id, nullif(only_digits(cpf), ''), nullif(only_digits(cns), '') "
+            "FROM pacientes_paciente"
+        )
+        conn.execute(f"CREATE INDEX ix_{DOCS_TABLE}_cpf ON {DOCS_TABLE}(cpf_digits)")
+        conn.execute(f"CREATE INDEX ix_{DOCS_TABLE}_cns ON {DOCS_TABLE}(cns_digits)")
+        conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        total = conn.execute(f"SELECT count(*) FROM {DOCS_TABLE}").fetchone()[0]
+    conn.execute("ANALYZE")
+    return total
+
+
+def _fts_query(tokens) -> str:
+    # Cada termo vira um prefixo entre aspas para não colidir com a sintaxe do FTS5
+    return " AND ".join(f'"{t}"*' for t in tokens)
+
+
+def _search_legacy(conn, q, limit):
+    like_nome = f"%{q.lower()}%"
+    digits = only_digits(q)
+    like_digits = f"%{digits}%" if digits else like_nome
+    params = (like_nome, like_digits, like_digits, like_digits, like_digits, limit)
+    return conn.execute(_LEGACY_SQL, params).fetchall()
+
+
+def search_pacientes(conn, q, limit=RESULT_LIMIT, indexed=None) -> list[dict]:
+    """Busca por nome (prefixo de cada palavra, sem acento) ou por CPF/CNS (prefixo).
+
+    ``indexed`` evita reconsultar o sqlite_master quando o chamador já sabe
+    se os índices existem (ex.: pool de conexões).
+    """
+    q = (q or "").strip()
+    if indexed is None:
+        indexed = has_search_index(conn)
+    if not indexed:
+        return [_row_to_dict(r) for r in _search_legacy(conn, q, limit)]
+
+    tokens = name_tokens(q)
+    if tokens:
+        rows = conn.execute(_NOME_SQL, (_fts_query(tokens), limit)).fetchall()
+    else:
+        digits = only_digits(q)
+        if not digits:
+            return []
+        # Intervalo [d, d + ':') cobre todas as strings numéricas com prefixo d
+        upper = digits + ':'
+        rows = conn.execute(_DOCS_SQL, (digits, upper, digits, upper, limit)).fetchall()
+    return [_row_to_dict(r) for r in rows]
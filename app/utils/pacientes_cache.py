@@ -0,0 +1,110 @@
+"""Cache LRU de resultados do autocomplete de pacientes.
+
+A chave é a consulta normalizada (nome sem acento em minúsculas ou só os
+dígitos). Cada entrada guarda até ``candidate_limit`` candidatos; se vierem
+menos que isso, a entrada é *completa* (é todo o conjunto que casa com a
+consulta). Quando o usuário continua digitando ("ma" -> "mar" -> "mari"), a
+nova consulta é um refinamento da anterior e é respondida filtrando os
+candidatos em memória, sem ir ao banco.
+
+Só é usado com o índice de busca do pacientes.db (semântica de prefixo por
+palavra / prefixo de CPF-CNS); o cache é descartado quando o arquivo muda.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from app.utils.pacientes_busca import RESULT_LIMIT, name_tokens, only_digits, search_pacientes
+
+
+def normalize_query(q) -> str:
+    tokens = name_tokens(q)
+    if tokens:
+        return 'n:' + ' '.join(tokens)
+    digits = only_digits(q)
+    return 'd:' + digits if digits else ''
+
+
+def _matches(key, paciente) -> bool:
+    kind, value = key[:2], key[2:]
+    if kind == 'd:':
+        return only_digits(paciente['cpf']).startswith(value) or only_digits(paciente['cns']).startswith(value)
+    words = ' ' + ' '.join(name_tokens(paciente['nome']))
+    return all(' ' + t in words for t in value.split(' '))
+
+
+class PacientesQueryCache:
+
+    def __init__(self, max_entries=512, candidate_limit=200):
+        self.max_entries = max_entries
+        self.candidate_limit = candidate_limit
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'refinements': 0, 'misses': 0, 'evictions': 0}
+
+    def _lookup(self, key, limit):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0][:limit]
+        # Maior prefixo já em cache com conjunto completo de candidatos
+        for end in range(len(key) - 1, 2, -1):
+            prefix = key[:end]
+            entry = self._entries.get(prefix)
+            if entry is None or not entry[1]:
+                continue
+            self._entries.move_to_end(prefix)
+            candidates = [p for p in entry[0] if _matches(key, p)]
+            self._store(key, candidates, True)
+            self._stats['refinements'] += 1
+            return candidates[:limit]
+        return None
+
+    def _store(self, key, candidates, complete):
+        self._entries[key] = (candidates, complete)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def search(self, conn, q, generation=None, limit=RESULT_LIMIT) -> list[dict]:
+        key = normalize_query(q)
+        if not key:
+            return []
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+            cached = self._lookup(key, limit)
+        if cached is not None:
+            return cached
+
+        candidates = search_pacientes(conn, q, limit=self.candidate_limit, indexed=True)
+        with self._lock:
+            self._stats['misses'] += 1
+            if generation == self._generation:
+                self._store(key, candidates, len(candidates) < self.candidate_limit)
+        return candidates[:limit]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._stats['hits'] + self._stats['refinements'] + self._stats['misses']
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                hit_ratio=round((total - self._stats['misses']) / total, 3) if total else None,
+            )
+
+
+def get_pacientes_cache() -> PacientesQueryCache:
+    cache = current_app.extensions.get('pacientes_cache')
+    if cache is None:
+        cache = PacientesQueryCache(
+            max_entries=current_app.config.get('PACIENTES_CACHE_ENTRIES', 512),
+            candidate_limit=current_app.config.get('PACIENTES_CACHE_CANDIDATOS', 200),
+        )
+        current_app.extensions['pacientes_cache'] = cache
+    return cache
@@ -0,0 +1,215 @@
+"""Importação em massa do cadastro de pacientes (pacientes.db).
+
+Lê dumps CSV ou JSONL (opcionalmente ``.gz``) como um pipeline de geradores:
+leitura -> normalização -> lotes. Cada lote é gravado com ``executemany`` em
+uma única transação (upsert pela chave escolhida), então a memória usada não
+depende do tamanho do arquivo. Ao final os índices de busca são recriados.
+"""
+import csv
+import gzip
+import json
+import re
+import sqlite3
+import time
+from datetime import datetime
+from itertools import islice
+
+from app.utils.pacientes_busca import build_search_index, only_digits
+
+BATCH_SIZE = 50_000
+CHAVES = ('cns', 'cpf', 'id')
+
+# Nomes de coluna aceitos nos dumps (minúsculos, sem espaços)
+COLUNAS = {
+    'id': ('id', 'co_paciente', 'codigo'),
+    'nome': ('nome', 'name', 'no_paciente', 'nome_paciente'),
+    'cpf': ('cpf', 'nu_cpf'),
+    'cns': ('cns', 'nu_cns', 'cartao_sus', 'cartao_sus_numero'),
+    'data_nascimento': ('data_nascimento', 'nascimento', 'dt_nascimento', 'data_nasc'),
+}
+
+_DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d%m%Y')
+_SPACES_RE = re.compile(r'\s+')
+
+_PRAGMAS_IMPORT = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -200000",
+)
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pacientes_paciente (
+        id INTEGER PRIMARY KEY,
+        nome TEXT,
+        cpf TEXT,
+        cns TEXT,
+        data_nascimento TEXT
+    )
+"""
+
+_UPSERT = {
+    'id': """
+        INSERT INTO pacientes_paciente (id, nome, cpf, cns, data_nascimento)
+        VALUES (:id, :nome, :cpf, :cns, :data_nascimento)
+        ON CONFLICT(id) DO UPDATE SET
+            nome = excluded.nome, cpf = excluded.cpf,
+            cns = excluded.cns, data_nascimento = excluded.data_nascimento
+    """,
+    'cns': """
+        INSERT INTO pacientes_paciente (nome, cpf, cns, data_nascimento)
+        VALUES (:nome, :cpf, :cns, :data_nascimento)
+        ON CONFLICT(cns) WHERE cns IS NOT NULL DO UPDATE SET
+            nome = excluded.nome, cpf = excluded.cpf, data_nascimento = excluded.data_nascimento
+    """,
+    'cpf': """
+        INSERT INTO pacientes_paciente (nome, cpf, cns, data_nascimento)
+        VALUES (:nome, :cpf, :cns, :data_nascimento)
+        ON CONFLICT(cpf) WHERE cpf IS NOT NULL DO UPDATE SET
+            nome = excluded.nome, cns = excluded.cns, data_nascimento = excluded.data_nascimento
+    """,
+}
+
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8-sig', newline='')
+    return open(path, 'r', encoding='utf-8-sig', newline='')
+
+
+def read_records(path):
+    """Gera dicionários (colunas em minúsculas) de um CSV ou JSONL."""
+    base = path[:-3] if path.endswith('.gz') else path
+    with _open_text(path) as fh:
+        if base.endswith(('.jsonl', '.ndjson')):
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield {str(k).strip().lower(): v for k, v in json.loads(line).items()}
+            return
+        sample = fh.read(64 * 1024)
+        fh.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=';,\t|')
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.DictReader(fh, dialect=dialect):
+            yield {(k or '').strip().lower(): v for k, v in row.items()}
+
+
+def normalize_date(value):
+    value = str(value or '').strip()[:10]
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return value or None
+
+
+def normalize_record(raw) -> dict:
+    """Mapeia colunas e normaliza: nome sem espaços duplicados, CPF/CNS só dígitos, data ISO."""
+    def pick(field):
+        for alias in COLUNAS[field]:
+            value = raw.get(alias)
+            if value not in (None, ''):
+                return value
+        return None
+
+    pid = pick('id')
+    nome = _SPACES_RE.sub(' ', str(pick('nome') or '')).strip()
+    cpf = only_digits(str(pick('cpf') or ''))
+    cns = only_digits(str(pick('cns') or ''))
+    if cpf and len(cpf) < 11:
+        cpf = cpf.zfill(11)
+    return {
+        'id': int(pid) if pid is not None and str(pid).strip().isdigit() else None,
+        'nome': nome or None,
+        'cpf': cpf or None,
+        'cns': cns or None,
+        'data_nascimento': normalize_date(pick('data_nascimento')),
+    }
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _criar_indice_unico(conn, chave):
+    """Índice único da chave do upsert; ``ValueError`` se o banco já tem valores repetidos."""
+    nome = f"ux_pacientes_paciente_{chave}"
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (nome,)).fetchone():
+        return
+    repetidos = conn.execute(
+        f"SELECT {chave}, count(*) FROM pacientes_paciente WHERE {chave} IS NOT NULL "
+        f"GROUP BY {chave} HAVING count(*) > 1 LIMIT 11"
+    ).fetchall()
+    if repetidos:
+        lista = ', '.join(f"{valor} ({total}x)" for valor, total in repetidos[:10])
+        raise ValueError(
+            f"O pacientes.db já tem {chave.upper()} repetidos ({lista}{', ...' if len(repetidos) > 10 else ''}); "
+            f"remova as duplicatas ou importe com outra --chave."
+        )
+    conn.execute(f"CREATE UNIQUE INDEX {nome} ON pacientes_paciente({chave}) WHERE {chave} IS NOT NULL")
+
+
+def import_pacientes(db_path, path, chave='cns', batch_size=BATCH_SIZE, progress=None) -> dict:
+    """Importa ``path`` no pacientes.db fazendo upsert por ``chave``.
+
+    ``progress(stats)`` é chamado a cada lote gravado. Registros sem nome ou
+    sem a chave escolhida são ignorados e contados em ``ignorados``.
+    ``ValueError`` se o banco já tem valores repetidos da ``chave``.
+    """
+    if chave not in CHAVES:
+        raise ValueError(f"Chave inválida: {chave}. Use uma de {', '.join(CHAVES)}.")
+
+    stats = {'lidos': 0, 'gravados': 0, 'ignorados': 0, 'segundos': 0.0, 'linhas_por_segundo': 0.0}
+    inicio = time.perf_counter()
+
+    def validos(records):
+        for raw in records:
+            stats['lidos'] += 1
+            rec = normalize_record(raw)
+            if not rec['nome'] or rec[chave] is None:
+                stats['ignorados'] += 1
+                continue
+            yield rec
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        for pragma in _PRAGMAS_IMPORT:
+            conn.execute(pragma)
+        conn.execute(_SCHEMA)
+        if chave != 'id':
+            _criar_indice_unico(conn, chave)
+        sql = _UPSERT[chave]
+        for batch in _batches(validos(read_records(path)), batch_size):
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(sql, batch)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            stats['gravados'] += len(batch)
+            stats['segundos'] = time.perf_counter() - inicio
+            stats['linhas_por_segundo'] = stats['lidos'] / stats['segundos'] if stats['segundos'] else 0.0
+            if progress:
+                progress(stats)
+
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # Leitores abrem o arquivo com mode=ro: volta ao journal padrão
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.isolation_level = ''
+        stats['indexados'] = build_search_index(conn)
+    finally:
+        conn.close()
+
+    stats['segundos'] = time.perf_counter() - inicio
+    stats['linhas_por_segundo'] = stats['lidos'] / stats['segundos'] if stats['segundos'] else 0.0
+    return stats
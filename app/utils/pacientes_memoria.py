@@ -0,0 +1,216 @@
+"""Índice em memória (trigramas + prefixos) para o autocomplete de pacientes.
+
+Opcional (``PACIENTES_BUSCA_MEMORIA``). Cada worker carrega o pacientes.db uma
+vez em estruturas compactas:
+
+- registros ordenados por nome (a posição já é a ordem do resultado);
+- ``dict[trigrama] -> array('I')`` com as posições dos registros cujo nome
+  contém o trigrama (palavras com marcador de início, " ma", "mar", ...);
+- listas ordenadas de CPF/CNS só com dígitos, consultadas por ``bisect``.
+
+Uma busca intersecta as listas de postings em ordem crescente e para assim que
+encontra ``limit`` registros, sem tocar no SQLite. Quando o arquivo muda, um
+novo índice é montado em uma thread e trocado atomicamente; até lá (e na
+primeira carga) o chamador recebe ``None`` e usa a busca SQL.
+"""
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from urllib.parse import quote
+
+from flask import current_app
+
+from app.utils.pacientes_busca import RESULT_LIMIT, name_tokens, only_digits
+
+logger = logging.getLogger(__name__)
+
+
+def _trigrams(word):
+    padded = ' ' + word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _query_grams(token):
+    # Termo de uma letra só tem o bigrama de início de palavra (" a")
+    return _trigrams(token) if len(token) > 1 else {' ' + token}
+
+
+class PacientesMemIndex:
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda r: r[1] or '')
+        self.size = len(rows)
+        self.ids = array('q')
+        self.records = []
+        self._folded = []
+        grams = {}
+        cpfs, cnss = [], []
+        for pos, (pid, nome, cpf, cns, nascimento) in enumerate(rows):
+            self.ids.append(pid)
+            self.records.append((nome or '', cpf or '', cns or '', nascimento or ''))
+            words = name_tokens(nome)
+            self._folded.append(' ' + ' '.join(words))
+            seen = set()
+            for w in words:
+                seen.add(' ' + w[0])
+                seen.update(_trigrams(w))
+            for g in seen:
+                postings = grams.get(g)
+                if postings is None:
+                    postings = grams[g] = array('I')
+                postings.append(pos)
+            cpf_digits = only_digits(cpf)
+            if cpf_digits:
+                cpfs.append((cpf_digits, pos))
+            cns_digits = only_digits(cns)
+            if cns_digits:
+                cnss.append((cns_digits, pos))
+        self._grams = grams
+        cpfs.sort()
+        cnss.sort()
+        self._cpf_keys = [k for k, _ in cpfs]
+        self._cpf_pos = array('I', (p for _, p in cpfs))
+        self._cns_keys = [k for k, _ in cnss]
+        self._cns_pos = array('I', (p for _, p in cnss))
+
+    def _to_dict(self, pos):
+        nome, cpf, cns, nascimento = self.records[pos]
+        return {"id": self.ids[pos], "nome": nome, "cpf": cpf, "cns": cns, "data_nascimento": nascimento}
+
+    def _search_nome(self, tokens, limit):
+        postings = []
+        for t in tokens:
+            for g in _query_grams(t):
+                p = self._grams.get(g)
+                if p is None:
+                    return []
+                postings.append(p)
+        postings.sort(key=len)
+        needles = [' ' + t for t in tokens]
+        base, others = postings[0], postings[1:]
+        found = []
+        for pos in base:
+            ok = True
+            for other in others:
+                i = bisect_left(other, pos)
+                if i == len(other) or other[i] != pos:
+                    ok = False
+                    break
+            if not ok:
+                continue
+            folded = self._folded[pos]
+            if all(n in folded for n in needles):
+                found.append(pos)
+                if len(found) >= limit:
+                    break
+        return found
+
+    @staticmethod
+    def _prefix_range(keys, positions, digits):
+        i = bisect_left(keys, digits)
+        j = bisect_left(keys, digits + ':', i)
+        return positions[i:j]
+
+    def _search_digits(self, digits, limit):
+        matches = set(self._prefix_range(self._cpf_keys, self._cpf_pos, digits))
+        matches.update(self._prefix_range(self._cns_keys, self._cns_pos, digits))
+        return heapq.nsmallest(limit, matches)
+
+    def search(self, q, limit=RESULT_LIMIT):
+        tokens = name_tokens(q)
+        if tokens:
+            found = self._search_nome(tokens, limit)
+        else:
+            digits = only_digits(q)
+            found = self._search_digits(digits, limit) if digits else []
+        return [self._to_dict(pos) for pos in found]
+
+
+def load_mem_index(db_path) -> PacientesMemIndex:
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT id, nome, cpf, cns, data_nascimento FROM pacientes_paciente").fetchall()
+    finally:
+        conn.close()
+    return PacientesMemIndex(rows)
+
+
+class PacientesMemSearch:
+    """Mantém o índice do worker atualizado, recarregando em segundo plano."""
+
+    def __init__(self, db_path, check_interval=5.0):
+        self.db_path = db_path
+        self.check_interval = check_interval
+        self._index = None
+        self._mtime_ns = None
+        self._checked_at = 0.0
+        self._loading = False
+        self._lock = threading.Lock()
+        self._stats = {'loads': 0, 'last_load_seconds': None, 'last_error': None}
+
+    def _build(self, mtime_ns):
+        inicio = time.perf_counter()
+        try:
+            index = load_mem_index(self.db_path)
+        except Exception as e:
+            logger.error(f"Erro ao carregar índice de pacientes em memória: {e}")
+            with self._lock:
+                self._stats['last_error'] = str(e)
+                self._mtime_ns = None
+                self._loading = False
+            return
+        with self._lock:
+            self._index = index
+            self._mtime_ns = mtime_ns
+            self._loading = False
+            self._stats['loads'] += 1
+            self._stats['last_load_seconds'] = round(time.perf_counter() - inicio, 3)
+            self._stats['last_error'] = None
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._loading or now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                mtime_ns = os.stat(self.db_path).st_mtime_ns
+            except OSError:
+                return
+            if mtime_ns == self._mtime_ns:
+                return
+            self._loading = True
+        threading.Thread(target=self._build, args=(mtime_ns,), daemon=True).start()
+
+    def search(self, q, limit=RESULT_LIMIT):
+        """Resultados do índice em memória ou ``None`` se ainda não carregado."""
+        self._maybe_reload()
+        index = self._index
+        if index is None:
+            return None
+        return index.search(q, limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                self._stats,
+                ready=self._index is not None,
+                loading=self._loading,
+                records=self._index.size if self._index is not None else 0,
+            )
+
+
+def get_pacientes_mem_search():
+    """Busca em memória do worker, ou ``None`` se desabilitada na config."""
+    if not current_app.config.get('PACIENTES_BUSCA_MEMORIA'):
+        return None
+    mem = current_app.extensions.get('pacientes_mem_search')
+    if mem is None:
+        mem = PacientesMemSearch(current_app.config['PACIENTES_DB_PATH'])
+        current_app.extensions['pacientes_mem_search'] = mem
+    return mem
@@ -0,0 +1,150 @@
+"""Pool de conexões somente leitura para o pacientes.db.
+
+Cada worker mantém algumas conexões abertas (URI ``mode=ro``, ``mmap_size``
+e cache de statements do sqlite3), reaproveitadas entre requisições. Quando o
+arquivo é substituído/reindexado (mtime muda) as conexões antigas são
+descartadas e novas são abertas sob demanda.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from flask import current_app
+
+from app.utils.pacientes_busca import has_search_index
+
+
+class PacientesPool:
+
+    def __init__(self, db_path, size=4, mmap_size=256 * 1024 * 1024, immutable=False, check_interval=1.0):
+        self.db_path = db_path
+        self.size = size
+        self.mmap_size = mmap_size
+        self.immutable = immutable
+        self.check_interval = check_interval
+        self.indexed = False
+        self._lock = threading.Lock()
+        self._idle = []
+        self._generation = 0
+        self._mtime_ns = None
+        self._checked_at = 0.0
+        self._in_use = 0
+        self._pid = os.getpid()
+        self._stats = {'opened': 0, 'reused': 0, 'closed': 0, 'reloads': 0}
+
+    def _uri(self):
+        uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        return uri
+
+    def _open(self):
+        conn = sqlite3.connect(self._uri(), uri=True, check_same_thread=False, cached_statements=64)
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA query_only = 1")
+        self._stats['opened'] += 1
+        return conn
+
+    def _close_idle(self):
+        for conn, _gen in self._idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._stats['closed'] += 1
+        self._idle = []
+
+    def _refresh(self):
+        """Confere o mtime do arquivo (no máximo a cada ``check_interval`` s)."""
+        now = time.monotonic()
+        if self._mtime_ns is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        mtime_ns = os.stat(self.db_path).st_mtime_ns  # FileNotFoundError se sumir
+        if mtime_ns != self._mtime_ns:
+            if self._mtime_ns is not None:
+                self._stats['reloads'] += 1
+            self._mtime_ns = mtime_ns
+            self._generation += 1
+            self._close_idle()
+            self.indexed = None
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Processo filho (fork do gunicorn): não reaproveitar conexões do pai
+                self._pid = os.getpid()
+                self._idle = []
+                self._mtime_ns = None
+            self._refresh()
+            generation = self._generation
+            conn = None
+            while self._idle:
+                candidate, gen = self._idle.pop()
+                if gen == generation:
+                    conn = candidate
+                    self._stats['reused'] += 1
+                    break
+                candidate.close()
+                self._stats['closed'] += 1
+            self._in_use += 1
+        try:
+            if conn is None:
+                conn = self._open()
+            if self.indexed is None:
+                self.indexed = has_search_index(conn)
+            yield conn
+        except Exception:
+            if conn is not None:
+                conn.close()
+                self._stats['closed'] += 1
+                conn = None
+            raise
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                if conn is not None:
+                    if generation == self._generation and len(self._idle) < self.size:
+                        self._idle.append((conn, generation))
+                    else:
+                        conn.close()
+                        self._stats['closed'] += 1
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                self._stats,
+                pid=self._pid,
+                idle=len(self._idle),
+                in_use=self._in_use,
+                size=self.size,
+                generation=self._generation,
+                indexed=bool(self.indexed),
+            )
+
+    def close(self):
+        with self._lock:
+            self._close_idle()
+
+
+def get_pacientes_pool() -> PacientesPool:
+    """Pool do app atual (criado sob demanda, um por worker)."""
+    pool = current_app.extensions.get('pacientes_pool')
+    if pool is None:
+        cfg = current_app.config
+        pool = PacientesPool(
+            cfg['PACIENTES_DB_PATH'],
+            size=cfg.get('PACIENTES_POOL_SIZE', 4),
+            mmap_size=cfg.get('PACIENTES_MMAP_SIZE', 256 * 1024 * 1024),
+            immutable=cfg.get('PACIENTES_DB_IMMUTABLE', False),
+        )
+        current_app.extensions['pacientes_pool'] = pool
+    return pool
@@ -0,0 +1,179 @@
+"""Paginação por cursor (keyset) para as listas do SISREG.
+
+Em vez de OFFSET, cada página guarda os valores de ordenação do primeiro e do
+último item em um cursor opaco; a próxima página filtra "depois do último"
+pela mesma ordenação, então o custo não cresce com a profundidade do histórico.
+A ordenação precisa terminar em uma chave única (ex.: ``Formulario.id``).
+Valores nulos seguem a regra do SQLite (NULL é o menor valor).
+"""
+import base64
+import json
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+from flask import request, url_for
+from sqlalchemy import and_, false, or_
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+
+@dataclass(frozen=True)
+class SortKey:
+    expr: object
+    desc: bool = False
+
+
+def _encode_value(v):
+    if isinstance(v, datetime):
+        return ['dt', v.isoformat()]
+    if isinstance(v, date):
+        return ['d', v.isoformat()]
+    return ['v', v]
+
+
+def _decode_value(item):
+    if not isinstance(item, list) or len(item) != 2:
+        raise ValueError("item de cursor inválido")
+    kind, v = item
+    if kind == 'dt':
+        return datetime.fromisoformat(v)
+    if kind == 'd':
+        return date.fromisoformat(v)
+    # Só escalares chegam ao bind; listas/objetos são cursor adulterado
+    if kind != 'v' or not (v is None or isinstance(v, (str, int, float))):
+        raise ValueError("valor de cursor inválido")
+    return v
+
+
+def encode_cursor(values) -> str:
+    raw = json.dumps([_encode_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Valores do cursor ou ``None`` se inválido/adulterado."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        items = json.loads(raw)
+        if not isinstance(items, list):
+            return None
+        values = [_decode_value(item) for item in items]
+    except (ValueError, TypeError):
+        return None
+    return values if len(values) == size else None
+
+
+def _eq(expr, v):
+    return expr.is_(None) if v is None else expr == v
+
+
+def _gt(expr, v):
+    return expr.isnot(None) if v is None else expr > v
+
+
+def _lt(expr, v):
+    return false() if v is None else or_(expr < v, expr.is_(None))
+
+
+def _after(keys, values, reverse):
+    """Predicado "vem depois de ``values``" na ordenação (ou antes, se ``reverse``)."""
+    clauses = []
+    for i, key in enumerate(keys):
+        ascending = key.desc == reverse
+        cmp = _gt(key.expr, values[i]) if ascending else _lt(key.expr, values[i])
+        clauses.append(and_(*[_eq(keys[j].expr, values[j]) for j in range(i)], cmp))
+    return or_(*clauses)
+
+
+def _nullable(expr) -> bool:
+    return getattr(getattr(expr, 'expression', expr), 'nullable', True)
+
+
+def _bound(key, value, reverse):
+    """Faixa redundante na primeira chave: o OR de ``_after`` sozinho não vira SEARCH no índice."""
+    if value is None:
+        return None
+    if key.desc == reverse:
+        return key.expr >= value
+    if _nullable(key.expr):
+        return or_(key.expr <= value, key.expr.is_(None))
+    return key.expr <= value
+
+
+def get_per_page(default=DEFAULT_PER_PAGE):
+    per_page = request.args.get('per_page', default, type=int) or default
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    per_page: int
+    next_cursor: str = None
+    prev_cursor: str = None
+    endpoint: str = None
+    extra_args: dict = field(default_factory=dict)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def _url(self, cursor, direction):
+        args = {k: v for k, v in request.args.items() if k not in ('cursor', 'dir')}
+        args.update(self.extra_args)
+        return url_for(self.endpoint, cursor=cursor, dir=direction, **args)
+
+    @property
+    def next_url(self):
+        return self._url(self.next_cursor, 'next') if self.has_next else None
+
+    @property
+    def prev_url(self):
+        return self._url(self.prev_cursor, 'prev') if self.has_prev else None
+
+
+def keyset_query(query, keys, per_page, values=None, reverse=False):
+    """``query`` restrita à página após ``values`` (ou antes, se ``reverse``), com as chaves anexadas."""
+    if values is not None:
+        query = query.where(_after(keys, values, reverse))
+        bound = _bound(keys[0], values[0], reverse)
+        if bound is not None:
+            query = query.where(bound)
+    order = []
+    for key in keys:
+        order.append(key.expr.asc() if key.desc == reverse else key.expr.desc())
+    return query.order_by(None).order_by(*order).add_columns(*[k.expr for k in keys]).limit(per_page + 1)
+
+
+def keyset_paginate(session, query, keys, endpoint, per_page=None, cursor=None, direction=None):
+    """Executa ``query`` (um ``select`` de uma entidade, sem ORDER BY) paginada por ``keys``.
+
+    ``cursor``/``direction`` vêm de ``request.args`` quando omitidos.
+    """
+    per_page = per_page or get_per_page()
+    cursor = cursor if cursor is not None else request.args.get('cursor', '')
+    direction = direction or request.args.get('dir', 'next')
+    reverse = direction == 'prev'
+
+    values = decode_cursor(cursor, len(keys)) if cursor else None
+    rows = session.execute(keyset_query(query, keys, per_page, values, reverse)).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+
+    page = KeysetPage(items=[r[0] for r in rows], per_page=per_page, endpoint=endpoint)
+    if rows:
+        first, last = encode_cursor(rows[0][1:]), encode_cursor(rows[-1][1:])
+        if reverse:
+            page.prev_cursor = first if has_more else None
+            page.next_cursor = last
+        else:
+            page.next_cursor = last if has_more else None
+            page.prev_cursor = first if values is not None else None
+    return page
@@ -0,0 +1,78 @@
+"""Cache curto (TTL) dos agregados do painel principal.
+
+Os blocos de ``dados_dashboard`` que não dependem do usuário (contadores e
+gráfico de quem tem ADMIN/VER_RELATORIOS, total de usuários do ADMIN) ficam
+em memória por ``PANEL_CACHE_TTL`` segundos em cada worker. Quando uma
+entrada expira, só uma requisição recalcula (single-flight); as demais que
+chegam no mesmo instante esperam pelo resultado em vez de repetir as
+consultas. ``PANEL_CACHE_TTL = 0`` desliga o cache.
+"""
+import threading
+import time
+
+from flask import current_app
+
+
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._key_locks = {}
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0}
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry
+        return None
+
+    def get_or_compute(self, key, compute):
+        if self.ttl <= 0:
+            return compute()
+        with self._lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                self._stats['hits'] += 1
+                return entry[1]
+            # [lock, quantos usam]: o lock da chave sai do dicionário quando ninguém mais o usa
+            trava = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            trava[1] += 1
+        try:
+            with trava[0]:
+                # Outra requisição pode ter recalculado enquanto esperávamos
+                with self._lock:
+                    entry = self._fresh(key)
+                    if entry is not None:
+                        self._stats['waits'] += 1
+                        return entry[1]
+                value = compute()
+                with self._lock:
+                    self._stats['misses'] += 1
+                    self._entries[key] = (time.monotonic() + self.ttl, value)
+                    # Remove entradas vencidas (ex.: chaves de dias anteriores)
+                    agora = time.monotonic()
+                    for k in [k for k, (expira, _) in self._entries.items() if expira <= agora]:
+                        self._entries.pop(k, None)
+                return value
+        finally:
+            with self._lock:
+                trava[1] -= 1
+                if not trava[1]:
+                    del self._key_locks[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), locks=len(self._key_locks), ttl=self.ttl)
+
+
+def get_panel_cache() -> TTLCache:
+    cache = current_app.extensions.get('painel_cache')
+    if cache is None:
+        cache = TTLCache(current_app.config.get('PANEL_CACHE_TTL', 60))
+        current_app.extensions['painel_cache'] = cache
+    return cache
@@ -0,0 +1,153 @@
+"""PDF da solicitação/autorização de um formulário.
+
+O HTML (``templates/pdf/formulario.html``) é renderizado no worker web; o
+weasyprint roda em um ``ProcessPoolExecutor`` (``PDF_WORKERS`` processos por
+worker) para não segurar a requisição com trabalho de CPU. O arquivo fica em
+``PDF_CACHE_DIR`` com o nome igual ao SHA-256 do HTML: enquanto o conteúdo
+do formulário não muda, downloads repetidos saem direto do disco. Pedidos
+simultâneos do mesmo PDF compartilham a mesma renderização, e a requisição
+não espera por ela: ``pdf_formulario`` só a inicia e a tela tenta de novo.
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, time, timedelta
+
+from flask import current_app, render_template
+from sqlalchemy import select
+
+from app.models import db, Formulario, FormularioEvento
+from app.utils import eventos
+from app.utils.carregamento import PDF, formulario_options
+
+_lock = threading.RLock()
+_pendentes = {}
+# Erro da última renderização de cada chave que falhou, entregue a quem pedir a seguir
+_falhas = {}
+
+
+def _render_pdf(html, destino, base_url):
+    # Roda no processo do pool
+    from weasyprint import HTML
+
+    tmp = f"{destino}.{os.getpid()}.tmp"
+    HTML(string=html, base_url=base_url).write_pdf(tmp)
+    os.replace(tmp, destino)
+    return destino
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    pool = current_app.extensions.get('pdf_pool')
+    if pool is None:
+        with _lock:
+            pool = current_app.extensions.get('pdf_pool')
+            if pool is None:
+                # spawn: o worker web pode ter threads/greenlets; fork herdaria locks no meio do uso
+                pool = ProcessPoolExecutor(
+                    max_workers=current_app.config.get('PDF_WORKERS', 2),
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+                current_app.extensions['pdf_pool'] = pool
+    return pool
+
+
+def html_formulario(formulario) -> str:
+    return render_template('pdf/formulario.html', f=formulario)
+
+
+def chave_html(html) -> str:
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+def caminho_pdf(chave) -> str:
+    return os.path.join(current_app.config['PDF_CACHE_DIR'], chave[:2], f"{chave}.pdf")
+
+
+def _submeter(html, chave):
+    """Future da renderização de ``chave`` (reaproveita uma que já esteja em andamento)."""
+    destino = caminho_pdf(chave)
+    with _lock:
+        future = _pendentes.get(chave)
+        if future is None:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            future = get_pdf_pool().submit(_render_pdf, html, destino, current_app.root_path)
+            _pendentes[chave] = future
+            future.add_done_callback(lambda f: _concluir(chave, f))
+    return future
+
+
+def _concluir(chave, future):
+    with _lock:
+        _pendentes.pop(chave, None)
+        if not future.cancelled() and future.exception() is not None:
+            _falhas[chave] = future.exception()
+
+
+def pdf_formulario(formulario):
+    """``(caminho, chave, pronto)`` do PDF atual do formulário.
+
+    Se o arquivo não está no cache, inicia a renderização (sem esperar) e
+    devolve ``pronto=False``. Se a última renderização desse conteúdo falhou,
+    levanta o erro dela. Com o arquivo pronto, atualiza ``formulario.pdf``;
+    o commit fica com quem chama.
+    """
+    html = html_formulario(formulario)
+    chave = chave_html(html)
+    destino = caminho_pdf(chave)
+    if os.path.exists(destino):
+        formulario.pdf = os.path.basename(destino)
+        return destino, chave, True
+    with _lock:
+        erro = _falhas.pop(chave, None)
+    if erro is not None:
+        raise erro
+    _submeter(html, chave)
+    return destino, chave, False
+
+
+def renderizar_lote(formularios) -> dict:
+    """Renderiza em paralelo os PDFs que ainda não estão no cache.
+
+    ``formulario.pdf`` só é atualizado quando o arquivo existe (cache ou
+    renderização concluída).
+    """
+    stats = {'total': 0, 'cache': 0, 'gerados': 0, 'erros': 0}
+    futures = {}
+    por_chave = {}
+    for f in formularios:
+        stats['total'] += 1
+        html = html_formulario(f)
+        chave = chave_html(html)
+        if os.path.exists(caminho_pdf(chave)):
+            stats['cache'] += 1
+            f.pdf = f"{chave}.pdf"
+            continue
+        if chave not in por_chave:
+            por_chave[chave] = []
+            futures[_submeter(html, chave)] = chave
+        por_chave[chave].append(f)
+    for future in as_completed(futures):
+        chave = futures[future]
+        if future.exception() is None:
+            stats['gerados'] += 1
+            for f in por_chave[chave]:
+                f.pdf = f"{chave}.pdf"
+        else:
+            stats['erros'] += 1
+            current_app.logger.error("Falha ao gerar PDF %s: %s", chave, future.exception())
+    return stats
+
+
+def autorizados_em(dia) -> list:
+    """Formulários autorizados/reagendados pela Regulação em ``dia`` (horário de Brasília)."""
+    inicio = datetime.combine(dia, time()) + timedelta(hours=3)
+    ids = select(FormularioEvento.formulario_id).where(
+        FormularioEvento.tipo.in_((eventos.REGULACAO_AUTORIZAR, eventos.REGULACAO_REAGENDAR)),
+        FormularioEvento.criado_em >= inicio,
+        FormularioEvento.criado_em < inicio + timedelta(days=1),
+    )
+    return db.session.execute(
+        select(Formulario).options(*formulario_options(*PDF)).where(Formulario.id.in_(ids)).order_by(Formulario.id)
+    ).scalars().all()
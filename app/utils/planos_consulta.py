@@ -0,0 +1,170 @@
+"""Verificação dos planos de consulta da tabela ``formulario``.
+
+Cada entrada de ``consultas()`` reproduz a forma de uma consulta das rotas
+(listas do SISREG com paginação por cursor, contadores, agenda, ocupação de
+horários e painel). ``verificar_planos`` roda ``EXPLAIN QUERY PLAN`` com os
+mesmos parâmetros que o SQLAlchemy enviaria e marca como regressão:
+
+- ``SCAN formulario``, com ou sem ``USING [COVERING] INDEX`` (percorrer o
+  índice inteiro também lê a tabela toda). Única exceção: consulta sem
+  ``WHERE``, com ``LIMIT`` e ordenada pelo índice (primeira página de uma
+  lista), que para depois de ``LIMIT`` linhas, e as agregações da tabela
+  inteira de ``AGREGACAO_TOTAL`` (``GROUP BY`` sem filtro), em que varrer um
+  índice de cobertura é o melhor plano possível;
+- ``USE TEMP B-TREE FOR ORDER BY`` (ordena todas as linhas filtradas).
+
+Usado por ``flask check-query-plans``. ``criar_indices_expressao`` cria os
+índices de expressão de ``formulario``, que o autogenerate do alembic não
+detecta no SQLite (``flask create-expression-indexes``).
+"""
+import re
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, func, inspect, literal_column, or_, select
+from sqlalchemy.sql.elements import TextClause
+
+from app.models import db, Formulario, PRIORIDADE_REGULACAO_SQL, PRIORIDADE_UBS_SQL
+from app.utils.paginacao import SortKey, keyset_query
+
+_SCAN_RE = re.compile(r'^SCAN (TABLE )?formulario\b')
+_SCAN_INDICE_RE = re.compile(r'^SCAN (TABLE )?formulario USING (COVERING )?INDEX ')
+_SCAN_COBERTURA_RE = re.compile(r'^SCAN (TABLE )?formulario USING COVERING INDEX ')
+_TEMP_ORDER_BY = 'USE TEMP B-TREE FOR ORDER BY'
+
+# Consultas que agregam a tabela toda: só o índice de cobertura é aceito
+AGREGACAO_TOTAL = {'regulacao.contadores'}
+
+
+def consultas() -> list:
+    """``[(nome, select)]`` com as formas de consulta usadas nas rotas."""
+    hoje = date.today()
+    agora = datetime.now()
+    per_page = 50
+
+    regulacao = [
+        SortKey(literal_column(f"({PRIORIDADE_REGULACAO_SQL})")),
+        SortKey(Formulario.data_registro, desc=True),
+        SortKey(Formulario.id, desc=True),
+    ]
+    ubs = [
+        SortKey(literal_column(f"({PRIORIDADE_UBS_SQL})")),
+        SortKey(Formulario.data_registro, desc=True),
+        SortKey(Formulario.id, desc=True),
+    ]
+    ambulatorio = [
+        SortKey(Formulario.data_atendimento),
+        SortKey(Formulario.hora_agendamento),
+        SortKey(Formulario.id),
+    ]
+    formularios = [
+        SortKey(Formulario.data_registro, desc=True),
+        SortKey(Formulario.id, desc=True),
+    ]
+    agendados = select(Formulario).where(Formulario.status == 'AGENDADO')
+
+    formas = [
+        ('regulacao.lista', keyset_query(select(Formulario), regulacao, per_page)),
+        ('regulacao.lista_cursor', keyset_query(select(Formulario), regulacao, per_page, [0, agora, 1000])),
+        ('ubs.lista', keyset_query(select(Formulario), ubs, per_page, [1, agora, 1000])),
+        ('ubs.meus', keyset_query(select(Formulario).where(Formulario.funcionario_id == 1), ubs, per_page)),
+        ('ambulatorio.lista', keyset_query(agendados, ambulatorio, per_page, [hoje, '08:00', 1000])),
+        ('ambulatorio.contadores',
+         agendados.with_only_columns(Formulario.compareceu, func.count()).group_by(Formulario.compareceu)),
+        ('formularios.lista', keyset_query(select(Formulario), formularios, per_page, [agora, 1000])),
+        ('formularios.status',
+         keyset_query(select(Formulario).where(Formulario.status == 'CONCLUIDO'), formularios, per_page)),
+        ('agenda.periodo', agendados.where(
+            Formulario.data_atendimento.isnot(None),
+            Formulario.data_atendimento >= hoje,
+            Formulario.data_atendimento <= hoje + timedelta(days=30),
+        ).order_by(Formulario.data_atendimento.asc(), Formulario.hora_agendamento.asc())),
+        ('agenda.medicos',
+         select(Formulario.medico_atendimento).where(Formulario.medico_atendimento.isnot(None)).distinct()),
+        ('agenda.locais',
+         select(Formulario.local_destino).where(Formulario.local_destino.isnot(None)).distinct()),
+        ('agendamento.ocupacao', select(
+            Formulario.data_atendimento, Formulario.hora_agendamento,
+            Formulario.medico_atendimento, Formulario.local_destino)
+         .where(Formulario.status == 'AGENDADO')
+         .where(Formulario.data_atendimento >= hoje, Formulario.data_atendimento <= hoje + timedelta(days=30))
+         .where(or_(Formulario.medico_atendimento == 'x', Formulario.local_destino == 'x'))),
+        ('painel.em_analise', select(func.count(Formulario.id)).where(Formulario.status == 'EM_ANALISE')),
+        ('painel.agendados_hoje', select(func.count(Formulario.id))
+         .where(Formulario.status == 'AGENDADO', Formulario.data_atendimento == hoje)),
+        ('painel.grafico', select(Formulario.especialidade, func.count(Formulario.id))
+         .where(Formulario.data_registro >= hoje - timedelta(days=30))
+         .group_by(Formulario.especialidade)),
+        ('painel.meus_envios', select(Formulario)
+         .where(Formulario.funcionario_id == 1)
+         .order_by(Formulario.data_registro.desc())
+         .limit(5)),
+    ]
+    if not current_app.config.get('STATUS_COUNTERS'):
+        # Com STATUS_COUNTERS os contadores saem de status_counters, sem tocar em formulario
+        formas.append(('regulacao.contadores', select(Formulario.status, func.count()).group_by(Formulario.status)))
+    return formas
+
+
+def explain(stmt) -> tuple[str, list[str]]:
+    """``(sql, linhas de EXPLAIN QUERY PLAN)`` para ``stmt`` (que também é executado)."""
+    sql, plan = [], []
+
+    def capturar(conn, cursor, statement, parameters, context, executemany):
+        sql.append(statement)
+        plan.extend(row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall())
+
+    with db.engine.connect() as conn:
+        event.listen(conn, 'before_cursor_execute', capturar)
+        conn.execute(stmt).fetchall()
+    return ' '.join(sql), plan
+
+
+def _primeira_pagina(sql) -> bool:
+    return re.search(r'\bLIMIT\b', sql) is not None and re.search(r'\bWHERE\b', sql) is None
+
+
+def full_scan(sql, plan, agregacao=False) -> bool:
+    if _TEMP_ORDER_BY in plan:
+        return True
+    for line in plan:
+        if not _SCAN_RE.match(line):
+            continue
+        if _SCAN_INDICE_RE.match(line) and _primeira_pagina(sql):
+            continue
+        if agregacao and _SCAN_COBERTURA_RE.match(line):
+            continue
+        return True
+    return False
+
+
+def verificar_planos() -> list:
+    """``[(nome, plano, ok)]`` para cada consulta de ``consultas()``."""
+    resultado = []
+    for nome, stmt in consultas():
+        sql, plan = explain(stmt)
+        resultado.append((nome, plan, not full_scan(sql, plan, nome in AGREGACAO_TOTAL)))
+    return resultado
+
+
+def indices_expressao() -> list:
+    """Índices de ``formulario`` com colunas de expressão SQL."""
+    return [
+        indice for indice in Formulario.__table__.indexes
+        if any(isinstance(expr, TextClause) for expr in indice.expressions)
+    ]
+
+
+def indices_expressao_faltando() -> list:
+    """Índices de expressão declarados no modelo que não existem no banco."""
+    inspetor = inspect(db.engine)
+    return [indice for indice in indices_expressao() if not inspetor.has_index('formulario', indice.name)]
+
+
+def criar_indices_expressao() -> list:
+    """Cria (se faltarem) os índices de expressão; devolve os nomes criados."""
+    faltando = indices_expressao_faltando()
+    with db.engine.begin() as conn:
+        for indice in faltando:
+            indice.create(conn)
+    return [indice.name for indice in faltando]
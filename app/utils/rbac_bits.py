@@ -0,0 +1,150 @@
+"""Permissões RBAC compiladas em máscaras de bits.
+
+Cada permissão do catálogo (e qualquer nome legado ainda gravado numa role)
+recebe uma posição de bit; cada role vira um inteiro com os bits das suas
+permissões e cada usuário, o OR das máscaras das suas roles. Checar uma
+permissão é um ``&`` entre inteiros, sem desserializar ``Role.permissions``
+nem carregar ``User.roles``.
+
+O compilado fica em memória por worker junto com a versão ``rbac`` de
+``cache_versions``. Um flush que cria/apaga roles ou permissões do catálogo,
+muda ``Role.permissions`` ou as roles de um usuário incrementa a versão e
+todos os workers recompilam na próxima checagem. A versão é lida uma vez por
+requisição (guardada em ``g``).
+"""
+import threading
+from itertools import chain
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, inspect, select
+
+from app.models import db, PermissionCatalog, Role, User, user_roles
+from app.utils.versoes import incrementar_versao, ler_versao
+
+VERSAO = 'rbac'
+
+_lock = threading.Lock()
+
+
+class RBACCompilado:
+    def __init__(self, versao, bits, roles):
+        self.versao = versao
+        self.bits = bits
+        self.roles = roles
+        self._usuarios = {}
+
+    def mascara(self, *nomes) -> int:
+        """Bits de ``nomes``; nomes desconhecidos não contribuem (nenhuma role os tem)."""
+        mascara = 0
+        for nome in nomes:
+            mascara |= self.bits.get(nome, 0)
+        return mascara
+
+    def mascara_usuario(self, user_id) -> int:
+        mascara = self._usuarios.get(user_id)
+        if mascara is None:
+            role_ids = db.session.execute(
+                select(user_roles.c.role_id).where(user_roles.c.user_id == user_id)
+            ).scalars()
+            mascara = 0
+            for role_id in role_ids:
+                mascara |= self.roles.get(role_id, 0)
+            self._usuarios[user_id] = mascara
+        return mascara
+
+    def nomes(self, mascara) -> list:
+        return [nome for nome, bit in self.bits.items() if mascara & bit]
+
+
+def _compilar(versao) -> RBACCompilado:
+    bits = {}
+    for nome in db.session.execute(select(PermissionCatalog.name).order_by(PermissionCatalog.id)).scalars():
+        bits.setdefault(nome, 1 << len(bits))
+    roles = {}
+    for role_id, permissoes in db.session.execute(select(Role.id, Role.permissions)).all():
+        mascara = 0
+        for nome in permissoes or ():
+            mascara |= bits.setdefault(nome, 1 << len(bits))
+        roles[role_id] = mascara
+    return RBACCompilado(versao, bits, roles)
+
+
+def versao_atual() -> int:
+    versao = g.get('_rbac_versao')
+    if versao is None:
+        versao = g._rbac_versao = ler_versao(VERSAO)
+    return versao
+
+
+def compilado() -> RBACCompilado:
+    versao = versao_atual()
+    atual = current_app.extensions.get('rbac')
+    if atual is not None and atual.versao == versao:
+        return atual
+    with _lock:
+        atual = current_app.extensions.get('rbac')
+        if atual is None or atual.versao != versao:
+            atual = _compilar(versao)
+            current_app.extensions['rbac'] = atual
+    return atual
+
+
+def disponivel(user) -> bool:
+    """Usuário persistido, sem roles alteradas na sessão e dentro do contexto da aplicação.
+
+    Fora disso vale a checagem direta em ``user.roles``.
+    """
+    return (
+        has_app_context()
+        and user.id is not None
+        and not inspect(user).attrs.roles.history.has_changes()
+    )
+
+
+def tem_alguma(user, *nomes) -> bool:
+    rbac = compilado()
+    return bool(rbac.mascara_usuario(user.id) & rbac.mascara(*nomes))
+
+
+def permissoes(user) -> list:
+    rbac = compilado()
+    return rbac.nomes(rbac.mascara_usuario(user.id))
+
+
+def _mudou(session) -> bool:
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, (Role, PermissionCatalog)):
+            return True
+        if isinstance(obj, User) and obj in session.deleted:
+            return True
+    for obj in session.dirty:
+        if isinstance(obj, Role) and inspect(obj).attrs.permissions.history.has_changes():
+            return True
+        if isinstance(obj, User) and inspect(obj).attrs.roles.history.has_changes():
+            return True
+        if isinstance(obj, PermissionCatalog) and inspect(obj).attrs.name.history.has_changes():
+            return True
+    return False
+
+
+def _after_flush(session, flush_context):
+    if _mudou(session):
+        incrementar_versao(session.connection(), VERSAO)
+        session.info['rbac_mudou'] = True
+
+
+def _after_commit(session):
+    if session.info.pop('rbac_mudou', False) and has_app_context():
+        # Checagens seguintes nesta mesma requisição já enxergam a nova versão
+        g.pop('_rbac_versao', None)
+
+
+def _after_rollback(session):
+    session.info.pop('rbac_mudou', None)
+
+
+def init_rbac_bits(app):
+    for nome, hook in (('after_flush', _after_flush), ('after_commit', _after_commit),
+                       ('after_rollback', _after_rollback)):
+        if not event.contains(db.session, nome, hook):
+            event.listen(db.session, nome, hook)
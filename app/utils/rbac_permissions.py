@@ -60,10 +60,8 @@ def require_permission(permission_name):
             if not current_user.is_authenticated:
                 return redirect(url_for('auth.login'))
             
-            if current_user.has_permission('admin-total'):
-                return f(*args, **kwargs)
-            
-            if not current_user.has_permission(permission_name):
+            # admin-total e a permissão pedida numa única checagem de bits
+            if not current_user.has_any_permission('admin-total', permission_name):
                 flash(f"Acesso negado! Você não possui a permissão '{permission_name}' necessária.", "danger")
                 return redirect(url_for('main.panel'))
             
@@ -81,12 +79,7 @@ def require_any_permission(permission_list):
             if not current_user.is_authenticated:
                 return redirect(url_for('auth.login'))
             
-            if current_user.has_permission('admin-total'):
-                return f(*args, **kwargs)
-            
-            has_permission = any(current_user.has_permission(perm) for perm in permission_list)
-            
-            if not has_permission:
+            if not current_user.has_any_permission('admin-total', *permission_list):
                 flash("Acesso negado! Você não possui as permissões necessárias.", "danger")
                 return redirect(url_for('main.panel'))
             
@@ -0,0 +1,138 @@
+"""Consolidado diário de formulários (tabela ``formulario_daily_rollup``).
+
+Cada linha conta os formulários de um dia de registro, especialidade, status
+e unidade de saúde. Com ``DAILY_ROLLUP`` ligado, o consolidado é atualizado no
+mesmo flush (mesma transação) de toda criação, exclusão ou alteração de uma
+dessas colunas, e o painel lê os totais dele em vez de agregar ``formulario``;
+o custo passa a depender do número de dias/combinações, não do histórico.
+Ao ligar a opção pela primeira vez rode ``flask rebuild-daily-rollup``.
+"""
+from collections import Counter
+from datetime import date
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, inspect, insert, select, update
+
+from app.models import db, Formulario, FormularioDailyRollup
+
+_tabela = FormularioDailyRollup.__table__
+# Dimensões do consolidado, na ordem da chave
+_DIMENSOES = ('data_registro', 'especialidade', 'status', 'unidade_saude')
+
+
+def rollup_enabled() -> bool:
+    return has_app_context() and bool(current_app.config.get('DAILY_ROLLUP'))
+
+
+def _dia(valor):
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor.date() if hasattr(valor, 'date') else valor
+
+
+def _chave(valores):
+    registro, especialidade, status, unidade = valores
+    if registro is None:
+        return None
+    return (_dia(registro), especialidade, status, unidade)
+
+
+def _valores_antigos(obj):
+    attrs = inspect(obj).attrs
+    valores = []
+    for nome in _DIMENSOES:
+        history = attrs[nome].history
+        valores.append((history.deleted or history.unchanged or [getattr(obj, nome)])[0])
+    return valores
+
+
+def _valores_atuais(obj):
+    return [getattr(obj, nome) for nome in _DIMENSOES]
+
+
+def _deltas(session) -> Counter:
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Formulario):
+            deltas[_chave(_valores_atuais(obj))] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Formulario):
+            deltas[_chave(_valores_antigos(obj))] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, Formulario) and obj not in session.deleted:
+            antiga, nova = _chave(_valores_antigos(obj)), _chave(_valores_atuais(obj))
+            if antiga != nova:
+                deltas[antiga] -= 1
+                deltas[nova] += 1
+    deltas.pop(None, None)
+    return deltas
+
+
+def _after_flush(session, flush_context):
+    if not rollup_enabled():
+        return
+    conn = session.connection()
+    for (dia, especialidade, status, unidade), delta in _deltas(session).items():
+        if not delta:
+            continue
+        result = conn.execute(
+            update(_tabela)
+            .where(_tabela.c.dia == dia, _tabela.c.especialidade == especialidade,
+                   _tabela.c.status == status, _tabela.c.unidade_saude == unidade)
+            .values(total=_tabela.c.total + delta)
+        )
+        if result.rowcount == 0:
+            conn.execute(insert(_tabela).values(
+                dia=dia, especialidade=especialidade, status=status, unidade_saude=unidade, total=delta,
+            ))
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+def init_daily_rollup(app):
+    app.config.setdefault('DAILY_ROLLUP', False)
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        # Valor anterior carregado antes da troca, para tirar a linha antiga do consolidado
+        for nome in _DIMENSOES:
+            event.listen(getattr(Formulario, nome), 'set', _keep_old_value, active_history=True, retval=True)
+
+
+def rebuild_daily_rollup() -> int:
+    """Recalcula ``formulario_daily_rollup`` a partir de ``formulario``; devolve o nº de linhas."""
+    dia = func.date(Formulario.data_registro)
+    rows = db.session.execute(
+        select(dia, Formulario.especialidade, Formulario.status, Formulario.unidade_saude, func.count())
+        .group_by(dia, Formulario.especialidade, Formulario.status, Formulario.unidade_saude)
+    ).all()
+    db.session.execute(delete(FormularioDailyRollup))
+    if rows:
+        db.session.execute(insert(FormularioDailyRollup), [
+            {'dia': _dia(d), 'especialidade': esp, 'status': status, 'unidade_saude': unidade, 'total': total}
+            for d, esp, status, unidade, total in rows
+        ])
+    db.session.commit()
+    return len(rows)
+
+
+def total_por_status(status) -> int:
+    return db.session.execute(
+        select(func.coalesce(func.sum(_tabela.c.total), 0)).where(_tabela.c.status == status)
+    ).scalar_one()
+
+
+def total_por_especialidade(desde, limite=None) -> list:
+    """``[(especialidade, total)]`` registrados a partir de ``desde``, do maior para o menor."""
+    total = func.sum(_tabela.c.total).label('total')
+    stmt = (
+        select(_tabela.c.especialidade, total)
+        .where(_tabela.c.dia >= desde)
+        .group_by(_tabela.c.especialidade)
+        .having(total > 0)
+        .order_by(total.desc())
+    )
+    if limite:
+        stmt = stmt.limit(limite)
+    return db.session.execute(stmt).all()
@@ -0,0 +1,30 @@
+"""Contadores de versão compartilhados entre workers (tabela ``cache_versions``).
+
+Caches em memória de cada processo guardam a versão com que foram montados e
+comparam com ``ler_versao`` (uma leitura por chave primária) antes de usar o
+valor. Quem altera os dados chama ``incrementar_versao`` na mesma transação
+da escrita, então um rollback também desfaz a invalidação. A tabela é criada
+pelas migrações (``flask db upgrade``), como as demais.
+"""
+from sqlalchemy import insert, select, update
+
+from app.models import db, CacheVersion
+
+_tabela = CacheVersion.__table__
+
+
+def ler_versao(nome, conn=None) -> int:
+    """Versão atual de ``nome``; ``conn`` lê dentro de uma transação em curso (ex.: num flush)."""
+    versao = (conn or db.session).execute(
+        select(_tabela.c.versao).where(_tabela.c.nome == nome)
+    ).scalar_one_or_none()
+    return versao or 0
+
+
+def incrementar_versao(conn, nome):
+    """Incrementa ``nome`` usando ``conn`` (a conexão da transação em curso)."""
+    result = conn.execute(
+        update(_tabela).where(_tabela.c.nome == nome).values(versao=_tabela.c.versao + 1)
+    )
+    if result.rowcount == 0:
+        conn.execute(insert(_tabela).values(nome=nome, versao=1))
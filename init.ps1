@@ -22,5 +22,9 @@ pip install --upgrade pip
 Write-Host "Instalando dependências..."
 pip install -r requirements.txt
 
+if (-Not (Get-Command pdftoppm -ErrorAction SilentlyContinue)) {
+    Write-Warning "pdftoppm (poppler) não encontrado no PATH: anexos PDF ficarão sem prévia."
+}
+
 Write-Host "Iniciando o app Python..."
 python main.py